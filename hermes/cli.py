@@ -11,23 +11,33 @@ from datetime import datetime, timedelta
 from functools import partial
 from importlib.util import module_from_spec, spec_from_file_location
 import inspect
+import os
 import sys
-from operator import attrgetter
 from pathlib import Path
 import random
 from typing import Any, Dict, Optional
 
 from appdirs import user_config_dir, user_data_dir
 import click
-from dateutil.tz import tzlocal
 
 from .chores import Chore, ChoreStore
 from .clients.gcal import GoogleClient, GoogleCalendarAPI, GoogleCalendarTimeSpan
+from .clients.ics import load_ics, read_ics, write_ics
+from .clients.records import (
+    insert_batched,
+    read_csv,
+    read_jsonl,
+    stored_tags,
+    write_csv,
+    write_jsonl,
+)
+from .columnar import MappedTimeSpan
+from .partition import PartitionedTimeSpan
 from .schedule import Schedule
 from .span import Span
 from .stochastics import Frequency
-from .timespan import date_parse
-from .utils import get_now
+from .timespan import BaseTimeSpan, date_parse, diff, SqliteTimeSpan
+from .utils import get_now, local_timezone, to_local
 
 
 APP_NAME = "HermesCLI"
@@ -138,14 +148,14 @@ def calendars(
         if tomorrow or start_date or finish_date:
             context.Fail("You must not specify multiple calendar spans.")
         start = get_now().replace(
-            hour=0, minute=0, second=0, microsecond=0, tzinfo=tzlocal()
+            hour=0, minute=0, second=0, microsecond=0, tzinfo=local_timezone()
         )
         stop = start + timedelta(days=1, microseconds=-1)  # Last microsecond of the day
     elif tomorrow:
         if today or start_date or finish_date:
             context.Fail("You must not specify multiple calendar spans.")
         start = get_now().replace(
-            hour=0, minute=0, second=0, microsecond=0, tzinfo=tzlocal()
+            hour=0, minute=0, second=0, microsecond=0, tzinfo=local_timezone()
         ) + timedelta(days=1)
         stop = start + timedelta(days=1, microseconds=-1)  # Last microsecond of the day
     elif start_date and finish_date:
@@ -156,7 +166,7 @@ def calendars(
     else:
         # assume 'today'
         start = get_now().replace(
-            hour=0, minute=0, second=0, microsecond=0, tzinfo=tzlocal()
+            hour=0, minute=0, second=0, microsecond=0, tzinfo=local_timezone()
         )
         stop = start + timedelta(days=1, microseconds=-1)  # Last microsecond of the day
 
@@ -201,14 +211,16 @@ def events(context: CallContext, pretty: bool = True) -> None:
         if pretty:
             click.secho(f"{cal_data['summary']} [{cal_id}]", bold=True)
         timespan = context.gcal.client.load_timespan(cal_id, **load_opts)
-        if pretty:
-            click.secho(f"Found {len(timespan)} events.")
-        for event in timespan.iter_tags():
+        found = 0
+        for event in timespan.iter_tags(order_by="valid_from"):
             indent = "\t" if pretty else ""
             category = f" ({event.category.fullpath})" if pretty else ""
             click.secho(
-                f"{indent}{event.name} <{event.valid_from.isoformat()}, {event.valid_to.isoformat()}>{category}"
+                f"{indent}{event.name} <{to_local(event.valid_from).isoformat()}, {to_local(event.valid_to).isoformat()}>{category}"
             )
+            found += 1
+        if pretty:
+            click.secho(f"Found {found} events.")
 
 
 @calendars.command()
@@ -231,7 +243,7 @@ def clear(context, yes):
     click.secho("Events:")
     for event in gcal.iter_tags():
         click.secho(
-            f"\t{event.name} <{event.valid_from.isoformat()}, {event.valid_to.isoformat()}> ({event.category.fullpath}"
+            f"\t{event.name} <{to_local(event.valid_from).isoformat()}, {to_local(event.valid_to).isoformat()}> ({event.category.fullpath}"
         )
 
     if not yes:
@@ -240,7 +252,7 @@ def clear(context, yes):
         )
 
     gcal.remove_events()
-    gcal.flush()
+    gcal.flush(resync=False)
 
 
 @calendars.command(name="next")
@@ -295,12 +307,9 @@ def whatsnext(context, schedule, slots, check_calendar, check_calendar_id, chore
 
     slot_list = []
     slot_schedules = {}
-    events = [e for e in gcal.iter_tags()]
     now = get_now()
     # TODO - the notion of 'upcoming' as relates to currently in-progress events is tricky
-    upcoming_events = sorted(
-        (e for e in events if e.valid_to >= now), key=attrgetter("valid_from")
-    )
+    upcoming_events = list(gcal.active_at(now)) + list(gcal.next_after(now, n=None))
 
     if now >= context.gcal.span.finish_at:
         raise click.UsageError(
@@ -368,7 +377,7 @@ def whatsnext(context, schedule, slots, check_calendar, check_calendar_id, chore
             unfeasible_count += 1
             continue
 
-        new_events = sorted(plan.iter_tags(), key=attrgetter("valid_from"))
+        new_events = list(plan.iter_tags(order_by="valid_from"))
         if new_events:
             slot_list.append(new_events[0].name)
             slot_schedules[new_events[0].name] = new_events
@@ -388,7 +397,7 @@ def whatsnext(context, schedule, slots, check_calendar, check_calendar_id, chore
         # TODO - show whole plan, somehow? Ugly UI.
         for other in slot_schedules[slot_list[i]]:
             click.secho(
-                f"\t\t- {other.name} <{other.valid_from.isoformat()},{other.valid_to.isoformat()}>"
+                f"\t\t- {other.name} <{to_local(other.valid_from).isoformat()},{to_local(other.valid_to).isoformat()}>"
             )
 
     choice = click.prompt(
@@ -399,21 +408,24 @@ def whatsnext(context, schedule, slots, check_calendar, check_calendar_id, chore
 
     chosen_schedule = slot_schedules[slot_list[int(choice)]]
 
-    if sorted(upcoming_events, key=attrgetter("valid_from")) != chosen_schedule:
+    changes = diff(upcoming_events, chosen_schedule)
+    if changes:
+        removals = changes.removed + [old for old, _ in changes.changed]
+        additions = changes.added + [new for _, new in changes.changed]
         click.secho("Removing previously scheduled events:", bold=True)
-        for event in upcoming_events:
+        for event in removals:
             click.secho(
-                f"\t{event.name} <{event.valid_from.isoformat()}, {event.valid_to.isoformat()}>"
+                f"\t{event.name} <{to_local(event.valid_from).isoformat()}, {to_local(event.valid_to).isoformat()}>"
             )
             gcal.remove_tag(event)
 
         click.secho("Adding events:", bold=True)
-        for event in chosen_schedule:
+        for event in additions:
             click.secho(
-                f"\t{event.name} <{event.valid_from.isoformat()}, {event.valid_to.isoformat()}>"
+                f"\t{event.name} <{to_local(event.valid_from).isoformat()}, {to_local(event.valid_to).isoformat()}>"
             )
             gcal.insert_tag(event)
-        gcal.flush()
+        gcal.flush(resync=False)
     else:
         click.secho("The current schedule has been chosen, no changes made.")
 
@@ -540,6 +552,91 @@ def filenames(context):
         click.secho(str(schedule))
 
 
+@cli.command(name="export")
+@click.argument("source", type=click.Path(exists=True))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["jsonl", "csv", "ics"]),
+    default="jsonl",
+    show_default=True,
+)
+@click.option(
+    "--output", "-o", type=click.File("w"), default="-", help="Defaults to stdout."
+)
+@click.option(
+    "--horizon",
+    default=None,
+    help="Expand .ics events that recur forever up to this date. Defaults to a year from now.",
+)
+def export_tags(source, fmt, output, horizon):
+    """Stream every tag in a local timespan file (SQLite, columnar, .ics or a partitioned directory) to JSON Lines, CSV or iCalendar."""
+    timespan = _open_timespan(Path(source), _horizon(horizon))
+    if fmt == "ics":
+        count = write_ics(timespan, output)
+    else:
+        writer = write_jsonl if fmt == "jsonl" else write_csv
+        count = writer(stored_tags(timespan), output)
+    click.secho(f"Exported {count} tags.", err=True)
+
+
+@cli.command(name="import")
+@click.argument("input_file", metavar="INPUT", type=click.File("r"))
+@click.argument("target", type=click.Path(dir_okay=False))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["jsonl", "csv", "ics"]),
+    default=None,
+    help="Guessed from the input file's extension if not given, else jsonl.",
+)
+@click.option("--batch-size", type=int, default=10_000, show_default=True)
+@click.option(
+    "--horizon",
+    default=None,
+    help="Expand .ics events that recur forever up to this date. Defaults to a year from now.",
+)
+def import_tags(input_file, target, fmt, batch_size, horizon):
+    """Bulk insert tags from JSON Lines, CSV or iCalendar in to a SQLite timespan file, which is created if need be."""
+    if fmt is None:
+        suffix = Path(input_file.name).suffix.lstrip(".")
+        fmt = suffix if suffix in ("csv", "ics") else "jsonl"
+    readers = {
+        "jsonl": read_jsonl,
+        "csv": read_csv,
+        "ics": partial(read_ics, horizon=_horizon(horizon)),
+    }
+
+    target = Path(target)
+    timespan = SqliteTimeSpan.read_from(target) if target.exists() else SqliteTimeSpan()
+    count = insert_batched(timespan, readers[fmt](input_file), batch_size)
+
+    # Write next to the target first, so a failure leaves it untouched
+    partial_file = target.with_name(f"{target.name}.partial")
+    if partial_file.exists():
+        partial_file.unlink()
+    timespan.write_to(partial_file)
+    os.replace(str(partial_file), str(target))
+    click.secho(f"Imported {count} tags in to {target}.", err=True)
+
+
+def _horizon(horizon: Optional[str]) -> datetime:
+    """Where to stop recurrences that never end, as they can't be stored."""
+    if horizon is not None:
+        return date_parse(horizon)
+    return get_now() + timedelta(days=365)
+
+
+def _open_timespan(path: Path, horizon: Optional[datetime] = None) -> BaseTimeSpan:
+    if path.is_dir():
+        return PartitionedTimeSpan.read_from(path)
+    elif path.suffix == ".hcol":
+        return MappedTimeSpan.read_from(path)
+    elif path.suffix == ".ics":
+        return load_ics(path, horizon=horizon)
+    return SqliteTimeSpan.read_from(path)
+
+
 def _make_target_cal(context, calendar, calendar_id) -> str:
     if calendar is not None and calendar_id is not None:
         raise click.UsageError(
@@ -23,21 +23,26 @@ from urllib.parse import quote
 import warnings
 
 from appdirs import user_data_dir
+from dateutil.tz import gettz
 from google.auth.transport import Request
 from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
 from ..categorypool import BaseCategoryPool
+from ..fingerprint import Fingerprint
+from ..query import Query
 from ..span import Span
-from ..tag import Category, Tag
+from ..tag import Category, RecurringTag, Tag
 from ..timespan import (
     BaseTimeSpan,
     date_parse,
+    diff,
     InsertableTimeSpan,
     RemovableTimeSpan,
     SqliteTimeSpan,
 )
+from ..utils import UTC
 
 
 class GoogleClient:
@@ -291,7 +296,9 @@ class GoogleCalendarAPI:
         return self._post(f"/calendars/{quote(calendar_id)}/events", data=event)
 
     def remove_events(self, tag: Tag, calendar_id: CalendarID = primary) -> None:
-        """Remove all events that exactly correspond to this tag."""
+        """Remove all events that exactly correspond to this tag: the same
+        summary, start and end. An instance of a recurring event is removed
+        by itself, leaving the rest of the series."""
         start = tag.valid_from
         end = tag.valid_to
         if start is None or end is None:
@@ -301,20 +308,39 @@ class GoogleCalendarAPI:
 
         for event_info in self._paginated_get(
             f"/calendars/{quote(calendar_id)}/events",
-            params={"timeMax": end.isoformat(), "timeMin": start.isoformat()},
+            params={
+                "timeMax": end.isoformat(),
+                "timeMin": start.isoformat(),
+                "singleEvents": "true",
+            },
         ):
+            # The range also returns any other events overlapping the tag
+            found = self._event_tag(event_info, tag.category)
+            if (found.name, found.valid_from, found.valid_to) != (tag.name, start, end):
+                continue
             self._delete(
                 f"/calendars/{quote(calendar_id)}/events/{quote(event_info['id'])}"
             )
 
     def load_timespan(
-        self, calendar_id: CalendarID = primary, span: Span = None
+        self,
+        calendar_id: CalendarID = primary,
+        span: Span = None,
+        expand_recurring: bool = True,
     ) -> SqliteTimeSpan:
-        return SqliteTimeSpan(tags=self.events(calendar_id, span))
+        return SqliteTimeSpan(
+            tags=self.events(calendar_id, span, expand_recurring=expand_recurring)
+        )
 
     def events(
-        self, calendar_id: CalendarID = None, span: Span = None
+        self,
+        calendar_id: CalendarID = None,
+        span: Span = None,
+        expand_recurring: bool = True,
     ) -> Iterable[Tag]:
+        """Load events as tags. With `expand_recurring=False`, each recurring
+        event is loaded once as a RecurringTag (bounded by `span`) instead of
+        once per instance."""
         if calendar_id is None:
             calendar_ids = list(self.calendars())
         else:
@@ -322,6 +348,8 @@ class GoogleCalendarAPI:
 
         if span is None:
             span = Span(None, None)
+        if not expand_recurring and span.finish_at is None:
+            raise ValueError("Recurring events can only be loaded over a finite span")
 
         for cid in calendar_ids:
             calendar = self.calendar_info(cid)
@@ -333,9 +361,11 @@ class GoogleCalendarAPI:
                 "calendarId": cid,
                 "timeZone": "Etc/UTC",  # TODO - figure out how to get this to play nice with dateutil
                 "maxResults": "2500",
-                "singleEvents": "true",  # Don't expand recurring events (hermes doesn't use them anyway)
-                "orderBy": "startTime",  # requires singleEvents = True
             }
+            if expand_recurring:
+                query_params["singleEvents"] = "true"
+                query_params["orderBy"] = "startTime"  # requires singleEvents
+
             begins_at = ""
             if span.begins_at is not None:
                 begins_at = span.begins_at.isoformat() + (
@@ -352,28 +382,61 @@ class GoogleCalendarAPI:
             if finish_at:
                 query_params["timeMax"] = finish_at
 
+            # Without singleEvents, recurring events arrive as one "master"
+            # event plus an event per modified or cancelled instance. Masters
+            # are held back until every instance has been seen, so that the
+            # instances can be excluded from the rule.
+            masters: List[Dict[str, Any]] = []
+            exceptions: Dict[str, List[dt.datetime]] = {}
             for event in self._paginated_get(
                 f"/calendars/{quote(cid)}/events", params=query_params
             ):
-                start = event.get("start")
-                end = event.get("end")
-                valid_from = (
-                    date_parse(start.get("dateTime", start.get("date", None)))
-                    if start
-                    else None
-                )
-                valid_to = (
-                    date_parse(end.get("dateTime", end.get("date", None)))
-                    if end
-                    else None
+                if event.get("recurrence"):
+                    masters.append(event)
+                    continue
+                if "recurringEventId" in event and "originalStartTime" in event:
+                    exceptions.setdefault(event["recurringEventId"], []).append(
+                        self._parse_time(event["originalStartTime"])
+                    )
+                if event.get("status") == "cancelled":
+                    continue
+                yield self._event_tag(event, category)
+
+            for event in masters:
+                tag = self._event_tag(event, category)
+                if tag.valid_from is None or tag.valid_to is None:
+                    continue
+                # Times arrive in UTC, but the rule must be expanded in the
+                # event's own zone, to follow its DST changes.
+                zone = event["start"].get("timeZone")
+                dtstart = tag.valid_from.astimezone(gettz(zone) if zone else UTC)
+                exdates = "".join(
+                    f"\nEXDATE:{when.strftime('%Y%m%dT%H%M%SZ')}"
+                    for when in exceptions.get(event["id"], [])
                 )
-                yield Tag(
-                    name=event.get("summary", event.get("id")),
+                yield RecurringTag(
+                    name=tag.name,
                     category=category,
-                    valid_from=valid_from,
-                    valid_to=valid_to,
+                    valid_from=dtstart,
+                    valid_to=span.finish_at,
+                    recurrence="\n".join(event["recurrence"]) + exdates,
+                    duration=tag.valid_to - tag.valid_from,
                 )
 
+    @staticmethod
+    def _parse_time(when: Dict[str, str]) -> dt.datetime:
+        return date_parse(when.get("dateTime", when.get("date", None)))
+
+    def _event_tag(self, event: Dict[str, Any], category: Optional[Category]) -> Tag:
+        start = self._parse_time(event["start"]) if event.get("start") else None
+        end = self._parse_time(event["end"]) if event.get("end") else None
+        return Tag(
+            name=event.get("summary", event.get("id")),
+            category=category,
+            valid_from=start,
+            valid_to=end,
+        )
+
 
 T = TypeVar("T", bound="GoogleCalendarTimeSpan")
 
@@ -444,8 +507,26 @@ class GoogleCalendarTimeSpan(InsertableTimeSpan, RemovableTimeSpan):
     def category_pool(self) -> BaseCategoryPool:
         return self._cached_timespan.category_pool
 
-    def iter_tags(self) -> Iterable["Tag"]:
-        return self._cached_timespan.iter_tags()
+    def iter_tags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable["Tag"]:
+        return self._cached_timespan.iter_tags(order_by, after, limit)
+
+    @property
+    def fingerprint(self) -> Fingerprint:
+        return self._cached_timespan.fingerprint
+
+    def active_at(self, when: dt.datetime) -> Iterable[Tag]:
+        return self._cached_timespan.active_at(when)
+
+    def next_after(self, when: dt.datetime, n: Optional[int] = 1) -> Iterable[Tag]:
+        return self._cached_timespan.next_after(when, n)
+
+    def _run_query(self, query: Query) -> Iterable[Tag]:
+        return self._cached_timespan._run_query(query)
 
     def filter(self, category: Union["Category", str]) -> BaseTimeSpan:
         """Note: This returns a NON-NETWORKED sqlite-backed timespan. It does
@@ -466,16 +547,19 @@ class GoogleCalendarTimeSpan(InsertableTimeSpan, RemovableTimeSpan):
     def insert_tag(self, tag: Tag) -> None:
         self._cached_timespan.insert_tag(tag)  # TODO - support rollbacks?
         self.dirty_queue.append((True, tag))
+        self._notify(True, (tag,))
 
     def remove_tag(self, tag: Tag) -> bool:
         success = self._cached_timespan.remove_tag(tag)  # TODO - support rollbacks?
         self.dirty_queue.append((False, tag))
+        if success:
+            self._notify(False, (tag,))
         return success
 
     def add_event(
         self, event_name: str, when: dt.datetime, duration: dt.timedelta
     ) -> Tag:
-        start = when.astimezone(dt.timezone.utc)
+        start = when.astimezone(UTC)
         tag = Tag(
             name=event_name,
             category=self.client.base_category / self.calendar_name,
@@ -492,23 +576,37 @@ class GoogleCalendarTimeSpan(InsertableTimeSpan, RemovableTimeSpan):
     def remove_events(
         self, event_name: Optional[str] = None, during: Optional[Span] = None
     ) -> None:
+        query = self._cached_timespan.query()
         if during is not None:
-            window = self._cached_timespan.slice_with_span(during)
-        else:
-            window = self._cached_timespan
+            query = query.between(during.begins_at, during.finish_at)
+        if event_name is not None:
+            query = query.names(event_name)
 
-        for tag in window.iter_tags():
-            if event_name is None or tag.name == event_name:
-                self.remove_tag(tag)
+        for tag in list(query):
+            self.remove_tag(tag)
 
-    def flush(self):
-        """Write all pending changes to Google Calendar, and then re-sync."""
+    def flush(self, resync: bool = True):
+        """Write all pending changes to Google Calendar, and then (optionally)
+        re-sync. Changes that cancel each other out are never sent."""
         # TODO - instead of a full resync, maybe use the streaming updates API?
+        net: Dict[Tag, int] = {}
         for is_insert, event in self.dirty_queue:
-            if is_insert:
+            net[event] = net.get(event, 0) + (1 if is_insert else -1)
+        self.dirty_queue.clear()
+
+        for event, count in net.items():
+            if count < 0:
+                self.client.remove_events(tag=event, calendar_id=self.calendar_id)
+        for event, count in net.items():
+            if count > 0:
                 # TODO - grab event id? not sure how to use it...
                 self.client.create_event(tag=event, calendar_id=self.calendar_id)
-            else:
-                self.client.remove_events(tag=event, calendar_id=self.calendar_id)
-        self.dirty_queue.clear()
-        self._cached_timespan = self.client.load_timespan(self.calendar_id, self.span)
+
+        if resync:
+            previous = self._cached_timespan
+            self._cached_timespan = self.client.load_timespan(
+                self.calendar_id, self.span
+            )
+            if self._has_subscribers:
+                # Push whatever changed upstream since the last sync.
+                self._notify_diff(diff(previous, self._cached_timespan))
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+from dataclasses import replace
+import datetime as dt
+from pathlib import Path
+import re
+from typing import (
+    cast,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+)
+import warnings
+
+from dateutil.tz import gettz
+
+from ..categorypool import MutableCategoryPool
+from ..fingerprint import tag_digest
+from ..tag import Category, RecurringTag, Tag
+from ..timespan import BaseTimeSpan, SqliteTimeSpan
+from ..utils import get_now, local_timezone, normalize, UTC, zone_name
+from .records import insert_batched, stored_tags
+
+Params = Dict[str, str]
+Property = Tuple[str, Params, str]
+
+_DURATION = re.compile(
+    r"([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$"
+)
+_UNESCAPE = re.compile(r"\\([\\;,nN])")
+_RULE_LINES = ("RRULE", "EXRULE")
+_DATE_LINES = ("RDATE", "EXDATE")
+_UTC_FORMAT = "%Y%m%dT%H%M%SZ"
+# Lines are folded at 75 octets of UTF-8, counting a continuation's space
+_FOLD_OCTETS = 75
+
+
+def _unfold(lines: Iterable[str]) -> Iterator[str]:
+    """Join folded content lines back together."""
+    pending: Optional[str] = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t"):
+            pending = (pending or "") + line[1:]
+            continue
+        if pending:
+            yield pending
+        pending = line
+    if pending:
+        yield pending
+
+
+def _split_property(line: str) -> Property:
+    """Split a content line in to its name, parameters and value."""
+    in_quotes = False
+    for index, char in enumerate(line):
+        if char == '"':
+            in_quotes = not in_quotes
+        elif char == ":" and not in_quotes:
+            head, value = line[:index], line[index + 1 :]
+            break
+    else:
+        raise ValueError("Malformed content line", line)
+    name, *param_list = head.split(";")
+    params = {}
+    for param in param_list:
+        key, _, param_value = param.partition("=")
+        params[key.upper()] = param_value.strip('"')
+    return name.upper(), params, value
+
+
+def _unescape(text: str) -> str:
+    return _UNESCAPE.sub(
+        lambda m: "\n" if m.group(1) in "nN" else m.group(1), text
+    )
+
+
+def _escape(text: str) -> str:
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\n", "\\n")
+    )
+
+
+def _parse_datetime(value: str, params: Params) -> dt.datetime:
+    """Parse a DATE or DATE-TIME value. Floating times and dates are local."""
+    if params.get("VALUE") == "DATE" or "T" not in value:
+        parsed = dt.datetime.strptime(value[:8], "%Y%m%d")
+        return parsed.replace(tzinfo=local_timezone())
+    parsed = dt.datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        return parsed.replace(tzinfo=UTC)
+    zone = gettz(params["TZID"]) if "TZID" in params else None
+    return parsed.replace(tzinfo=zone or local_timezone())
+
+
+def _parse_duration(value: str) -> dt.timedelta:
+    match = _DURATION.match(value)
+    if match is None:
+        raise ValueError("Malformed duration", value)
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = dt.timedelta(
+        weeks=int(weeks or 0),
+        days=int(days or 0),
+        hours=int(hours or 0),
+        minutes=int(minutes or 0),
+        seconds=int(seconds or 0),
+    )
+    return -duration if sign == "-" else duration
+
+
+def _format_duration(duration: dt.timedelta) -> str:
+    seconds = int(duration.total_seconds())
+    days, seconds = divmod(seconds, 86400)
+    return f"P{days}DT{seconds}S"
+
+
+class _Event:
+    """The properties of one VEVENT, as they are read."""
+
+    def __init__(self) -> None:
+        self.properties: Dict[str, Property] = {}
+        self.recurrence: List[Property] = []
+
+    def add(self, prop: Property) -> None:
+        name = prop[0]
+        if name in _RULE_LINES or name in _DATE_LINES:
+            self.recurrence.append(prop)
+        else:
+            self.properties.setdefault(name, prop)
+
+    def time(self, name: str) -> Optional[dt.datetime]:
+        prop = self.properties.get(name)
+        return None if prop is None else _parse_datetime(prop[2], prop[1])
+
+    def text(self, name: str) -> Optional[str]:
+        prop = self.properties.get(name)
+        return None if prop is None else _unescape(prop[2])
+
+    @property
+    def uid(self) -> Optional[str]:
+        return self.text("UID")
+
+    @property
+    def cancelled(self) -> bool:
+        return (self.text("STATUS") or "").upper() == "CANCELLED"
+
+
+class ICSReader:
+    """Streaming reader of iCalendar data.
+
+    Content lines are read one at a time and each VEVENT is turned in to a Tag
+    as soon as it ends, so that arbitrarily large files can be read in bounded
+    memory. Only recurring events are held back until the end, so that any
+    modified or cancelled instances (events with a RECURRENCE-ID) can be
+    excluded from their rule. Those become RecurringTags, bounded by their
+    COUNT or UNTIL, or else by `horizon`.
+
+    The first CATEGORIES entry of an event is used as a "/"-separated category
+    path, under `category` if that is given. TZIDs are looked up with dateutil,
+    VTIMEZONE definitions are not read.
+    """
+
+    def __init__(
+        self,
+        category: Optional[Category] = None,
+        horizon: Optional[dt.datetime] = None,
+    ) -> None:
+        self.category = category
+        self.horizon = horizon
+        self._category_pool = MutableCategoryPool()
+
+    def read(self, lines: Iterable[str]) -> Iterator[Tag]:
+        masters: List[_Event] = []
+        exceptions: Dict[str, List[dt.datetime]] = {}
+        event: Optional[_Event] = None
+        nested = 0  # Depth of components within the event, eg. VALARMs
+        for line in _unfold(lines):
+            if not line:
+                continue
+            prop = _split_property(line)
+            name, _, value = prop
+            if name == "BEGIN" and value.upper() == "VEVENT":
+                event = _Event()
+                nested = 0
+            elif event is not None and name == "BEGIN":
+                nested += 1
+            elif event is not None and name == "END" and nested:
+                nested -= 1
+            elif nested:
+                continue  # Their properties aren't the event's
+            elif name == "END" and value.upper() == "VEVENT" and event is not None:
+                if event.recurrence:
+                    masters.append(event)
+                else:
+                    recurrence_id = event.time("RECURRENCE-ID")
+                    if recurrence_id is not None and event.uid is not None:
+                        exceptions.setdefault(event.uid, []).append(recurrence_id)
+                    tag = None if event.cancelled else self._event_tag(event)
+                    if tag is not None:
+                        yield tag
+                event = None
+            elif event is not None:
+                event.add(prop)
+
+        for event in masters:
+            if event.cancelled:
+                continue
+            tag = self._recurring_tag(event, exceptions.get(event.uid or "", []))
+            if tag is not None:
+                yield tag
+
+    def _category(self, event: _Event) -> Optional[Category]:
+        prop = event.properties.get("CATEGORIES")
+        if prop is None:
+            return self.category
+        first = re.split(r"(?<!\\),", prop[2])[0]
+        path = _unescape(first)
+        if self.category is not None:
+            path = f"{self.category.fullpath}/{path}"
+        try:
+            return self._category_pool.get_category(path, create=True)
+        except ValueError:
+            warnings.warn(f"Unusable category {path!r}, using the default instead")
+            return self.category
+
+    def _times(
+        self, event: _Event
+    ) -> Tuple[Optional[dt.datetime], Optional[dt.datetime]]:
+        start = event.time("DTSTART")
+        end = event.time("DTEND")
+        if end is None and start is not None:
+            duration = event.properties.get("DURATION")
+            if duration is not None:
+                end = start + _parse_duration(duration[2])
+            elif event.properties["DTSTART"][1].get("VALUE") == "DATE":
+                end = start + dt.timedelta(days=1)
+            else:
+                end = start
+        return start, end
+
+    def _event_tag(self, event: _Event) -> Optional[Tag]:
+        start, end = self._times(event)
+        if start is None:
+            return None
+        return Tag(
+            name=event.text("SUMMARY") or event.uid or "",
+            category=self._category(event),
+            valid_from=normalize(start),
+            valid_to=normalize(end),
+        )
+
+    def _recurring_tag(
+        self, event: _Event, exceptions: List[dt.datetime]
+    ) -> Optional[RecurringTag]:
+        start, end = self._times(event)
+        if start is None or end is None:
+            return None
+
+        # Dates are rewritten in UTC, so that rules don't depend on TZIDs
+        lines = []
+        for name, params, value in event.recurrence:
+            if name in _RULE_LINES:
+                lines.append(f"{name}:{value}")
+            else:
+                when = ",".join(
+                    _format_utc(_parse_datetime(v, params))
+                    for v in value.split(",")
+                )
+                lines.append(f"{name}:{when}")
+        lines += [f"EXDATE:{_format_utc(w)}" for w in exceptions]
+
+        bounded = all(
+            "COUNT=" in value.upper() or "UNTIL=" in value.upper()
+            for name, _, value in event.recurrence
+            if name == "RRULE"
+        )
+        tag = RecurringTag(
+            name=event.text("SUMMARY") or event.uid or "",
+            category=self._category(event),
+            valid_from=start,
+            valid_to=None if bounded else self.horizon,
+            recurrence="\n".join(lines),
+            duration=end - start,
+        )
+        try:
+            rule = tag.rule
+            last = None
+            if bounded:
+                for last in rule:
+                    pass
+        except ValueError as exc:
+            warnings.warn(f"Skipping event {event.uid} with a bad recurrence: {exc}")
+            return None
+        if bounded:
+            if last is None:
+                return None
+            tag = replace(tag, valid_to=last + tag.duration)
+        return tag
+
+
+def read_ics(
+    source: Union[Path, Iterable[str]],
+    category: Optional[Category] = None,
+    horizon: Optional[dt.datetime] = None,
+) -> Iterator[Tag]:
+    """Stream the tags of an .ics file (or any iterable of its lines)."""
+    reader = ICSReader(category, horizon)
+    if isinstance(source, Path):
+        with source.open(encoding="utf-8", newline="") as lines:
+            yield from reader.read(lines)
+    else:
+        yield from reader.read(source)
+
+
+def load_ics(
+    source: Union[Path, Iterable[str]],
+    timespan: Optional[SqliteTimeSpan] = None,
+    category: Optional[Category] = None,
+    horizon: Optional[dt.datetime] = None,
+    batch_size: int = 10_000,
+) -> SqliteTimeSpan:
+    """Bulk load an .ics file in to a (new, by default) SqliteTimeSpan.
+
+    Tags are inserted `batch_size` at a time, each batch in one transaction,
+    so neither the file nor its tags need to fit in memory at once. Stored
+    recurrences must be bounded, so pass a `horizon` for any without an end.
+    """
+    if timespan is None:
+        timespan = SqliteTimeSpan()
+    insert_batched(timespan, read_ics(source, category, horizon), batch_size)
+    return timespan
+
+
+def _format_utc(when: dt.datetime) -> str:
+    return when.astimezone(UTC).strftime(_UTC_FORMAT)
+
+
+def _format_start(when: dt.datetime) -> str:
+    zone = zone_name(when.tzinfo)
+    if zone is not None and zone != "UTC":
+        return f"DTSTART;TZID={zone}:{when.strftime('%Y%m%dT%H%M%S')}"
+    return f"DTSTART:{_format_utc(when)}"
+
+
+def _fold(line: str) -> str:
+    if len(line.encode("utf-8")) <= _FOLD_OCTETS:
+        return line
+    # Split between characters, never within one
+    chunks: List[str] = []
+    chunk = ""
+    octets = 0
+    for char in line:
+        width = len(char.encode("utf-8"))
+        if octets + width > _FOLD_OCTETS - bool(chunks):
+            chunks.append(chunk)
+            chunk = ""
+            octets = 0
+        chunk += char
+        octets += width
+    chunks.append(chunk)
+    return "\r\n ".join(chunks)
+
+
+def _event_lines(tag: Tag, stamp: str) -> Iterator[str]:
+    start = cast(dt.datetime, tag.valid_from)  # write_ics skips open starts
+    yield "BEGIN:VEVENT"
+    yield f"UID:{tag_digest(tag):032x}@hermes"
+    yield f"DTSTAMP:{stamp}"
+    if isinstance(tag, RecurringTag):
+        # Recurrences keep their zone (if it has a name), to follow its DST
+        yield _format_start(start)
+        yield f"DURATION:{_format_duration(tag.duration)}"
+        yield from tag.recurrence.splitlines()
+    else:
+        yield f"DTSTART:{_format_utc(start)}"
+        if tag.valid_to is not None:
+            yield f"DTEND:{_format_utc(tag.valid_to)}"
+    yield f"SUMMARY:{_escape(tag.name)}"
+    if tag.category is not None:
+        yield f"CATEGORIES:{_escape(tag.category.fullpath)}"
+    yield "END:VEVENT"
+
+
+def write_ics(timespan: BaseTimeSpan, stream: TextIO) -> int:
+    """Write the tags of a timespan as an iCalendar stream, one event at a time.
+
+    Tags without a `valid_from` can't be represented and are skipped. Returns
+    the number of events written. Times are only kept to the second.
+    """
+    stamp = _format_utc(get_now())
+    stream.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Hermes//Hermes//EN\r\n")
+    count = 0
+    for tag in stored_tags(timespan):
+        if tag.valid_from is None:
+            continue
+        stream.writelines(f"{_fold(line)}\r\n" for line in _event_lines(tag, stamp))
+        count += 1
+    stream.write("END:VCALENDAR\r\n")
+    return count
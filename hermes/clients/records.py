@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import csv
+import datetime as dt
+import itertools
+import json
+from typing import Any, cast, Dict, Iterable, Iterator, Optional, TextIO
+
+from dateutil.tz import gettz
+
+from ..categorypool import MutableCategoryPool
+from ..tag import RecurringTag, Tag
+from ..timespan import BaseTimeSpan, date_parse, InsertableTimeSpan, SqliteTimeSpan
+from ..utils import UTC, zone_name
+
+# Columns of the CSV format, and keys of the JSON Lines one. The last three are
+# only set for recurring tags.
+FIELDS = (
+    "valid_from",
+    "valid_to",
+    "name",
+    "category",
+    "recurrence",
+    "duration",
+    "timezone",
+)
+
+Record = Dict[str, Any]
+
+
+def stored_tags(timespan: BaseTimeSpan) -> Iterable[Tag]:
+    """The tags of a timespan as they are stored, with recurring tags kept as
+    rules where the timespan stores them that way."""
+    if isinstance(timespan, SqliteTimeSpan):
+        return itertools.chain(timespan._iter_concrete(), timespan._iter_recurring())
+    return timespan.iter_tags()
+
+
+def insert_batched(
+    timespan: InsertableTimeSpan, tags: Iterable[Tag], batch_size: int = 10_000
+) -> int:
+    """Insert tags `batch_size` at a time, so that they needn't all fit in
+    memory at once. Returns the number of tags inserted."""
+    tags = iter(tags)
+    count = 0
+    while True:
+        batch = list(itertools.islice(tags, batch_size))
+        if not batch:
+            return count
+        timespan.insert_tags(batch)
+        count += len(batch)
+
+
+def _time(when: Optional[dt.datetime]) -> Optional[str]:
+    return None if when is None else when.astimezone(UTC).isoformat()
+
+
+def to_record(tag: Tag) -> Record:
+    """A flat, JSON-compatible record of a tag. Times are written in UTC, and
+    recurring tags also keep the name of the zone their rule follows."""
+    record = {
+        "valid_from": _time(tag.valid_from),
+        "valid_to": _time(tag.valid_to),
+        "name": tag.name,
+        "category": tag.category.fullpath if tag.category else None,
+    }
+    if isinstance(tag, RecurringTag):
+        record["recurrence"] = tag.recurrence
+        record["duration"] = tag.duration.total_seconds()
+        record["timezone"] = zone_name(cast(dt.datetime, tag.valid_from).tzinfo)
+    return record
+
+
+class RecordReader:
+    """Builds tags from records, sharing categories between them."""
+
+    def __init__(self) -> None:
+        self._category_pool = MutableCategoryPool()
+
+    def tag(self, record: Record) -> Tag:
+        # Missing values may be None (JSON) or empty (CSV)
+        valid_from = record.get("valid_from") or None
+        valid_to = record.get("valid_to") or None
+        category = record.get("category") or None
+        fields = {
+            "name": record["name"],
+            "category": None
+            if category is None
+            else self._category_pool.get_category(category, create=True),
+            "valid_from": None if valid_from is None else date_parse(valid_from),
+            "valid_to": None if valid_to is None else date_parse(valid_to),
+        }
+        if record.get("recurrence"):
+            zone = record.get("timezone") or None
+            if zone is not None and fields["valid_from"] is not None:
+                fields["valid_from"] = fields["valid_from"].astimezone(gettz(zone))
+            return RecurringTag(
+                recurrence=record["recurrence"],
+                duration=dt.timedelta(seconds=float(record["duration"])),
+                **fields,
+            )
+        return Tag(**fields)
+
+
+def write_jsonl(tags: Iterable[Tag], stream: TextIO, chunk_size: int = 10_000) -> int:
+    """Write one JSON object per line, a chunk of lines per write. Returns the
+    number of tags written."""
+    tags = iter(tags)
+    count = 0
+    while True:
+        chunk = [
+            json.dumps(to_record(tag)) + "\n"
+            for tag in itertools.islice(tags, chunk_size)
+        ]
+        if not chunk:
+            return count
+        stream.write("".join(chunk))
+        count += len(chunk)
+
+
+def read_jsonl(lines: Iterable[str]) -> Iterator[Tag]:
+    reader = RecordReader()
+    for line in lines:
+        if line.strip():
+            yield reader.tag(json.loads(line))
+
+
+def write_csv(tags: Iterable[Tag], stream: TextIO, chunk_size: int = 10_000) -> int:
+    """Write a header and then one row per tag, a chunk of rows per write.
+    Returns the number of tags written."""
+    writer = csv.DictWriter(stream, FIELDS)
+    writer.writeheader()
+    tags = iter(tags)
+    count = 0
+    while True:
+        chunk = [to_record(tag) for tag in itertools.islice(tags, chunk_size)]
+        if not chunk:
+            return count
+        writer.writerows(chunk)
+        count += len(chunk)
+
+
+def read_csv(lines: Iterable[str]) -> Iterator[Tag]:
+    reader = RecordReader()
+    for row in csv.DictReader(lines):
+        yield reader.tag(row)
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import datetime as dt
+import itertools
+import json
+import mmap
+from pathlib import Path
+import struct
+import sys
+from typing import (
+    Any,
+    cast,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    Union,
+)
+
+from .categorypool import CategoryPool
+from .query import Query
+from .span import Span
+from .tag import Category, encode_data, LazyData, MetaTag, Tag
+from .timespan import (
+    _check_ordering,
+    _order_key,
+    BaseTimeSpan,
+    SqliteMetaTimeSpan,
+    TimeSpan,
+    WriteableTimeSpan,
+)
+from .utils import from_micros, to_micros
+
+if TYPE_CHECKING:  # pragma: no cover
+    # Only on Python 3.8+, so it is imported where it is used
+    from multiprocessing.shared_memory import SharedMemory
+
+# Open-ended tags are stored with these sentinels
+_INT64_MIN = -(2 ** 63)
+_INT64_MAX = 2 ** 63 - 1
+
+# magic, tag count, string table length, longest duration (or -1)
+_HEADER = struct.Struct("=8sqqq")
+_MAGIC = b"HERMESC1"
+
+
+def _to_micros(when: Optional[dt.datetime], default: int) -> int:
+    return default if when is None else to_micros(when)
+
+
+def _from_micros(micros: int) -> Optional[dt.datetime]:
+    if micros in (_INT64_MIN, _INT64_MAX):
+        return None
+    return from_micros(micros)
+
+
+def encode_columns(tags: Iterable[Tag]) -> bytes:
+    """Encode tags (recurring ones already expanded) as a columnar snapshot:
+    a header, then start, finish, name id and category id int64 columns in
+    start order, then a string table of the distinct names and categories."""
+    ordered = sorted(tags, key=_order_key)
+    starts = array("q", (_to_micros(t.valid_from, _INT64_MIN) for t in ordered))
+    finishes = array("q", (_to_micros(t.valid_to, _INT64_MAX) for t in ordered))
+    name_ids, category_ids = array("q"), array("q")
+    string_table = _dictionary_encode(ordered, name_ids, category_ids)
+    header = _HEADER.pack(
+        _MAGIC, len(ordered), len(string_table), _max_duration(starts, finishes)
+    )
+    columns = (starts, finishes, name_ids, category_ids)
+    return header + b"".join(c.tobytes() for c in columns) + string_table
+
+
+def _dictionary_encode(tags: List[Tag], name_ids: array, category_ids: array) -> bytes:
+    """Fill in the id columns, and return the string table they refer to."""
+    names: Dict[str, int] = {}
+    categories: Dict[str, int] = {}
+    for tag in tags:
+        name_ids.append(names.setdefault(tag.name, len(names)))
+        if tag.category is None:
+            category_ids.append(-1)
+        else:
+            path = tag.category.fullpath
+            category_ids.append(categories.setdefault(path, len(categories)))
+    strings = json.dumps({"names": list(names), "categories": list(categories)})
+    return strings.encode("utf-8")
+
+
+def _max_duration(starts: Sequence[int], finishes: Sequence[int]) -> int:
+    """The longest tag in microseconds, or -1 if any is open ended."""
+    longest = 0
+    for start, finish in zip(starts, finishes):
+        if start == _INT64_MIN or finish == _INT64_MAX:
+            return -1
+        longest = max(longest, finish - start)
+    return longest
+
+
+class ColumnarTimeSpan(BaseTimeSpan):
+    """Read-only timespan over a columnar snapshot (see `encode_columns`) in
+    any buffer, without copying it. Tags are only decoded as they are read,
+    and reslicing bisects the start column, so a query only touches the rows
+    (and pages) in its window. Derived timespans are plain TimeSpans."""
+
+    _starts: Sequence[int]
+    _finishes: Sequence[int]
+
+    def __init__(self, buffer: Union[bytes, bytearray, memoryview]) -> None:
+        view = memoryview(buffer)
+        magic, count, strings_len, max_duration = _HEADER.unpack_from(view)
+        if magic != _MAGIC:
+            raise ValueError("Not a columnar timespan snapshot")
+        self._count = count
+        self._max_duration = None if max_duration < 0 else max_duration
+
+        offset = _HEADER.size
+        self._views: List[memoryview] = [view]
+        columns = []
+        for _ in range(4):
+            column = view[offset : offset + 8 * count].cast("q")
+            self._views.append(column)
+            columns.append(column)
+            offset += 8 * count
+        self._starts, self._finishes, self._name_ids, self._category_ids = columns
+
+        self._load_strings(bytes(view[offset : offset + strings_len]))
+
+    def _load_strings(self, string_table: bytes) -> None:
+        strings = json.loads(string_table)
+        self._names: List[str] = strings["names"]
+        pool: Dict[str, Category] = {}
+        for path in strings["categories"]:
+            parent = None
+            for depth, name in enumerate(path.split("/")):
+                prefix = "/".join(path.split("/")[: depth + 1])
+                parent = pool.setdefault(prefix, Category(name, parent))
+        self._category_pool = CategoryPool(stored_categories=pool)
+        self._categories = [pool[path] for path in strings["categories"]]
+
+    def release(self) -> None:
+        """Drop every view on the underlying buffer, so that it can be freed."""
+        for view in reversed(self._views):
+            view.release()
+        self._views.clear()
+
+    def _tag(self, row: int) -> Tag:
+        category_id = self._category_ids[row]
+        return Tag(
+            self._names[self._name_ids[row]],
+            category=None if category_id < 0 else self._categories[category_id],
+            valid_from=_from_micros(self._starts[row]),
+            valid_to=_from_micros(self._finishes[row]),
+        )
+
+    def _rows(
+        self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
+    ) -> Iterator[int]:
+        """Rows overlapping the window, in start order."""
+        begins = _to_micros(begins_at, _INT64_MIN)
+        finish = _to_micros(finish_at, _INT64_MAX)
+        stop = bisect_right(self._starts, finish)
+        start = 0
+        if self._max_duration is not None and begins_at is not None:
+            start = bisect_left(self._starts, begins - self._max_duration)
+        return (r for r in range(start, stop) if self._finishes[r] >= begins)
+
+    @property
+    def category_pool(self) -> CategoryPool:
+        return self._category_pool
+
+    def iter_tags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable["Tag"]:
+        return (self._tag(r) for r in self._row_range(order_by, after, limit))
+
+    def _row_range(
+        self, order_by: Optional[str], after: Optional[Tag], limit: Optional[int]
+    ) -> range:
+        # Rows are stored in order, so every iteration is ordered.
+        _check_ordering(order_by, after)
+        start = 0
+        if after is not None:
+            key = _order_key(after)
+            start = bisect_left(self._starts, _to_micros(after.valid_from, _INT64_MIN))
+            while start < self._count and _order_key(self._tag(start)) <= key:
+                start += 1
+        stop = self._count if limit is None else min(self._count, start + limit)
+        return range(start, stop)
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def span(self) -> Span:
+        if not self._count:
+            raise ValueError("You must only retrieve the span of non-empty TimeSpans.")
+        return Span(_from_micros(self._starts[0]), _from_micros(max(self._finishes)))
+
+    def active_at(self, when: dt.datetime) -> Iterable[Tag]:
+        return [self._tag(r) for r in self._rows(when, when)]
+
+    def next_after(self, when: dt.datetime, n: Optional[int] = 1) -> Iterable[Tag]:
+        start = bisect_right(self._starts, _to_micros(when, _INT64_MIN))
+        stop = self._count if n is None else min(self._count, start + n)
+        return [self._tag(r) for r in range(start, stop)]
+
+    def _run_query(self, query: Query) -> Iterable[Tag]:
+        _check_ordering(query.ordering, None)
+        rows = self._rows(query.window.begins_at, query.window.finish_at)
+        tags = (self._tag(r) for r in rows)
+        return itertools.islice(filter(query.matches, tags), query.max_results)
+
+    def filter(self, category: Union["Category", str]) -> TimeSpan:
+        if isinstance(category, str):
+            category = self._category_pool.get_category(category)
+        return TimeSpan(tags={t for t in self.iter_tags() if t in category})
+
+    def reslice(
+        self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
+    ) -> TimeSpan:
+        return TimeSpan(tags={self._tag(r) for r in self._rows(begins_at, finish_at)})
+
+
+class SharedTimeSpan(ColumnarTimeSpan):
+    """A columnar snapshot of a timespan, published in shared memory.
+
+    One process calls `publish`, and any number of others `attach` to it by
+    name and query it without copying or decoding it up front. The snapshot
+    is immutable. Every process should `close` it when done, and the
+    publisher should `unlink` it once no longer needed.
+    """
+
+    def __init__(self, shared_memory: "SharedMemory") -> None:
+        self._shared_memory = shared_memory
+        super().__init__(cast(memoryview, shared_memory.buf))
+
+    @classmethod
+    def publish(
+        cls, timespan: BaseTimeSpan, name: Optional[str] = None
+    ) -> "SharedTimeSpan":
+        from multiprocessing.shared_memory import SharedMemory
+
+        data = encode_columns(timespan.iter_tags())
+        shared_memory = SharedMemory(name=name, create=True, size=len(data))
+        cast(memoryview, shared_memory.buf)[: len(data)] = data
+        return cls(shared_memory)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedTimeSpan":
+        from multiprocessing.shared_memory import SharedMemory
+
+        return cls(SharedMemory(name=name))
+
+    @property
+    def name(self) -> str:
+        return self._shared_memory.name
+
+    def close(self) -> None:
+        self.release()
+        self._shared_memory.close()
+
+    def unlink(self) -> None:
+        self._shared_memory.unlink()
+
+    def __enter__(self) -> "SharedTimeSpan":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+# magic, tag count, block count, longest duration (or -1), string table
+# length, metadata length (or -1 if there is no metadata column)
+_FILE_HEADER = struct.Struct("<8sqqqqq")
+_FILE_MAGIC = b"HERMESM1"
+
+
+def write_columnar(
+    source: Union[BaseTimeSpan, Iterable[Tag]], filename: Path, block_size: int = 256
+) -> None:
+    """Write tags to a columnar file, for `MappedTimeSpan`.
+
+    Rows are sorted by start time and cut in to blocks of `block_size`. Each
+    block's first start time is kept in an index, and the start column holds
+    only the difference from the previous row in its block. The finish column
+    holds each tag's duration. Names and categories are dictionary encoded,
+    and the data of any MetaTags is kept in a separate metadata column.
+    """
+    if filename.exists():
+        raise ValueError("File already exists", filename)
+    if isinstance(source, SqliteMetaTimeSpan):
+        # Its metatags are only the concrete tags, so expand the recurring ones
+        source = itertools.chain(
+            source.iter_metatags(), source._occurrences(source._iter_recurring())
+        )
+    elif isinstance(source, BaseTimeSpan):
+        source = getattr(source, "iter_metatags", source.iter_tags)()
+    ordered = sorted(source, key=_order_key)
+
+    starts = [_to_micros(t.valid_from, _INT64_MIN) for t in ordered]
+    finishes = [_to_micros(t.valid_to, _INT64_MAX) for t in ordered]
+    block_rows, block_starts = array("q"), array("q")
+    deltas, durations = array("q"), array("q")
+    previous = 0
+    for row, (start, finish) in enumerate(zip(starts, finishes)):
+        # Tags with no start get blocks of their own, so that no delta has to
+        # span the sentinel.
+        in_block = row - block_rows[-1] if block_rows else block_size
+        if in_block == block_size or (start == _INT64_MIN) != (previous == _INT64_MIN):
+            block_rows.append(row)
+            block_starts.append(start)
+            previous = start
+        deltas.append(start - previous)
+        previous = start
+        if finish == _INT64_MAX or start == _INT64_MIN:
+            durations.append(finish)
+        else:
+            durations.append(finish - start)
+    block_count = len(block_starts)
+    block_rows.append(len(ordered))
+
+    columns = [block_rows, block_starts, deltas, durations]
+    metadata = b""
+    has_metadata = any(isinstance(t, MetaTag) for t in ordered)
+    if has_metadata:
+        offsets, blobs = array("q", [0]), []
+        for tag in ordered:
+            if isinstance(tag, MetaTag):
+                blobs.append(encode_data(tag.data).encode("utf-8"))
+            else:
+                blobs.append(b"")
+            offsets.append(offsets[-1] + len(blobs[-1]))
+        columns.append(offsets)
+        metadata = b"".join(blobs)
+
+    name_ids, category_ids = array("i"), array("i")
+    string_table = _dictionary_encode(ordered, name_ids, category_ids)
+    columns += [name_ids, category_ids]
+    if sys.byteorder != "little":
+        for column in columns:
+            column.byteswap()
+
+    header = _FILE_HEADER.pack(
+        _FILE_MAGIC,
+        len(ordered),
+        block_count,
+        _max_duration(starts, finishes),
+        len(string_table),
+        len(metadata) if has_metadata else -1,
+    )
+    with filename.open("wb") as f:
+        f.write(header)
+        for column in columns:
+            f.write(column.tobytes())
+        f.write(string_table)
+        f.write(metadata)
+
+
+class _StartColumn(Sequence[int]):
+    """Random access to the delta-encoded start column. Whole blocks are
+    decoded at a time, and the most recent ones are kept."""
+
+    def __init__(self, timespan: "MappedTimeSpan") -> None:
+        self._timespan = timespan
+        self._decoded: "OrderedDict[int, List[int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return self._timespan._count
+
+    def _block(self, block: int) -> List[int]:
+        if block in self._decoded:
+            self._decoded.move_to_end(block)
+            return self._decoded[block]
+        ts = self._timespan
+        first, last = ts._block_rows[block], ts._block_rows[block + 1]
+        base = ts._block_starts[block]
+        starts = [base + d for d in itertools.accumulate(ts._deltas[first:last])]
+        self._decoded[block] = starts
+        if len(self._decoded) > 64:
+            self._decoded.popitem(last=False)
+        return starts
+
+    def __getitem__(self, row):  # type: ignore
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        block = bisect_right(self._timespan._block_rows, row) - 1
+        return self._block(block)[row - self._timespan._block_rows[block]]
+
+
+class _FinishColumn(Sequence[int]):
+    def __init__(self, timespan: "MappedTimeSpan") -> None:
+        self._timespan = timespan
+
+    def __len__(self) -> int:
+        return self._timespan._count
+
+    def __getitem__(self, row):  # type: ignore
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        duration = self._timespan._durations[row]
+        start = self._timespan._starts[row]
+        if duration == _INT64_MAX or start == _INT64_MIN:
+            return duration
+        return start + duration
+
+
+class MappedTimeSpan(ColumnarTimeSpan, WriteableTimeSpan):
+    """Read-only timespan over a columnar file (see `write_columnar`), opened
+    with mmap. Nothing is read up front beyond the header and string table, so
+    reslicing a large archive only touches the pages in the window."""
+
+    def __init__(self, filename: Path) -> None:
+        if sys.byteorder != "little":
+            raise NotImplementedError("Columnar files are little-endian only")
+        with filename.open("rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        header = _FILE_HEADER.unpack_from(view)
+        magic, count, block_count, max_duration, strings_len, metadata_len = header
+        if magic != _FILE_MAGIC:
+            raise ValueError("Not a columnar timespan file", filename)
+        self._count = count
+        self._max_duration = None if max_duration < 0 else max_duration
+        self._views: List[memoryview] = [view]
+        offset = _FILE_HEADER.size
+
+        def column(fmt: str, length: int) -> memoryview:
+            nonlocal offset
+            size = struct.calcsize(fmt) * length
+            result = view[offset : offset + size].cast(fmt)  # type: ignore
+            offset += size
+            self._views.append(result)
+            return result
+
+        self._block_rows = column("q", block_count + 1)
+        self._block_starts = column("q", block_count)
+        self._deltas = column("q", count)
+        self._durations = column("q", count)
+        self._metadata_offsets = column("q", count + 1) if metadata_len >= 0 else None
+        self._name_ids = column("i", count)
+        self._category_ids = column("i", count)
+        self._load_strings(bytes(column("B", strings_len)))
+        self._metadata = column("B", max(metadata_len, 0))
+
+        self._starts = _StartColumn(self)
+        self._finishes = _FinishColumn(self)
+
+    def close(self) -> None:
+        self.release()
+        self._mmap.close()
+
+    @property
+    def has_metadata(self) -> bool:
+        return self._metadata_offsets is not None
+
+    def iter_metatags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable[MetaTag]:
+        for row in self._row_range(order_by, after, limit):
+            encoded = b""
+            if self._metadata_offsets is not None:
+                start, stop = self._metadata_offsets[row : row + 2]
+                encoded = bytes(self._metadata[start:stop])
+            # The metadata is only decoded if it is used
+            yield MetaTag.from_tag(self._tag(row), data=LazyData(encoded))
+
+    def write_to(self, filename: Path) -> None:
+        tags = self.iter_metatags() if self.has_metadata else self.iter_tags()
+        write_columnar(tags, filename)
+
+    @classmethod
+    def read_from(cls, filename: Path) -> "MappedTimeSpan":
+        return cls(filename)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+from hashlib import blake2b
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .tag import RecurringTag, Tag
+
+# Digests are combined by addition, so that a tag can be removed again by
+# subtraction. That makes every node a hash of the multiset of tags under it.
+_MODULUS = 2 ** 128
+
+
+def _utc(when: Optional[dt.datetime]) -> str:
+    return "" if when is None else when.astimezone(dt.timezone.utc).isoformat()
+
+
+def tag_digest(tag: Tag) -> int:
+    """Stable 128-bit digest of a tag's times, name and category."""
+    parts = [
+        _utc(tag.valid_from),
+        _utc(tag.valid_to),
+        tag.name,
+        tag.category.fullpath if tag.category else "",
+    ]
+    if isinstance(tag, RecurringTag):
+        parts += [tag.recurrence, str(tag.duration // dt.timedelta(microseconds=1))]
+    digest = blake2b("\x1f".join(parts).encode("utf-8"), digest_size=16).digest()
+    return int.from_bytes(digest, "big")
+
+
+class _Node:
+    __slots__ = ("hash", "children")
+
+    def __init__(self) -> None:
+        self.hash = 0
+        self.children: Dict[int, "_Node"] = {}
+
+
+class Fingerprint:
+    """Per-day content hashes of a timespan, rolled up through months and years
+    in to a single root, Merkle tree style.
+
+    Tags are filed under the UTC day they start on. Adding or removing a tag
+    updates only the four nodes on its path, and comparing two fingerprints
+    only descends in to the years, months and days that differ.
+    """
+
+    def __init__(self, tags: Optional[Iterable[Tag]] = None) -> None:
+        self._root = _Node()
+        for tag in tags or ():
+            self.add(tag)
+
+    @staticmethod
+    def _path(tag: Tag) -> Tuple[int, int, int]:
+        if tag.valid_from is None:
+            day = dt.date.min
+        else:
+            day = tag.valid_from.astimezone(dt.timezone.utc).date()
+        return day.year, day.month, day.day
+
+    def _update(self, tag: Tag, sign: int) -> None:
+        delta = sign * tag_digest(tag)
+        path = self._path(tag)
+        nodes = [self._root]
+        for key in path:
+            nodes.append(nodes[-1].children.setdefault(key, _Node()))
+        for node in nodes:
+            node.hash = (node.hash + delta) % _MODULUS
+
+        # Prune emptied nodes, so that equal content means equal structure.
+        for parent, key, child in zip(nodes, path, nodes[1:]):
+            if child.hash == 0:
+                del parent.children[key]
+                break
+
+    def add(self, tag: Tag) -> None:
+        self._update(tag, 1)
+
+    def remove(self, tag: Tag) -> None:
+        self._update(tag, -1)
+
+    @property
+    def root(self) -> int:
+        return self._root.hash
+
+    def day(self, date: dt.date) -> int:
+        node: Optional[_Node] = self._root
+        for key in (date.year, date.month, date.day):
+            node = node.children.get(key) if node is not None else None
+        return 0 if node is None else node.hash
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Fingerprint):
+            return NotImplemented
+        return self.root == other.root
+
+    def differing_days(self, other: "Fingerprint") -> List[dt.date]:
+        """The days whose tags differ between the two fingerprints, in order."""
+        days: List[dt.date] = []
+        self._descend(self._root, other._root, (), days)
+        return days
+
+    @classmethod
+    def _descend(
+        cls, left: _Node, right: _Node, path: Tuple[int, ...], days: List[dt.date]
+    ) -> None:
+        if left.hash == right.hash:
+            return
+        if len(path) == 3:
+            days.append(dt.date(*path))
+            return
+        empty = _Node()
+        for key in sorted(set(left.children) | set(right.children)):
+            cls._descend(
+                left.children.get(key, empty),
+                right.children.get(key, empty),
+                path + (key,),
+                days,
+            )
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+from pathlib import Path
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import apsw
+
+from .categorypool import MutableCategoryPool
+from .span import Span
+from .tag import Tag
+from .timespan import (
+    _RECURRING_COLUMNS,
+    _sql_time,
+    ConcurrentSqliteTimeSpan,
+    SqliteTimeSpan,
+)
+from .utils import from_micros
+
+_ALIAS = re.compile(r"[A-Za-z_][A-Za-z0-9_]*$")
+_TAG_COLUMNS = "valid_from, valid_to, name, category"
+
+# (alias, tag) from one store, overlapping (alias, tag) from another
+Conflict = Tuple[str, Tag, str, Tag]
+
+
+class MultiStore:
+    """Several SqliteTimeSpans attached to one SQLite connection, so that
+    queries across all of them run as single SQL statements.
+
+    File-backed stores (a path written by `write_to`, a ConcurrentSqliteTimeSpan
+    or a spilled SqliteTimeSpan) are attached as they are, and read live. In-memory
+    stores are copied in whole, with SQLite's serialize/deserialize, so later
+    changes to them aren't seen.
+
+    Only concrete tags with both ends take part in the joins. Recurring tags
+    are carried over by `combine`, but not expanded by the other queries.
+    """
+
+    def __init__(self, **stores: Union[SqliteTimeSpan, Path]) -> None:
+        self._conn = apsw.Connection(":memory:")
+        # Either the path of a file, or the serialized database
+        self._sources: Dict[str, Union[Path, bytes]] = {}
+        self._category_pool = MutableCategoryPool()
+        for alias, store in stores.items():
+            self.attach(alias, store)
+
+    @property
+    def aliases(self) -> List[str]:
+        return list(self._sources)
+
+    def attach(self, alias: str, store: Union[SqliteTimeSpan, Path]) -> None:
+        if not _ALIAS.match(alias) or alias.lower() in ("main", "temp"):
+            raise ValueError("Store aliases must be plain SQL identifiers", alias)
+        if alias in self._sources:
+            raise ValueError("A store is already attached as", alias)
+
+        source: Union[Path, bytes]
+        if isinstance(store, Path):
+            if not store.is_file():
+                raise ValueError("No such store", store)
+            source = store
+        elif isinstance(store, ConcurrentSqliteTimeSpan):
+            source = store._path
+        elif store._spill_path is not None:
+            source = store._spill_path
+        else:
+            source = store._sqlite_db.serialize("main")
+        _attach(self._conn, alias, source)
+        try:
+            self._check_current(alias)
+        except ValueError:
+            self._conn.execute(f'DETACH DATABASE "{alias}"')
+            raise
+        self._sources[alias] = source
+
+    def _check_current(self, alias: str) -> None:
+        """Files from older versions store times as ISO strings and recurring
+        tags without their zone, which `read_from` migrates but SQL over the
+        file as it is would get wrong."""
+        # Strings sort after numbers, so any stored time that is one is the max
+        (latest,) = list(
+            self._conn.execute(f'SELECT max(valid_from) FROM "{alias}".tags')
+        )[0]
+        columns = {
+            row[1]
+            for row in self._conn.execute(f'PRAGMA "{alias}".table_info(recurring)')
+        }
+        if isinstance(latest, str) or (columns and "timezone" not in columns):
+            raise ValueError(
+                "This store is from an older version of hermes. Read it with"
+                " SqliteTimeSpan.read_from and write it out again to upgrade it",
+                alias,
+            )
+
+    def detach(self, alias: str) -> None:
+        self._conn.execute(f'DETACH DATABASE "{alias}"')
+        del self._sources[alias]
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self) -> "MultiStore":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def _tag(self, row: Any) -> Tag:
+        return Tag(
+            valid_from=from_micros(row[0]),
+            valid_to=from_micros(row[1]),
+            name=row[2],
+            category=self._category_pool.get_category(row[3], create=True),
+        )
+
+    def _max_duration(self, alias: str) -> Optional[int]:
+        rows = self._conn.execute(
+            f'SELECT max(valid_to - valid_from) FROM "{alias}".tags'
+        )
+        return list(rows)[0][0]
+
+    def _overlap_select(
+        self, left: str, right: str, params: Dict[str, Any], i: int
+    ) -> str:
+        """One SELECT of the bounded tags of `left` overlapping those of
+        `right`. Bounding the start of the right-hand tags lets SQLite scan
+        tags_idx over a range, rather than the whole table."""
+        join = "y.valid_from < x.valid_to AND y.valid_to > x.valid_from"
+        longest = self._max_duration(right)
+        if longest is not None:
+            join += f" AND y.valid_from > x.valid_from - :longest{i}"
+            params[f"longest{i}"] = longest
+        return f"""
+            SELECT '{left}', x.valid_from, x.valid_to, x.name, x.category,
+                   '{right}', y.valid_from, y.valid_to, y.name, y.category
+            FROM "{left}".tags AS x JOIN "{right}".tags AS y ON {join}
+            WHERE x.valid_from IS NOT NULL AND x.valid_to IS NOT NULL
+        """
+
+    def _conflicts(self, pairs: List[Tuple[str, str]]) -> Iterator[Conflict]:
+        params: Dict[str, Any] = {}
+        selects = [
+            self._overlap_select(left, right, params, i)
+            for i, (left, right) in enumerate(pairs)
+        ]
+        query = " UNION ALL ".join(selects) + " ORDER BY 2, 3, 4, 7, 8, 9"
+        for row in self._conn.execute(query, params):
+            yield row[0], self._tag(row[1:5]), row[5], self._tag(row[6:10])
+
+    def overlaps(self, left: str, right: str) -> Iterator[Tuple[Tag, Tag]]:
+        """Every pair of a tag in `left` and a tag in `right` that overlap
+        (touching isn't overlapping), in order of the left tags."""
+        for _, left_tag, _, right_tag in self._conflicts([(left, right)]):
+            yield left_tag, right_tag
+
+    def conflicts(self) -> Iterator[Conflict]:
+        """Overlapping tags in different stores, eg. double bookings across
+        calendars, as (alias, tag, other alias, other tag)."""
+        aliases = sorted(self._sources)
+        pairs = [
+            (left, right)
+            for i, left in enumerate(aliases)
+            for right in aliases[i + 1 :]
+        ]
+        if not pairs:
+            return iter(())
+        return self._conflicts(pairs)
+
+    def tabulate(
+        self, within: Optional[Span] = None
+    ) -> Dict[str, Dict[str, dt.timedelta]]:
+        """Total time of the tags of each store, by category. Tags are clipped
+        to `within`, and tags with an open end are only counted when `within`
+        closes it."""
+        begins_at = None if within is None else within.begins_at
+        finish_at = None if within is None else within.finish_at
+        params = {"begins_at": _sql_time(begins_at), "finish_at": _sql_time(finish_at)}
+        selects = [
+            f"""
+            SELECT '{alias}', category, sum(
+                min(coalesce(valid_to, :finish_at), coalesce(:finish_at, valid_to))
+                - max(
+                    coalesce(valid_from, :begins_at),
+                    coalesce(:begins_at, valid_from)
+                )
+            )
+            FROM "{alias}".tags
+            WHERE (:finish_at IS NULL OR valid_from IS NULL OR valid_from < :finish_at)
+            AND (:begins_at IS NULL OR valid_to IS NULL OR valid_to > :begins_at)
+            GROUP BY category
+            """
+            for alias in sorted(self._sources)
+        ]
+        totals: Dict[str, Dict[str, dt.timedelta]] = {
+            alias: {} for alias in self._sources
+        }
+        if not selects:
+            return totals
+        for alias, category, micros in self._conn.execute(
+            " UNION ALL ".join(selects), params
+        ):
+            if micros is not None:
+                totals[alias][category] = dt.timedelta(microseconds=micros)
+        return totals
+
+    def combine(self) -> SqliteTimeSpan:
+        """All of the attached stores in one new SqliteTimeSpan, copied over in
+        SQL. Tags (and recurring tags) found in more than one store are kept
+        once."""
+        combined = SqliteTimeSpan()
+        conn = combined._sqlite_db
+        for alias, source in self._sources.items():
+            _attach(conn, alias, source)
+        try:
+            with conn:
+                for alias in self._sources:
+                    conn.execute(
+                        f"""
+                        INSERT OR IGNORE INTO main.tags ({_TAG_COLUMNS})
+                        SELECT {_TAG_COLUMNS} FROM "{alias}".tags
+                        """
+                    )
+                    # Files from before recurring tags were supported lack these
+                    if conn.execute(
+                        f"""SELECT 1 FROM "{alias}".sqlite_master
+                        WHERE name = 'recurring'"""
+                    ).fetchall():
+                        conn.execute(
+                            f"""
+                            INSERT INTO main.recurring ({_RECURRING_COLUMNS})
+                            SELECT {_RECURRING_COLUMNS} FROM "{alias}".recurring
+                            EXCEPT SELECT {_RECURRING_COLUMNS} FROM main.recurring
+                            """
+                        )
+        finally:
+            for alias in self._sources:
+                conn.execute(f'DETACH DATABASE "{alias}"')
+        for (category,) in conn.execute("SELECT DISTINCT category FROM tags"):
+            combined._category_pool.get_category(category, create=True)
+        combined._measure_max_duration()
+        combined._rebuild_fingerprint()
+        return combined
+
+
+def _attach(conn: apsw.Connection, alias: str, source: Union[Path, bytes]) -> None:
+    if isinstance(source, Path):
+        conn.execute(f'ATTACH DATABASE ? AS "{alias}"', (str(source),))
+    else:
+        conn.execute(f"ATTACH DATABASE ':memory:' AS \"{alias}\"")
+        conn.deserialize(alias, source)
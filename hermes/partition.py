@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import heapq
+import itertools
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .categorypool import BaseCategoryPool, CategoryPool
+from .query import Query
+from .span import Span
+from .tag import Category, Tag
+from .timespan import (
+    _MAX_TIME,
+    _MIN_TIME,
+    _order_key,
+    BaseTimeSpan,
+    InsertableTimeSpan,
+    RemovableTimeSpan,
+    SqliteTimeSpan,
+    WriteableTimeSpan,
+)
+
+PartitionKey = Callable[[dt.datetime], str]
+
+# Partition for tags with no start time
+UNBOUNDED = "unbounded"
+
+
+def monthly(when: dt.datetime) -> str:
+    return when.astimezone(dt.timezone.utc).strftime("%Y-%m")
+
+
+def yearly(when: dt.datetime) -> str:
+    return when.astimezone(dt.timezone.utc).strftime("%Y")
+
+
+class PartitionedTimeSpan(InsertableTimeSpan, RemovableTimeSpan, WriteableTimeSpan):
+    """A timespan sharded in to one SqliteTimeSpan per period.
+
+    Tags are routed by the period their `valid_from` falls in, monthly unless
+    another `partition_key` is given. The bounds of every partition are kept,
+    so that queries only touch the partitions overlapping their window. Old
+    partitions can be compacted and frozen, after which they are read-only,
+    and `write_to` stores each partition in its own file.
+    """
+
+    def __init__(
+        self, tags: Optional[Iterable[Tag]] = None, partition_key: PartitionKey = monthly
+    ) -> None:
+        self._partition_key = partition_key
+        self._partitions: Dict[str, SqliteTimeSpan] = {}
+        self._bounds: Dict[str, Tuple[dt.datetime, dt.datetime]] = {}
+        self._frozen: Set[str] = set()
+        if tags is not None:
+            self.insert_tags(tags)
+
+    def _key(self, tag: Tag) -> str:
+        if tag.valid_from is None:
+            return UNBOUNDED
+        return self._partition_key(tag.valid_from)
+
+    @property
+    def partitions(self) -> Dict[str, SqliteTimeSpan]:
+        return dict(self._partitions)
+
+    @property
+    def frozen(self) -> Set[str]:
+        return set(self._frozen)
+
+    def _pruned(
+        self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
+    ) -> List[str]:
+        """Keys of the partitions that could hold tags overlapping the window."""
+        begins_at = begins_at or _MIN_TIME
+        finish_at = finish_at or _MAX_TIME
+        return [
+            key
+            for key, (earliest, latest) in sorted(self._bounds.items())
+            if earliest <= finish_at and latest >= begins_at
+        ]
+
+    def _widen(self, key: str, tag: Tag) -> None:
+        earliest, latest = self._bounds.get(key, (_MAX_TIME, _MIN_TIME))
+        self._bounds[key] = (
+            min(earliest, tag.valid_from or _MIN_TIME),
+            max(latest, tag.valid_to or _MAX_TIME),
+        )
+
+    def _writable(self, key: str) -> SqliteTimeSpan:
+        if key in self._frozen:
+            raise ValueError("Partition is frozen", key)
+        if key not in self._partitions:
+            self._partitions[key] = SqliteTimeSpan()
+        return self._partitions[key]
+
+    def insert_tag(self, tag: Tag) -> None:
+        self.insert_tags((tag,))
+
+    def insert_tags(self, tags: Iterable[Tag]) -> None:
+        routed: Dict[str, List[Tag]] = {}
+        for tag in tags:
+            routed.setdefault(self._key(tag), []).append(tag)
+        for key, batch in routed.items():
+            self._writable(key).insert_tags(batch)
+            for tag in batch:
+                self._widen(key, tag)
+            self._notify(True, batch)
+
+    def remove_tag(self, tag: Tag) -> bool:
+        # Bounds are left as they are. They only need to be conservative.
+        key = self._key(tag)
+        if key not in self._partitions:
+            return False
+        found = self._writable(key).remove_tag(tag)
+        if found:
+            self._notify(False, (tag,))
+        return found
+
+    def freeze(
+        self,
+        before: dt.datetime,
+        gap_tolerance: dt.timedelta = dt.timedelta(0),
+        archive_before: Optional[dt.datetime] = None,
+    ) -> List[str]:
+        """Compact every partition whose tags all finished before `before`, and
+        make it read-only. Returns the keys of the newly frozen partitions."""
+        frozen = []
+        for key, (_, latest) in sorted(self._bounds.items()):
+            if key in self._frozen or latest >= before:
+                continue
+            self._partitions[key].compact(gap_tolerance, archive_before)
+            self._frozen.add(key)
+            frozen.append(key)
+        return frozen
+
+    @property
+    def category_pool(self) -> BaseCategoryPool:
+        return CategoryPool(
+            stored_categories={
+                path: category
+                for partition in self._partitions.values()
+                for path, category in partition.category_pool.categories.items()
+            }
+        )
+
+    def iter_tags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable["Tag"]:
+        partitions = [self._partitions[key] for key in sorted(self._partitions)]
+        tags: Iterable[Tag]
+        if order_by is None:
+            tags = itertools.chain.from_iterable(
+                p.iter_tags(None, after, limit) for p in partitions
+            )
+        else:
+            # Recurring tags can spill past their own partition, so merge
+            tags = heapq.merge(
+                *(p.iter_tags(order_by, after, limit) for p in partitions),
+                key=_order_key,
+            )
+        return itertools.islice(tags, limit)
+
+    def _run_query(self, query: Query) -> Iterable[Tag]:
+        window = query.window
+        pruned = self._pruned(window.begins_at, window.finish_at)
+        results = [self._partitions[key]._run_query(query) for key in pruned]
+        tags: Iterable[Tag]
+        if query.ordering is None:
+            tags = itertools.chain.from_iterable(results)
+        else:
+            tags = heapq.merge(*results, key=_order_key)
+        return itertools.islice(tags, query.max_results)
+
+    def active_at(self, when: dt.datetime) -> Iterable[Tag]:
+        pruned = self._pruned(when, when)
+        active = (self._partitions[key].active_at(when) for key in pruned)
+        return list(heapq.merge(*active, key=_order_key))
+
+    def next_after(self, when: dt.datetime, n: Optional[int] = 1) -> Iterable[Tag]:
+        pruned = self._pruned(when, None)
+        upcoming = (self._partitions[key].next_after(when, n) for key in pruned)
+        return list(itertools.islice(heapq.merge(*upcoming, key=_order_key), n))
+
+    def has_tag(self, tag: Tag) -> bool:
+        partition = self._partitions.get(self._key(tag))
+        return partition is not None and partition.has_tag(tag)
+
+    def __len__(self) -> int:
+        return sum(len(p) for p in self._partitions.values())
+
+    @property
+    def span(self) -> Span:
+        if not self._bounds:
+            raise ValueError("You must only retrieve the span of non-empty TimeSpans.")
+        earliest = min(begins_at for begins_at, _ in self._bounds.values())
+        latest = max(finish_at for _, finish_at in self._bounds.values())
+        return Span(
+            None if earliest == _MIN_TIME else earliest,
+            None if latest == _MAX_TIME else latest,
+        )
+
+    def _derive(
+        self,
+        transform: Callable[[SqliteTimeSpan], BaseTimeSpan],
+        keys: Optional[Iterable[str]] = None,
+    ) -> "PartitionedTimeSpan":
+        derived = PartitionedTimeSpan(partition_key=self._partition_key)
+        for key in self._partitions if keys is None else keys:
+            tags = list(transform(self._partitions[key]).iter_tags())
+            if tags:
+                derived._partitions[key] = SqliteTimeSpan(tags)
+                for tag in tags:
+                    derived._widen(key, tag)
+        return derived
+
+    def filter(self, category: Union["Category", str]) -> "PartitionedTimeSpan":
+        if isinstance(category, str):
+            category = self.category_pool.get_category(category)
+        return self._derive(lambda partition: partition.filter(category))
+
+    def reslice(
+        self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
+    ) -> "PartitionedTimeSpan":
+        return self._derive(
+            lambda partition: partition.reslice(begins_at, finish_at),
+            self._pruned(begins_at, finish_at),
+        )
+
+    def write_to(self, filename: Path) -> None:
+        """Write each partition to its own file in the directory `filename`.
+        Frozen partitions are marked as such in their file names, and empty
+        ones are skipped."""
+        filename.mkdir(parents=True, exist_ok=True)
+        for key, partition in self._partitions.items():
+            if not len(partition):
+                continue
+            suffix = ".frozen.sqlite" if key in self._frozen else ".sqlite"
+            partition.write_to(filename / f"{key}{suffix}")
+
+    @classmethod
+    def read_from(
+        cls, filename: Path, partition_key: PartitionKey = monthly
+    ) -> "PartitionedTimeSpan":
+        timespan = cls(partition_key=partition_key)
+        for path in sorted(filename.glob("*.sqlite")):
+            key, _, marker = path.name[: -len(".sqlite")].partition(".")
+            partition = SqliteTimeSpan.read_from(path)
+            timespan._partitions[key] = partition
+            if marker == "frozen":
+                timespan._frozen.add(key)
+            # The stored span skips NULLs, so widen it for unbounded tags
+            span = partition.span
+            unbounded = partition._max_duration is None
+            timespan._bounds[key] = (
+                _MIN_TIME if key == UNBOUNDED else span.begins_at or _MIN_TIME,
+                _MAX_TIME if unbounded else span.finish_at or _MAX_TIME,
+            )
+        return timespan
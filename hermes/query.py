@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from dataclasses import dataclass, replace
+import datetime as dt
+from typing import FrozenSet, Iterator, Optional, Tuple, TYPE_CHECKING, Union
+
+from .span import Span
+from .tag import Category, Tag
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .timespan import BaseTimeSpan
+
+
+def _is_within(category: Category, ancestor: Category) -> bool:
+    node: Optional[Category] = category
+    while node is not None:
+        if node == ancestor:
+            return True
+        node = node.parent
+    return False
+
+
+@dataclass(frozen=True)
+class Query:
+    """A lazy, composable query over a timespan.
+
+    Each builder method returns a new query and nothing is read until the query
+    is iterated. The chain is simplified as it is built (windows intersect,
+    name sets intersect, nested categories collapse to the innermost one), and
+    then handed to the timespan to run in a single pass. `between` selects the
+    tags that overlap the window, like `reslice` does.
+    """
+
+    source: "BaseTimeSpan"
+    categories: Tuple[Category, ...] = ()
+    window: Span = Span(None, None)
+    name_set: Optional[FrozenSet[str]] = None
+    ordering: Optional[str] = None
+    max_results: Optional[int] = None
+
+    def category(self, category: Union[Category, str]) -> "Query":
+        if isinstance(category, str):
+            category = self.source.category_pool.get_category(category)
+        if any(_is_within(c, category) for c in self.categories):
+            return self
+        kept = tuple(c for c in self.categories if not _is_within(category, c))
+        return replace(self, categories=kept + (category,))
+
+    def between(
+        self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
+    ) -> "Query":
+        if self.window.begins_at is not None:
+            begins_at = (
+                self.window.begins_at
+                if begins_at is None
+                else max(begins_at, self.window.begins_at)
+            )
+        if self.window.finish_at is not None:
+            finish_at = (
+                self.window.finish_at
+                if finish_at is None
+                else min(finish_at, self.window.finish_at)
+            )
+        return replace(self, window=Span(begins_at, finish_at))
+
+    def names(self, *names: str) -> "Query":
+        name_set = frozenset(names)
+        if self.name_set is not None:
+            name_set &= self.name_set
+        return replace(self, name_set=name_set)
+
+    def order_by(self, ordering: Optional[str]) -> "Query":
+        return replace(self, ordering=ordering)
+
+    def limit(self, n: int) -> "Query":
+        if self.max_results is not None:
+            n = min(n, self.max_results)
+        return replace(self, max_results=n)
+
+    @property
+    def is_empty(self) -> bool:
+        """True if the query can be seen to match nothing without running it."""
+        begins_at, finish_at = self.window.begins_at, self.window.finish_at
+        return (
+            self.max_results == 0
+            or self.name_set is not None
+            and not self.name_set
+            or begins_at is not None
+            and finish_at is not None
+            and begins_at > finish_at
+            or len(self.categories) > 1  # Disjoint, as nested ones were merged
+        )
+
+    def matches(self, tag: Tag) -> bool:
+        if self.name_set is not None and tag.name not in self.name_set:
+            return False
+        if not all(tag in category for category in self.categories):
+            return False
+        return tag in self.window
+
+    def __iter__(self) -> Iterator[Tag]:
+        if self.is_empty:
+            return iter(())
+        return iter(self.source._run_query(self))
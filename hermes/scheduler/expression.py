@@ -6,6 +6,8 @@ from typing import Any, Optional, Union, cast
 
 from ortools.sat.python import cp_model
 
+from ..utils import MICROS_PER_SECOND, to_micros
+
 
 def _special(message):
     """Denotes a special action that must be handled outside of the usual flow."""
@@ -78,12 +80,12 @@ class Expression:
 
     def after(self, other: Union["Expression", datetime]) -> "Expression":
         if isinstance(other, datetime):
-            other = Constant(int(other.timestamp()))
+            other = Constant(to_micros(other) // MICROS_PER_SECOND)
         return Expression(Action.GREATER_THAN, self, other)
 
     def before(self, other: Union["Expression", datetime]) -> "Expression":
         if isinstance(other, datetime):
-            other = Constant(int(other.timestamp()))
+            other = Constant(to_micros(other) // MICROS_PER_SECOND)
         return Expression(Action.LESS_THAN, self, other)
 
     def and_(self, other: Union["Expression", bool]) -> "Expression":
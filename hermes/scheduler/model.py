@@ -3,13 +3,13 @@ import datetime as dt
 from typing import Optional, Iterable
 
 from ortools.sat.python import cp_model
-import pytz
 
 from .expression import Variable
 from .schedule import Event, Schedule
 from ..tag import Tag
 from ..span import FiniteSpan
 from ..timespan import SqliteTimeSpan, BaseTimeSpan
+from ..utils import from_micros, MICROS_PER_SECOND, to_micros
 
 
 class Solution:
@@ -21,12 +21,10 @@ class Solution:
         if not is_present:
             return None
 
-        start = dt.datetime.fromtimestamp(
-            self._solver.Value(event.start_time._var), pytz.utc
-        )
-        stop = dt.datetime.fromtimestamp(
-            self._solver.Value(event.stop_time._var), pytz.utc
+        start = from_micros(
+            self._solver.Value(event.start_time._var) * MICROS_PER_SECOND
         )
+        stop = from_micros(self._solver.Value(event.stop_time._var) * MICROS_PER_SECOND)
         # TODO - category?
         return Tag(name=event.name, valid_from=start, valid_to=stop)
 
@@ -145,8 +143,8 @@ class Model:
     def make_var(
         self, model: cp_model.CpModel, var: "Variable", span: FiniteSpan
     ) -> None:
-        lb = int(span.begins_at.timestamp())
-        ub = int(span.finish_at.timestamp())
+        lb = to_micros(span.begins_at) // MICROS_PER_SECOND
+        ub = to_micros(span.finish_at) // MICROS_PER_SECOND
         variable = model.NewIntVar(lb, ub, var.name)
         var.bind(variable)
 
@@ -5,7 +5,7 @@ from typing import Iterable, List, Any
 from .expression import Variable, Expression
 from ..span import FiniteSpan
 from ..tag import Tag  # , Category
-from ..timespan import TimeSpan
+from ..timespan import CachedTimeSpan, TimeSpan
 
 
 DEFAULT_EVENT_DURATION = dt.timedelta(minutes=30)
@@ -141,7 +141,8 @@ class Schedule:
             context = TimeSpan(set())
 
         # category = Category("Hermes", None) / name
-        self._context = context.filter(name)
+        # events() reslices the context once per scheduling window, repeatedly
+        self._context = CachedTimeSpan(context.filter(name))
         self._name = name
         self._schedule_items: List[ScheduleItem] = []
 
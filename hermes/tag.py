@@ -1,11 +1,29 @@
 # -*- coding: utf-8 -*-
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 import datetime as dt
+from functools import lru_cache
+import os
 import re
-from typing import Any, MutableMapping, Optional, Type, TypeVar
-from uuid import uuid4 as uuid
+import secrets
+import threading
+import time
+from typing import (
+    Any,
+    cast,
+    Dict,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Type,
+    TypeVar,
+    Union,
+)
+
+from dateutil.rrule import rruleset, rrulestr
 
 from .span import Span, Spannable
+from .utils import json_dumps, json_loads
 
 
 @dataclass(frozen=True)
@@ -53,9 +71,7 @@ class Tag(Spannable):
 
     @property
     def span(self) -> "Span":
-        return Span(
-            self.valid_from or dt.datetime.max, self.valid_to or dt.datetime.max
-        )
+        return Span(self.valid_from, self.valid_to)
 
     def recategorize(self: _TagT, category: Category) -> _TagT:
         return type(self)(self.name, category, self.valid_from, self.valid_to)
@@ -79,6 +95,123 @@ class Tag(Spannable):
         )
 
 
+@lru_cache(maxsize=256)
+def _parse_recurrence(recurrence: str, dtstart: dt.datetime, zone: int) -> rruleset:
+    # Aware datetimes compare equal across zones, but a rule expands in the
+    # zone of its dtstart, so `zone` (the id of dtstart's tzinfo, which the
+    # cached dtstart keeps alive) is part of the key.
+    return rrulestr(recurrence, dtstart=dtstart, forceset=True, cache=True)
+
+
+@dataclass(frozen=True)
+class RecurringTag(Tag):
+    """A tag that repeats, stored once and expanded only on demand.
+
+    `recurrence` holds RFC 5545 RRULE/RDATE/EXRULE/EXDATE lines, as found in
+    iCalendar and Google Calendar data. `valid_from` is the start of the first
+    occurrence and `valid_to`, if set, bounds the finish of the last one. Each
+    occurrence lasts `duration`. Like dateutil's rrule, occurrences only have
+    one second resolution.
+    """
+
+    recurrence: str = ""
+    duration: dt.timedelta = dt.timedelta(0)
+
+    def __post_init__(self):
+        if self.valid_from is None:
+            raise ValueError("Recurring tags must have a first occurrence")
+
+    @property
+    def rule(self) -> rruleset:
+        dtstart = cast(dt.datetime, self.valid_from)
+        return _parse_recurrence(self.recurrence, dtstart, id(dtstart.tzinfo))
+
+    def recategorize(self, category: Category) -> "RecurringTag":
+        return replace(self, category=category)
+
+    def occurrences(
+        self,
+        begins_at: Optional[dt.datetime] = None,
+        finish_at: Optional[dt.datetime] = None,
+    ) -> Iterator[Tag]:
+        """Yield each occurrence that overlaps the given window, as a plain Tag.
+
+        Either end of the window may be None, but the recurrence must then be
+        bounded by `valid_to` on that side."""
+        # rrule only has second resolution, and drops any microseconds.
+        first = cast(dt.datetime, self.valid_from).replace(microsecond=0)
+        if begins_at is not None:
+            first = max(first, begins_at - self.duration)
+
+        last = None if self.valid_to is None else self.valid_to - self.duration
+        if finish_at is not None:
+            last = finish_at if last is None else min(last, finish_at)
+        if last is None:
+            raise ValueError("Unbounded recurrences can only be expanded in a window")
+
+        for start in self.rule.xafter(first, inc=True):
+            if start > last:
+                break
+            yield Tag(
+                name=self.name,
+                category=self.category,
+                valid_from=start,
+                valid_to=start + self.duration,
+            )
+
+
+class LazyData(MutableMapping[str, Any]):
+    """Metadata kept as the JSON it was stored as, until it is first used.
+
+    Stores read many more tags than callers look at the data of, so this
+    saves decoding it at all in most cases, and re-encoding it when it is
+    copied between stores unchanged.
+    """
+
+    __slots__ = ("_encoded", "_data")
+
+    def __init__(self, encoded: Union[str, bytes]) -> None:
+        self._encoded = encoded
+        self._data: Optional[Dict[str, Any]] = None
+
+    @property
+    def decoded(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = json_loads(self._encoded) if self._encoded else {}
+        return self._data
+
+    def __getitem__(self, key: str) -> Any:
+        return self.decoded[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.decoded[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self.decoded[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.decoded)
+
+    def __len__(self) -> int:
+        return len(self.decoded)
+
+    def __repr__(self) -> str:
+        return repr(self.decoded)
+
+    def copy(self) -> MutableMapping[str, Any]:
+        if self._data is None:
+            return LazyData(self._encoded)
+        return dict(self._data)
+
+
+def encode_data(data: MutableMapping[str, Any]) -> str:
+    """JSON for some metadata, reusing what it was decoded from if possible."""
+    if isinstance(data, LazyData) and data._data is None:
+        encoded = data._encoded
+        return encoded if isinstance(encoded, str) else encoded.decode("utf-8")
+    return json_dumps(dict(data))
+
+
 _MTagT = TypeVar("_MTagT", bound="MetaTag")
 
 
@@ -96,7 +229,10 @@ class MetaTag(Tag):
         merge_data: bool = True,
     ) -> _MTagT:
         if merge_data and isinstance(tag, MetaTag):
-            data = {**tag.data, **data}
+            if not data and isinstance(tag.data, LazyData):
+                data = tag.data.copy()  # Without decoding it
+            else:
+                data = {**tag.data, **data}
 
         return cls(
             name=tag.name,
@@ -107,12 +243,82 @@ class MetaTag(Tag):
         )
 
 
+class IDAllocator:
+    """Hands out unique, time-ordered 128-bit ids, as fixed width hex strings.
+
+    Much like a ULID, the top 48 bits of an id are the millisecond it was
+    allocated in. The next `SEQUENCE_BITS` count within that millisecond,
+    borrowing from the next one if need be, and the low `NODE_BITS` are chosen
+    at random for each process, so that processes allocating at once (or a
+    forked child carrying on its parent's batch) don't collide. Ids are
+    reserved a batch at a time, so that allocating several in the same
+    millisecond is usually just taking the next number. Within a process they
+    are in the order allocated.
+    """
+
+    SEQUENCE_BITS = 22
+    NODE_BITS = 58
+
+    def __init__(self, batch_size: int = 1024) -> None:
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._last = 0
+        self._batch: Iterator[int] = iter(())
+        self._batch_ms = 0
+        self._pid = 0
+        self._node = 0
+
+    def _check_node(self) -> None:
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._node = secrets.randbits(self.NODE_BITS)
+
+    def _reserve(self, n: int, now_ms: int) -> range:
+        first = max(self._last + 1, now_ms << self.SEQUENCE_BITS)
+        self._last = first + n - 1
+        return range(first, first + n)
+
+    def _format(self, i: int) -> str:
+        return f"{i << self.NODE_BITS | self._node:032x}"
+
+    def allocate(self, n: int) -> List[str]:
+        """Allocate `n` consecutive ids at once."""
+        with self._lock:
+            self._check_node()
+            # Past the rest of the batch, which is dropped to keep ids in order
+            self._batch = iter(())
+            ids = self._reserve(n, time.time_ns() // 1_000_000)
+            return [self._format(i) for i in ids]
+
+    def next_id(self) -> str:
+        with self._lock:
+            self._check_node()
+            now_ms = time.time_ns() // 1_000_000
+            # A batch is only used within its millisecond, to keep ids timely
+            i = next(self._batch, None) if now_ms == self._batch_ms else None
+            if i is None:
+                self._batch = iter(self._reserve(self._batch_size, now_ms))
+                self._batch_ms = now_ms
+                i = next(self._batch)
+            return self._format(i)
+
+
+_ids = IDAllocator()
+
+
+def allocate_ids(n: int) -> List[str]:
+    """Allocate `n` ids for IDTags, eg. to create many at once."""
+    return _ids.allocate(n)
+
+
 class IDTag(MetaTag):
-    """A tag with a random unique ID (UUID)"""
+    """A tag with a unique ID, ordered by when it was allocated."""
 
-    def __init__(self, **kwargs) -> None:
-        super().__init__(**kwargs)
-        self.data.setdefault("id", str(uuid()))
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        if "id" not in self.data:
+            self.data["id"] = _ids.next_id()
 
     @property
     def id(self) -> str:
@@ -1,25 +1,427 @@
 # -*- coding: utf-8 -*-
 import abc
-from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
 import datetime as dt
-import json
+from functools import lru_cache
+import heapq
+import itertools
 from operator import attrgetter
+import os
 from pathlib import Path
-from typing import Any, cast, Iterable, List, Optional, Set, Union
+import re
+import tempfile
+import threading
+from typing import (
+    Any,
+    Callable,
+    cast,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+import weakref
 
 import apsw
 from dateutil.parser import parse as date_parse_base
-from dateutil.tz import tzutc
+from dateutil.tz import gettz
 
 from .categorypool import BaseCategoryPool, CategoryPool, MutableCategoryPool
+from .fingerprint import Fingerprint
+from .query import Query
 from .span import Span, Spannable
-from .tag import Category, MetaTag, Tag
-
-
+from .tag import (
+    Category,
+    encode_data,
+    IDTag,
+    LazyData,
+    MetaTag,
+    RecurringTag,
+    Tag,
+)
+from .utils import from_micros, to_micros, UTC, zone_name
+
+
+# RFC 3339, as emitted by Google Calendar and by our own stores. This is the
+# subset that Python 3.7's fromisoformat can take, once any "Z" is replaced.
+_RFC3339 = re.compile(
+    r"\d{4}-\d{2}-\d{2}"
+    r"(?:[T ]\d{2}:\d{2}:\d{2}(?:\.\d{3}|\.\d{6})?(?:Z|[+-]\d{2}:\d{2})?)?"
+)
+
+
+@lru_cache(maxsize=4096)
 def date_parse(datestring: str) -> dt.datetime:
     """Parse a date string, and also set the timezone to UTC. Reads TZ info
-    from input string, if present, or else assumes local time."""
-    return date_parse_base(datestring).astimezone(dt.timezone.utc)
+    from input string, if present, or else assumes local time.
+
+    RFC 3339 strings take a fast path, and anything else goes to dateutil.
+    Results are cached, as the same values (eg. all-day dates) recur a lot."""
+    if _RFC3339.fullmatch(datestring):
+        if datestring.endswith("Z"):
+            datestring = datestring[:-1] + "+00:00"
+        parsed = dt.datetime.fromisoformat(datestring)
+    else:
+        parsed = date_parse_base(datestring)
+    return parsed.astimezone(dt.timezone.utc)
+
+
+_MIN_TIME = dt.datetime.min.replace(tzinfo=dt.timezone.utc)
+_MAX_TIME = dt.datetime.max.replace(tzinfo=dt.timezone.utc)
+
+_TagKey = Tuple[dt.datetime, dt.datetime, str, str]
+
+
+def _order_key(tag: Tag) -> _TagKey:
+    """Total ordering for tags: start time, then finish time, then name. Open
+    starts sort first and open finishes last, as SqliteTimeSpan orders its
+    rows (see `_ORDER_BY`)."""
+    return (
+        tag.valid_from or _MIN_TIME,
+        tag.valid_to or _MAX_TIME,
+        tag.name,
+        tag.category.fullpath if tag.category else "",
+    )
+
+
+# The SQL equivalent of `_order_key`. NULLs sort first in SQLite, which suits
+# open starts but not open finishes. (Category only breaks ties in memory, as
+# the stores' unique index is on the other three.)
+_ORDER_BY = "valid_from, valid_to IS NULL, valid_to, name"
+
+
+def _shift(when: dt.datetime, delta: dt.timedelta) -> dt.datetime:
+    """`when + delta`, clamped to the representable range."""
+    try:
+        return when + delta
+    except OverflowError:
+        return _MAX_TIME if delta > dt.timedelta(0) else _MIN_TIME
+
+
+def _sql_time(when: Optional[dt.datetime]) -> Optional[int]:
+    return to_micros(when) if when is not None else None
+
+
+def _legacy_time(value: Union[int, str, None]) -> Optional[int]:
+    return to_micros(date_parse(value)) if isinstance(value, str) else value
+
+
+def _sql_time_from(value: Optional[int]) -> Optional[dt.datetime]:
+    return from_micros(value) if value is not None else None
+
+
+def _expand(
+    tags: Iterable[Tag],
+    begins_at: Optional[dt.datetime] = None,
+    finish_at: Optional[dt.datetime] = None,
+) -> Iterator[Tag]:
+    """Yield `tags`, replacing each RecurringTag with its occurrences in the
+    given window. Other tags are passed through unfiltered."""
+    for tag in tags:
+        if isinstance(tag, RecurringTag):
+            yield from tag.occurrences(begins_at, finish_at)
+        else:
+            yield tag
+
+
+def _route(
+    tags: Iterable[Tag],
+    targets: Dict[Category, List[Any]],
+    routed: Dict[Any, List[Tag]],
+) -> None:
+    """Append each tag to `routed[key]` for every key whose target category is
+    the tag's category or one of its ancestors."""
+    for tag in tags:
+        category = tag.category
+        while category is not None:
+            for key in targets.get(category, ()):
+                routed[key].append(tag)
+            category = category.parent
+
+
+def _ordered_tags(source: Union["BaseTimeSpan", Iterable[Tag]]) -> Iterable[Tag]:
+    if isinstance(source, BaseTimeSpan):
+        return source.iter_tags(order_by="valid_from")
+    return source
+
+
+ORDERINGS = ("valid_from",)
+
+
+def _check_ordering(order_by: Optional[str], after: Optional[Tag]) -> None:
+    if order_by is not None and order_by not in ORDERINGS:
+        raise ValueError("Unsupported ordering", order_by)
+    if after is not None:
+        if order_by is None:
+            raise ValueError("A cursor requires an ordering")
+        if after.valid_from is None or after.valid_to is None:
+            raise ValueError("Cursor tags must have finite times", after)
+
+
+def _paginate(
+    tags: Iterable[Tag],
+    order_by: Optional[str] = None,
+    after: Optional[Tag] = None,
+    limit: Optional[int] = None,
+) -> Iterator[Tag]:
+    """Order and page through tags in python. Timespans should only fall back
+    to this if they have nothing better, as it must sort every tag."""
+    _check_ordering(order_by, after)
+    if order_by is not None:
+        tags = sorted(tags, key=_order_key)
+    if after is not None:
+        cursor = _order_key(after)
+        tags = (t for t in tags if _order_key(t) > cursor)
+    return itertools.islice(tags, limit)
+
+
+def merge(
+    *sources: Union["BaseTimeSpan", Iterable[Tag]],
+    coalesce: bool = False,
+    gap_tolerance: dt.timedelta = dt.timedelta(0),
+) -> Iterator[Tag]:
+    """Stream the tags of several sources as one sequence ordered by start time.
+
+    Iterables of tags are assumed to already be in start time order (as
+    produced by another `merge`, for instance); timespans are ordered for you.
+    Exact duplicates are dropped as they are found. With `coalesce`, tags with
+    the same name and category that overlap, or are separated by no more than
+    `gap_tolerance`, are merged in to one tag.
+
+    The output is a generator in start order, so it can be handed directly to
+    `InsertableTimeSpan.insert_tags` without collecting it first.
+    """
+    merged = heapq.merge(*(_ordered_tags(s) for s in sources), key=_order_key)
+    tags = _deduplicate(merged)
+    if coalesce:
+        tags = _coalesce(tags, gap_tolerance)
+    return tags
+
+
+def _deduplicate(tags: Iterable[Tag]) -> Iterator[Tag]:
+    """Drop repeated tags from an ordered stream. Duplicates share an order key
+    so only the tags at the current key need to be remembered."""
+    current_key: Optional[_TagKey] = None
+    seen: List[Tag] = []  # MetaTags are not hashable
+    for tag in tags:
+        key = _order_key(tag)
+        if key != current_key:
+            current_key = key
+            seen = []
+        elif tag in seen:
+            continue
+        seen.append(tag)
+        yield tag
+
+
+def _coalesce(tags: Iterable[Tag], gap_tolerance: dt.timedelta) -> Iterator[Tag]:
+    """Merge overlapping or nearby same-name, same-category tags from an
+    ordered stream, preserving the order.
+
+    Each (name, category) has at most one pending tag that may still grow. A
+    pending tag is closed once the stream moves past its finish (plus the
+    tolerance), and closed tags are only released once no pending tag could
+    precede them.
+    """
+    serial = itertools.count()
+    # ident -> [opened serial, extended serial, tag]
+    pending: Dict[Tuple[str, str], List[Any]] = {}
+    deadlines: List[Tuple[dt.datetime, int, Tuple[str, str]]] = []
+    openings: List[Tuple[_TagKey, int, Tuple[str, str]]] = []
+    ready: List[Tuple[_TagKey, int, Tag]] = []
+
+    def close(ident: Tuple[str, str]) -> None:
+        tag = pending.pop(ident)[2]
+        heapq.heappush(ready, (_order_key(tag), next(serial), tag))
+
+    def release(final: bool = False) -> Iterator[Tag]:
+        while openings and (
+            openings[0][2] not in pending
+            or pending[openings[0][2]][0] != openings[0][1]
+        ):
+            heapq.heappop(openings)
+        while ready and (final or not openings or ready[0][0] <= openings[0][0]):
+            yield heapq.heappop(ready)[2]
+
+    for tag in tags:
+        start = tag.valid_from or _MIN_TIME
+        while deadlines and deadlines[0][0] < start:
+            _, extended, ident = heapq.heappop(deadlines)
+            if ident in pending and pending[ident][1] == extended:
+                close(ident)
+
+        ident = (tag.name, tag.category.fullpath if tag.category else "")
+        if ident in pending:
+            entry = pending[ident]
+            held: Tag = entry[2]
+            if held.valid_to is None or tag.valid_to is None:
+                finish = None
+            else:
+                finish = max(held.valid_to, tag.valid_to)
+            entry[1] = next(serial)
+            entry[2] = replace(held, valid_to=finish)
+            if isinstance(held, MetaTag) and isinstance(tag, MetaTag):
+                entry[2] = replace(entry[2], data=_merge_data([held, tag]))
+        else:
+            opened = next(serial)
+            entry = [opened, opened, tag]
+            pending[ident] = entry
+            heapq.heappush(openings, (_order_key(tag), entry[0], ident))
+
+        held_finish = entry[2].valid_to
+        if held_finish is None:
+            deadline = _MAX_TIME
+        else:
+            deadline = _shift(held_finish, gap_tolerance)
+        heapq.heappush(deadlines, (deadline, entry[1], ident))
+
+        yield from release()
+
+    for ident in list(pending):
+        close(ident)
+    yield from release(final=True)
+
+
+def compact(
+    timespan: Union["BaseTimeSpan", Iterable[Tag]],
+    gap_tolerance: dt.timedelta = dt.timedelta(0),
+    archive_before: Optional[dt.datetime] = None,
+) -> Iterator[Tag]:
+    """Stream a compacted copy of `timespan`'s tags, in start order. As with
+    `merge`, an iterable of tags in start order may be given instead.
+
+    Tags with the same name and category that overlap, or are no more than
+    `gap_tolerance` apart, are merged in to one tag. If `archive_before` is
+    given, every tag that finished before then is rolled up in to a single
+    summary tag per (UTC) day and category. The metadata of MetaTags is merged
+    along with them, the earliest tag's values winning.
+    """
+    tags = merge(timespan, coalesce=True, gap_tolerance=gap_tolerance)
+    if archive_before is None:
+        return tags
+    return _archive(tags, archive_before)
+
+
+def _archive(tags: Iterable[Tag], archive_before: dt.datetime) -> Iterator[Tag]:
+    # Tags arrive in start order, so a day's tags are contiguous and only one
+    # day needs to be held at a time.
+    day: Optional[dt.date] = None
+    passthrough: List[Tag] = []
+    summaries: Dict[str, List[Tag]] = {}
+
+    def flush() -> Iterator[Tag]:
+        rolled_up = [
+            _summary_tag(cast(dt.date, day), group) for group in summaries.values()
+        ]
+        yield from sorted(passthrough + rolled_up, key=_order_key)
+        passthrough.clear()
+        summaries.clear()
+
+    for tag in tags:
+        if tag.valid_from is None:
+            yield tag  # Infinitely early tags sort before everything else
+            continue
+
+        tag_day = tag.valid_from.astimezone(dt.timezone.utc).date()
+        if tag_day != day:
+            yield from flush()
+            day = tag_day
+
+        if tag.valid_to is not None and tag.valid_to < archive_before:
+            category = tag.category.fullpath if tag.category else ""
+            summaries.setdefault(category, []).append(tag)
+        else:
+            passthrough.append(tag)
+
+    yield from flush()
+
+
+def _summary_tag(day: dt.date, tags: List[Tag]) -> Tag:
+    category = tags[0].category
+    label = category.fullpath if category else "Uncategorized"
+    summary = Tag(
+        name=f"Archived {day.isoformat()}: {label} ({len(tags)} tags)",
+        category=category,
+        valid_from=min(cast(dt.datetime, t.valid_from) for t in tags),
+        valid_to=max(cast(dt.datetime, t.valid_to) for t in tags),
+    )
+    data = _merge_data([t for t in tags if isinstance(t, MetaTag)])
+    return MetaTag.from_tag(summary, data) if data else summary
+
+
+def _merge_data(tags: List[MetaTag]) -> Dict[str, Any]:
+    """The metadata of several tags in one, the earliest tag's values winning."""
+    merged: Dict[str, Any] = {}
+    for tag in reversed(tags):
+        merged.update(tag.data)
+    return merged
+
+
+@dataclass(frozen=True)
+class TimeSpanDiff:
+    """The changes needed to turn one timespan in to another. `changed` holds
+    (old, new) pairs of tags that share a start time, name and category."""
+
+    added: List[Tag]
+    removed: List[Tag]
+    changed: List[Tuple[Tag, Tag]]
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+def diff(
+    old: Union["BaseTimeSpan", Iterable[Tag]], new: Union["BaseTimeSpan", Iterable[Tag]]
+) -> TimeSpanDiff:
+    """Compare two timespans (or iterables of tags in start order) by walking
+    both in start order, in O(n + m)."""
+    result = TimeSpanDiff(added=[], removed=[], changed=[])
+    old_groups = _start_groups(_ordered_tags(old))
+    new_groups = _start_groups(_ordered_tags(new))
+    old_group = next(old_groups, None)
+    new_group = next(new_groups, None)
+    while old_group or new_group:
+        if old_group and (not new_group or old_group[0] < new_group[0]):
+            result.removed.extend(old_group[1])
+            old_group = next(old_groups, None)
+        elif new_group and (not old_group or new_group[0] < old_group[0]):
+            result.added.extend(new_group[1])
+            new_group = next(new_groups, None)
+        elif old_group and new_group:
+            _diff_group(old_group[1], new_group[1], result)
+            old_group = next(old_groups, None)
+            new_group = next(new_groups, None)
+    return result
+
+
+def _start_groups(tags: Iterable[Tag]) -> Iterator[Tuple[dt.datetime, List[Tag]]]:
+    groups = itertools.groupby(tags, key=lambda t: t.valid_from or _MIN_TIME)
+    for start, group in groups:
+        yield start, list(group)
+
+
+def _diff_group(old: List[Tag], new: List[Tag], result: TimeSpanDiff) -> None:
+    """Diff tags that all share a start time. These groups are small."""
+    unmatched = list(old)
+    for tag in new:
+        if tag in unmatched:
+            unmatched.remove(tag)
+            continue
+        ident = (tag.name, tag.category)
+        previous = next((t for t in unmatched if (t.name, t.category) == ident), None)
+        if previous is None:
+            result.added.append(tag)
+        else:
+            unmatched.remove(previous)
+            result.changed.append((previous, tag))
+    result.removed.extend(unmatched)
 
 
 class BaseTimeSpan(Spannable, metaclass=abc.ABCMeta):
@@ -29,13 +431,50 @@ class BaseTimeSpan(Spannable, metaclass=abc.ABCMeta):
         raise NotImplementedError("Subclasses must define this interface.")
 
     @abc.abstractmethod
-    def iter_tags(self) -> Iterable["Tag"]:
+    def iter_tags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable["Tag"]:
+        """Iterate over the tags in this timespan, in no particular order.
+
+        If `order_by` is "valid_from", tags are ordered by start time, then
+        finish time, then name. `after` is a keyset cursor: with an ordering,
+        only tags strictly after that tag are returned, so the last tag of one
+        page is the cursor for the next. `limit` caps the number of tags.
+        """
         raise NotImplementedError("Subclasses must define this interface.")
 
     @abc.abstractmethod
     def filter(self, category: Union["Category", str]) -> "BaseTimeSpan":
         raise NotImplementedError("Subclasses must define this interface.")
 
+    def filter_many(
+        self, categories: Iterable[Union["Category", str]]
+    ) -> Dict[Union["Category", str], "BaseTimeSpan"]:
+        """`filter` for several categories at once, keyed by the categories as
+        given. The tags are read in one pass, and a tag goes to every category
+        that contains it, so nested categories may share tags."""
+        targets, routed = self._filter_targets(categories)
+        _route(self.iter_tags(), targets, routed)
+        return {key: TimeSpan(set(tags)) for key, tags in routed.items()}
+
+    def _filter_targets(
+        self, categories: Iterable[Union["Category", str]]
+    ) -> Tuple[Dict[Category, List[Any]], Dict[Any, List[Tag]]]:
+        targets: Dict[Category, List[Any]] = {}
+        routed: Dict[Any, List[Tag]] = {}
+        for key in categories:
+            if key in routed:
+                continue  # Asked for twice, but its tags are only routed once
+            routed[key] = []
+            category = (
+                self.category_pool.get_category(key) if isinstance(key, str) else key
+            )
+            targets.setdefault(category, []).append(key)
+        return targets, routed
+
     @abc.abstractmethod
     def reslice(
         self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
@@ -45,6 +484,40 @@ class BaseTimeSpan(Spannable, metaclass=abc.ABCMeta):
     def has_tag(self, tag: Tag) -> bool:
         return tag in set(self.iter_tags())
 
+    @property
+    def fingerprint(self) -> Fingerprint:
+        """Merkle-style per-day content hashes, see `Fingerprint`. Subclasses
+        should keep this up to date incrementally rather than rescanning."""
+        return Fingerprint(self.iter_tags())
+
+    def active_at(self, when: dt.datetime) -> Iterable[Tag]:
+        """Tags in progress at `when` (inclusive of both ends), in start order."""
+        return [
+            t
+            for t in self.iter_tags(order_by="valid_from")
+            if (t.valid_from or _MIN_TIME) <= when <= (t.valid_to or _MAX_TIME)
+        ]
+
+    def next_after(self, when: dt.datetime, n: Optional[int] = 1) -> Iterable[Tag]:
+        """The first `n` tags (or all of them, if `n` is None) that start
+        strictly after `when`, in start order."""
+        upcoming = (
+            t
+            for t in self.iter_tags(order_by="valid_from")
+            if t.valid_from is not None and t.valid_from > when
+        )
+        return list(itertools.islice(upcoming, n))
+
+    def query(self) -> Query:
+        """Start a lazy query over this timespan. See `Query`."""
+        return Query(self)
+
+    def _run_query(self, query: Query) -> Iterable[Tag]:
+        """Run a query in one pass. Subclasses should push as much of it as
+        they can down in to their own indexes."""
+        tags = self.iter_tags(order_by=query.ordering)
+        return itertools.islice(filter(query.matches, tags), query.max_results)
+
     def __len__(self) -> int:
         return len(list(self.iter_tags()))
 
@@ -78,22 +551,131 @@ class BaseTimeSpan(Spannable, metaclass=abc.ABCMeta):
             yield self.slice_with_span(subspan)
 
 
+@dataclass(frozen=True)
+class _SortedIndex:
+    tags: List[Tag]
+    keys: List[_TagKey]
+    starts: List[dt.datetime]
+    # Longest tag, used to bound stabbing queries. None if any is unbounded.
+    max_duration: Optional[dt.timedelta]
+
+    @classmethod
+    def build(cls, tags: Iterable[Tag]) -> "_SortedIndex":
+        ordered = sorted(tags, key=_order_key)
+        max_duration: Optional[dt.timedelta] = None
+        longest = dt.timedelta(0)
+        for tag in ordered:
+            if tag.valid_from is None or tag.valid_to is None:
+                break
+            longest = max(longest, tag.valid_to - tag.valid_from)
+        else:
+            max_duration = longest
+        return cls(
+            tags=ordered,
+            keys=[_order_key(t) for t in ordered],
+            starts=[t.valid_from or _MIN_TIME for t in ordered],
+            max_duration=max_duration,
+        )
+
+
 @dataclass(frozen=True)
 class TimeSpan(BaseTimeSpan):
     tags: Set[Tag]
+    # Sorted index of `tags`, built on first use. Safe because we're immutable.
+    _sorted: Optional[_SortedIndex] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _fingerprint: Optional[Fingerprint] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    # Index of MetaTags by their "id", also built on first use
+    _ids: Optional[Dict[Any, MetaTag]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self) -> None:
+        if iter(self.tags) is self.tags:
+            # A one-off stream, kept so that it can be checked and read again
+            object.__setattr__(self, "tags", list(self.tags))
+        # Recurrences are expanded to count and iterate over them
+        for tag in self.tags:
+            if isinstance(tag, RecurringTag) and tag.valid_to is None:
+                raise ValueError("Recurring tags must be bounded by valid_to", tag)
 
     @property
     def category_pool(self) -> CategoryPool:
         return CategoryPool(
             stored_categories={
                 tag.category.fullpath: tag.category
-                for tag in self.iter_tags()
+                for tag in self.tags
                 if tag.category is not None
             }
         )
 
-    def iter_tags(self) -> Iterable["Tag"]:
-        yield from self.tags
+    def iter_tags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable["Tag"]:
+        _check_ordering(order_by, after)
+        if order_by is None:
+            return itertools.islice(self._expanded(), limit)
+
+        index = self._index()
+        start = 0 if after is None else bisect_right(index.keys, _order_key(after))
+        stop = None if limit is None else start + limit
+        return iter(index.tags[start:stop])
+
+    def _expanded(self) -> Iterator[Tag]:
+        """The tags, with recurring ones replaced by their occurrences, less
+        any occurrences also held as concrete tags or repeated by another rule."""
+        occurrences: Set[Tag] = set()
+        for tag in self.tags:
+            if not isinstance(tag, RecurringTag):
+                yield tag
+                continue
+            for occurrence in tag.occurrences():
+                if occurrence not in self.tags and occurrence not in occurrences:
+                    occurrences.add(occurrence)
+                    yield occurrence
+
+    @property
+    def fingerprint(self) -> Fingerprint:
+        if self._fingerprint is None:
+            object.__setattr__(self, "_fingerprint", Fingerprint(self.tags))
+        return cast(Fingerprint, self._fingerprint)
+
+    def _index(self) -> _SortedIndex:
+        if self._sorted is None:
+            index = _SortedIndex.build(self._expanded())
+            object.__setattr__(self, "_sorted", index)
+        return cast(_SortedIndex, self._sorted)
+
+    def active_at(self, when: dt.datetime) -> Iterable[Tag]:
+        index = self._index()
+        stop = bisect_right(index.starts, when)
+        start = 0
+        if index.max_duration is not None:
+            start = bisect_left(index.starts, _shift(when, -index.max_duration))
+        return [t for t in index.tags[start:stop] if (t.valid_to or _MAX_TIME) >= when]
+
+    def next_after(self, when: dt.datetime, n: Optional[int] = 1) -> Iterable[Tag]:
+        index = self._index()
+        start = bisect_right(index.starts, when)
+        return index.tags[start : None if n is None else start + n]
+
+    def _run_query(self, query: Query) -> Iterable[Tag]:
+        _check_ordering(query.ordering, None)
+        index = self._index()
+        start, stop = 0, len(index.tags)
+        if query.window.finish_at is not None:
+            stop = bisect_right(index.starts, query.window.finish_at)
+        if query.window.begins_at is not None and index.max_duration is not None:
+            earliest = _shift(query.window.begins_at, -index.max_duration)
+            start = bisect_left(index.starts, earliest)
+        tags = (index.tags[i] for i in range(start, stop))
+        return itertools.islice(filter(query.matches, tags), query.max_results)
 
     def reslice(
         self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
@@ -102,7 +684,11 @@ class TimeSpan(BaseTimeSpan):
             begins_at if begins_at is not None else self.span.begins_at,
             finish_at if finish_at is not None else self.span.finish_at,
         )
-        tags = {t for t in self.tags if t in newspan}
+        tags = {
+            t
+            for t in _expand(self.tags, newspan.begins_at, newspan.finish_at)
+            if t in newspan
+        }
         return TimeSpan(tags=tags)
 
     @property
@@ -126,21 +712,98 @@ class TimeSpan(BaseTimeSpan):
             category = self.category_pool.get_category(category)
         cast(Category, category)
 
-        return TimeSpan(tags={tag for tag in self.iter_tags() if tag in category})
+        return TimeSpan(tags={tag for tag in self.tags if tag in category})
 
     @classmethod
     def combine(cls, *others: "BaseTimeSpan") -> "TimeSpan":
         tags = {t for other in others for t in other.iter_tags()}
         return TimeSpan(tags)
 
+    def get_by_id(self, tag_id: Any) -> Optional[MetaTag]:
+        """The MetaTag (eg. IDTag) with this "id" in its data, if any."""
+        if self._ids is None:
+            ids = {
+                tag.data["id"]: tag
+                for tag in self.tags
+                if isinstance(tag, MetaTag) and "id" in tag.data
+            }
+            object.__setattr__(self, "_ids", ids)
+        return cast(Dict[Any, MetaTag], self._ids).get(tag_id)
 
-class InsertableTimeSpan(BaseTimeSpan, metaclass=abc.ABCMeta):
+
+Subscriber = Callable[[bool, Tag], None]
+_Subscription = Tuple[Optional[Category], Optional[Span], Subscriber]
+
+
+class MutableTimeSpan(BaseTimeSpan, metaclass=abc.ABCMeta):
+    """Common base of the mutable timespans, which push their changes to
+    subscribers as they happen."""
+
+    def subscribe(
+        self,
+        callback: Subscriber,
+        category: Optional[Union[Category, str]] = None,
+        span: Optional[Span] = None,
+    ) -> Callable[[], None]:
+        """Call `callback(is_insert, tag)` for each tag inserted in to or removed
+        from this timespan that would pass `filter(category)` and overlap
+        `span`. This lets a derived view be maintained incrementally, rather
+        than being rebuilt after every change.
+
+        Recurring tags are delivered as their occurrences within `span`, if it
+        is bounded, or else as the recurring tag itself. Returns a function
+        that cancels the subscription."""
+        if isinstance(category, str):
+            category = self.category_pool.get_category(category)
+        if not hasattr(self, "_subscribers"):
+            self._subscribers: Dict[object, _Subscription] = {}
+        key = object()
+        self._subscribers[key] = (category, span, callback)
+
+        def unsubscribe() -> None:
+            self._subscribers.pop(key, None)
+
+        return unsubscribe
+
+    @property
+    def _has_subscribers(self) -> bool:
+        return bool(getattr(self, "_subscribers", None))
+
+    def _notify(self, is_insert: bool, tags: Iterable[Tag]) -> None:
+        """Push a change to every matching subscriber."""
+        if not self._has_subscribers:
+            return
+        tags = list(tags)
+        for category, span, callback in list(self._subscribers.values()):
+            for tag in tags:
+                if category is not None and tag not in category:
+                    continue
+                if span is not None and tag not in span:
+                    continue
+                if isinstance(tag, RecurringTag) and span and span.is_finite():
+                    for occurrence in tag.occurrences(span.begins_at, span.finish_at):
+                        callback(is_insert, occurrence)
+                else:
+                    callback(is_insert, tag)
+
+    def _notify_diff(self, changes: TimeSpanDiff) -> None:
+        self._notify(False, changes.removed + [old for old, _ in changes.changed])
+        self._notify(True, changes.added + [new for _, new in changes.changed])
+
+
+class InsertableTimeSpan(MutableTimeSpan, metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def insert_tag(self, tag: Tag) -> None:
         raise NotImplementedError("Subclasses must define this interface.")
 
+    def insert_tags(self, tags: Iterable[Tag]) -> None:
+        """Insert many tags. Subclasses should override this with a bulk load
+        where they can."""
+        for tag in tags:
+            self.insert_tag(tag)
+
 
-class RemovableTimeSpan(BaseTimeSpan, metaclass=abc.ABCMeta):
+class RemovableTimeSpan(MutableTimeSpan, metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def remove_tag(self, tag: Tag) -> bool:
         """Remove the specified tag. Return true iff the tag was found."""
@@ -158,25 +821,246 @@ class WriteableTimeSpan(BaseTimeSpan, metaclass=abc.ABCMeta):
         raise NotImplementedError("Subclasses must define this interface.")
 
 
+_CacheKey = Tuple[Any, ...]
+
+
+def _remove_spill_file(conn: apsw.Connection, path: Path) -> None:
+    conn.close()
+    path.unlink()
+
+
+class ReadOnlyTimeSpan(BaseTimeSpan):
+    """A view of another timespan that can only be read, eg. to hand out a
+    shared result without letting the receiver change it."""
+
+    def __init__(self, timespan: BaseTimeSpan) -> None:
+        self._timespan = timespan
+
+    @property
+    def category_pool(self) -> BaseCategoryPool:
+        return self._timespan.category_pool
+
+    def iter_tags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable["Tag"]:
+        return self._timespan.iter_tags(order_by, after, limit)
+
+    @property
+    def fingerprint(self) -> Fingerprint:
+        return self._timespan.fingerprint
+
+    def active_at(self, when: dt.datetime) -> Iterable[Tag]:
+        return self._timespan.active_at(when)
+
+    def next_after(self, when: dt.datetime, n: Optional[int] = 1) -> Iterable[Tag]:
+        return self._timespan.next_after(when, n)
+
+    def _run_query(self, query: Query) -> Iterable[Tag]:
+        return self._timespan._run_query(query)
+
+    def has_tag(self, tag: Tag) -> bool:
+        return self._timespan.has_tag(tag)
+
+    @property
+    def span(self) -> Span:
+        return self._timespan.span
+
+    def __len__(self) -> int:
+        return len(self._timespan)
+
+    def filter(self, category: Union["Category", str]) -> "BaseTimeSpan":
+        return self._timespan.filter(category)
+
+    def reslice(
+        self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
+    ) -> "BaseTimeSpan":
+        return self._timespan.reslice(begins_at, finish_at)
+
+
+class CachedTimeSpan(ReadOnlyTimeSpan):
+    """Read-through cache in front of any other timespan.
+
+    The results of `reslice`, `filter`, `span` and `len` are memoized in an
+    LRU that is bounded by `max_tags`, the total number of tags held across
+    all cached results. Results are shared between callers, so they are
+    handed out as `ReadOnlyTimeSpan`s. If the wrapped timespan is mutable, the
+    cache subscribes to it and drops exactly the entries each change could
+    affect. Everything else is passed straight through.
+    """
+
+    def __init__(self, timespan: BaseTimeSpan, max_tags: int = 100_000) -> None:
+        super().__init__(timespan)
+        self._max_tags = max_tags
+        self._size = 0
+        self._entries: "OrderedDict[_CacheKey, Tuple[Any, int]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._unsubscribe: Optional[Callable[[], None]] = None
+        if isinstance(timespan, MutableTimeSpan):
+            self._unsubscribe = timespan.subscribe(self._invalidate)
+
+    def close(self) -> None:
+        """Stop listening for changes to the wrapped timespan."""
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        self.invalidate()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def invalidate(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    def _cached(
+        self,
+        key: _CacheKey,
+        compute: Callable[[], Any],
+        cost: Callable[[Any], int] = lambda _: 1,
+    ) -> Any:
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+        self.misses += 1
+        value = compute()
+        size = cost(value)
+        if size <= self._max_tags:
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self._max_tags:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+        return value
+
+    def _invalidate(self, is_insert: bool, tag: Tag) -> None:
+        for key in list(self._entries):
+            if key[0] == "reslice":
+                # slice_with_span passes naive min/max for open ends
+                begins_at = None if key[1] == dt.datetime.min else key[1]
+                finish_at = None if key[2] == dt.datetime.max else key[2]
+                stale = tag in Span(begins_at, finish_at)
+            elif key[0] == "filter":
+                stale = key[1] is None or tag in key[1]
+            else:
+                stale = True
+            if stale:
+                _, size = self._entries.pop(key)
+                self._size -= size
+
+    @property
+    def span(self) -> Span:
+        return self._cached(("span",), lambda: self._timespan.span)
+
+    def __len__(self) -> int:
+        return self._cached(("len",), lambda: len(self._timespan))
+
+    def filter(self, category: Union["Category", str]) -> "BaseTimeSpan":
+        if isinstance(category, str):
+            category = self.category_pool.get_category(category)
+        return self._cached(
+            ("filter", category),
+            lambda: ReadOnlyTimeSpan(self._timespan.filter(category)),
+            lambda result: max(1, len(result)),
+        )
+
+    def reslice(
+        self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
+    ) -> "BaseTimeSpan":
+        return self._cached(
+            ("reslice", begins_at, finish_at),
+            lambda: ReadOnlyTimeSpan(self._timespan.reslice(begins_at, finish_at)),
+            lambda result: max(1, len(result)),
+        )
+
+
+_RECURRING_COLUMNS = (
+    "valid_from, valid_to, name, category, recurrence, duration, timezone"
+)
+
+
+def _words(text: str) -> Set[str]:
+    """Roughly the tokens FTS5's default tokenizer would find in `text`."""
+    return set(re.findall(r"[^\W_]+", text.lower()))
+
+
 class SqliteTimeSpan(InsertableTimeSpan, RemovableTimeSpan, WriteableTimeSpan):
     """Sqlite-backed TimeSpan"""
 
+    # Columns of the tags table that `search` looks through
+    _SEARCH_COLUMNS: Tuple[str, ...] = ("name",)
+
     # The goal for this implementation is that it should be a really solid
     # performer for almost any use case, so long as the number of tags can
     # reasonably fit in memory. This particular class is a good candidate for
     # optimizations at the expense of readibility.
+    #
+    # For stores that might not fit, a `memory_budget` in bytes may be given.
+    # Once the database grows past it, it is moved to a temporary file, and
+    # the page cache is capped at the budget so that hot index pages stay
+    # in memory.
 
-    def __init__(self, tags: Optional[Iterable[Tag]] = None) -> None:
-        self._sqlite_db: apsw.Connection = apsw.Connection(":memory:")
+    def __init__(
+        self, tags: Optional[Iterable[Tag]] = None, memory_budget: Optional[int] = None
+    ) -> None:
+        self._sqlite_db: apsw.Connection = self._connect()
+        self._memory_budget = memory_budget
+        self._spill_path: Optional[Path] = None
         self._category_pool: MutableCategoryPool = MutableCategoryPool()
+        # Upper bound on the length of any stored tag (None if unbounded), so
+        # that stabbing queries can use a bounded range scan on tags_idx.
+        self._max_duration: Optional[dt.timedelta] = dt.timedelta(0)
+        self._fingerprint = Fingerprint()
+        self._has_search_index = False
 
         with self._sqlite_db:
             conn = self._sqlite_db.cursor()
             self._create_table(conn)
+            self._create_recurring_table(conn)
 
         if tags:
-            for tag in tags:
-                self.insert_tag(tag)
+            self.insert_tags(tags)
+
+    def _connect(self) -> apsw.Connection:
+        return apsw.Connection(":memory:")
+
+    @property
+    def spilled(self) -> bool:
+        """True once this timespan has moved out of memory in to a temp file."""
+        return self._spill_path is not None
+
+    def _check_budget(self) -> None:
+        # Spilling swaps the connection, so this must only be called once no
+        # transaction is open, at the end of a public method.
+        if self._memory_budget is None or self._spill_path is not None:
+            return
+        conn = self._sqlite_db.cursor()
+        page_count = list(conn.execute("PRAGMA page_count"))[0][0]
+        page_size = list(conn.execute("PRAGMA page_size"))[0][0]
+        if page_count * page_size > self._memory_budget:
+            self._spill()
+
+    def _spill(self) -> None:
+        fd, name = tempfile.mkstemp(prefix="hermes-", suffix=".sqlite")
+        os.close(fd)
+        path = Path(name)
+        file_db = apsw.Connection(name)
+        with file_db.backup("main", self._sqlite_db, "main") as backup:
+            backup.step()
+        # A negative cache_size is in KiB
+        budget_kib = max(1, cast(int, self._memory_budget) // 1024)
+        file_db.cursor().execute(f"PRAGMA cache_size = -{budget_kib}")
+
+        self._sqlite_db.close()
+        self._sqlite_db = file_db
+        self._spill_path = path
+        weakref.finalize(self, _remove_spill_file, file_db, path)
 
     def _create_table(self, conn) -> None:
         conn.execute(
@@ -195,69 +1079,668 @@ class SqliteTimeSpan(InsertableTimeSpan, RemovableTimeSpan, WriteableTimeSpan):
             """
         )
 
+    def _create_recurring_table(self, conn) -> None:
+        # Recurring tags are stored once, as rules, and expanded when read. The
+        # rule is expanded in the time zone it was given in, so that eg. a
+        # weekly 9am meeting stays at 9am across daylight saving changes.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS recurring (
+                valid_from datetime,
+                valid_to datetime,
+                name text,
+                category text,
+                recurrence text,
+                duration integer,
+                timezone text
+            )
+            """
+        )
+
     def __len__(self) -> int:
         with self._sqlite_db:
             conn = self._sqlite_db.cursor()
-            return list(conn.execute("SELECT COUNT(*) FROM tags"))[0][0]
+            count = list(conn.execute("SELECT COUNT(*) FROM tags"))[0][0]
+        count += sum(1 for _ in self._occurrences(self._iter_recurring()))
+        return count
 
     def insert_tag(self, tag: Tag) -> None:
+        self.insert_tags((tag,))
+
+    def insert_tags(self, tags: Iterable[Tag]) -> None:
+        """Bulk insert, in a single transaction with one prepared statement."""
+        recurring: List[RecurringTag] = []
+        inserted: Optional[List[Tag]] = [] if self._has_subscribers else None
+
+        def concrete_params() -> Iterator[Dict[str, Any]]:
+            for tag in tags:
+                if inserted is not None:
+                    inserted.append(tag)
+                if isinstance(tag, RecurringTag):
+                    recurring.append(tag)
+                else:
+                    yield self._tag_params(tag)
+
+        try:
+            self._insert_tags(concrete_params(), recurring)
+        except Exception:
+            # The fingerprint was updated as rows were prepared
+            self._rebuild_fingerprint()
+            raise
+        self._check_budget()
+
+        if inserted:
+            self._notify_inserted(inserted)
+
+    def _notify_inserted(self, tags: Iterable[Tag]) -> None:
+        """Tell subscribers about inserted tags, as they were stored."""
+        self._notify(
+            True,
+            (
+                replace(tag, category=self._stored_category(tag))
+                if tag.category is None
+                else tag
+                for tag in tags
+            ),
+        )
+
+    def _insert_tags(
+        self, params: Iterable[Dict[str, Any]], recurring: List[RecurringTag]
+    ) -> None:
         with self._sqlite_db:
             conn = self._sqlite_db.cursor()
-            category_str = tag.category.fullpath if tag.category else "sqlite3"
-            category = self._category_pool.get_category(category_str, create=True)
-            conn.execute(
+            conn.executemany(
                 """
                 INSERT INTO
                 tags (valid_from, valid_to, name, category)
                 VALUES (:valid_from, :valid_to, :name, :category)
                 """,
-                {
-                    "valid_from": tag.valid_from.astimezone(tzutc()).isoformat()
-                    if tag.valid_from
-                    else None,
-                    "valid_to": tag.valid_to.astimezone(tzutc()).isoformat()
-                    if tag.valid_to
-                    else None,
-                    "name": tag.name,
-                    "category": category.fullpath,
-                },
+                params,
             )
+            if recurring:
+                conn.executemany(
+                    f"""
+                    INSERT INTO recurring ({_RECURRING_COLUMNS})
+                    VALUES (
+                        :valid_from, :valid_to, :name, :category, :recurrence,
+                        :duration, :timezone
+                    )
+                    """,
+                    (self._recurring_params(tag) for tag in recurring),
+                )
+
+    def _insert_concrete(self, tags: Iterable[Tag]) -> None:
+        self._insert_tags((self._tag_params(tag) for tag in tags), [])
+
+    def _stored_category(self, tag: Tag) -> Category:
+        category_str = tag.category.fullpath if tag.category else "sqlite3"
+        return self._category_pool.get_category(category_str, create=True)
+
+    def _recurring_params(self, tag: RecurringTag) -> Dict[str, Any]:
+        if tag.valid_to is None:
+            raise ValueError("Stored recurring tags must be bounded by valid_to", tag)
+        category = self._stored_category(tag)
+        self._fingerprint.add(tag if tag.category else tag.recategorize(category))
+        return {
+            "valid_from": _sql_time(tag.valid_from),
+            "valid_to": _sql_time(tag.valid_to),
+            "name": tag.name,
+            "category": category.fullpath,
+            "recurrence": tag.recurrence,
+            "duration": tag.duration // dt.timedelta(microseconds=1),
+            "timezone": zone_name(cast(dt.datetime, tag.valid_from).tzinfo),
+        }
+
+    def _tag_params(self, tag: Tag) -> Dict[str, Any]:
+        category = self._stored_category(tag)
+        self._fingerprint.add(tag if tag.category else tag.recategorize(category))
+        if self._max_duration is not None:
+            if tag.valid_from is None or tag.valid_to is None:
+                self._max_duration = None
+            else:
+                duration = tag.valid_to - tag.valid_from
+                self._max_duration = max(self._max_duration, duration)
+        return {
+            "valid_from": _sql_time(tag.valid_from),
+            "valid_to": _sql_time(tag.valid_to),
+            "name": tag.name,
+            "category": category.fullpath,
+        }
 
     def remove_tag(self, tag: Tag) -> bool:
+        if isinstance(tag, RecurringTag):
+            table = "recurring"
+            columns = _RECURRING_COLUMNS
+            match = (
+                "valid_from = :valid_from AND name = :name"
+                " AND recurrence = :recurrence"
+            )
+            params = {
+                "valid_from": _sql_time(tag.valid_from),
+                "name": tag.name,
+                "recurrence": tag.recurrence,
+            }
+        else:
+            table = "tags"
+            columns = "valid_from, valid_to, name, category"
+            match = "valid_from = :valid_from AND valid_to = :valid_to AND name = :name"
+            params = {
+                "valid_from": _sql_time(tag.valid_from),
+                "valid_to": _sql_time(tag.valid_to),
+                "name": tag.name,
+            }
+
+        with self._sqlite_db:
+            conn = self._sqlite_db.cursor()
+            query = f"SELECT {columns} FROM {table} WHERE {match}"
+            rows = list(conn.execute(query, params))
+            conn.execute(f"DELETE FROM {table} WHERE {match}", params)
+
+        if not rows and table == "tags":
+            # It may be an occurrence of a recurring tag instead
+            return self._remove_occurrence(tag)
+        removed: List[Tag]
+        if table == "recurring":
+            removed = [self._recurring_from_row(row) for row in rows]
+        else:
+            removed = [self._tag_from_row(row) for row in rows]
+        for found in removed:
+            self._fingerprint.remove(found)
+        self._notify(False, removed)
+        return bool(rows)
+
+    def _remove_occurrence(self, tag: Tag) -> bool:
+        """Occurrences aren't stored by themselves, so one is removed by
+        excluding it from its rule, with an EXDATE."""
+        if tag.valid_from is None:
+            return False
+        with self._sqlite_db:
+            conn = self._sqlite_db.cursor()
+            rows = list(
+                conn.execute(f"SELECT rowid, {_RECURRING_COLUMNS} FROM recurring")
+            )
+        for row in rows:
+            recurring = self._recurring_from_row(row[1:])
+            if tag not in recurring.occurrences(tag.valid_from, tag.valid_from):
+                continue
+            start = tag.valid_from.astimezone(UTC)
+            excluded = replace(
+                recurring,
+                recurrence=f"{recurring.recurrence}\nEXDATE:{start:%Y%m%dT%H%M%SZ}",
+            )
+            self._fingerprint.remove(recurring)
+            with self._sqlite_db:
+                conn = self._sqlite_db.cursor()
+                conn.execute("DELETE FROM recurring WHERE rowid = ?", (row[0],))
+                self._insert_tags(iter(()), [excluded])
+            self._notify(False, [tag])
+            return True
+        return False
+
+    def compact(
+        self,
+        gap_tolerance: dt.timedelta = dt.timedelta(0),
+        archive_before: Optional[dt.datetime] = None,
+    ) -> None:
+        """Compact this timespan in place. See the module-level `compact`.
+        Recurring tags are left as they are."""
+        self._compact(
+            self._iter_concrete(order_by="valid_from"), gap_tolerance, archive_before
+        )
+
+    def _compact(
+        self,
+        ordered: Iterable[Tag],
+        gap_tolerance: dt.timedelta,
+        archive_before: Optional[dt.datetime],
+    ) -> None:
+        if self._has_subscribers:
+            ordered = list(ordered)
+        tags = list(compact(ordered, gap_tolerance, archive_before))
+        with self._sqlite_db:
+            self._sqlite_db.cursor().execute("DELETE FROM tags")
+            self._insert_concrete(tags)
+        self._rebuild_fingerprint()
+        self._check_budget()
+
+        if self._has_subscribers:
+            # Subscribers only hear about the tags that were actually merged.
+            self._notify_diff(diff(ordered, sorted(tags, key=_order_key)))
+
+    @property
+    def fingerprint(self) -> Fingerprint:
+        return self._fingerprint
+
+    def enable_journal(self) -> int:
+        """Start recording every change to this timespan in an append-only
+        journal, and return the current sequence number. Safe to call again.
+
+        The journal is kept by triggers, so it sees every insert and removal
+        however it was made, and it is saved along with the rest of the store.
+        """
         with self._sqlite_db:
             conn = self._sqlite_db.cursor()
             conn.execute(
-                "DELETE FROM tags WHERE valid_from = :valid_from AND valid_to = :valid_to AND name = :name",
-                {
-                    "valid_from": tag.valid_from.astimezone(tzutc()).isoformat()
-                    if tag.valid_from is not None
-                    else None,
-                    "valid_to": tag.valid_to.astimezone(tzutc()).isoformat()
-                    if tag.valid_to is not None
-                    else None,
-                    "name": tag.name,
-                },
+                """
+                CREATE TABLE IF NOT EXISTS journal (
+                    seq integer PRIMARY KEY AUTOINCREMENT,
+                    is_insert integer,
+                    valid_from datetime,
+                    valid_to datetime,
+                    name text,
+                    category text,
+                    recurrence text,
+                    duration integer,
+                    timezone text
+                )
+                """
             )
-        return True  # TODO - apsw does not support rowcount, do we care?
+            for table, columns in (
+                ("tags", "valid_from, valid_to, name, category"),
+                ("recurring", _RECURRING_COLUMNS),
+            ):
+                triggers = (("INSERT", 1, "NEW"), ("DELETE", 0, "OLD"))
+                for event, is_insert, row in triggers:
+                    values = ", ".join(
+                        f"{row}.{column.strip()}" for column in columns.split(",")
+                    )
+                    conn.execute(
+                        f"""
+                        CREATE TRIGGER IF NOT EXISTS journal_{table}_{event.lower()}
+                        AFTER {event} ON {table}
+                        BEGIN
+                            INSERT INTO journal (is_insert, {columns})
+                            VALUES ({is_insert}, {values});
+                        END
+                        """
+                    )
+        return self.last_seq
+
+    @property
+    def last_seq(self) -> int:
+        """The sequence number of the latest journal entry, or 0."""
+        with self._sqlite_db:
+            conn = self._sqlite_db.cursor()
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'journal'"
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def changes_since(self, seq: int) -> Iterable[Tuple[int, bool, Tag]]:
+        """Yield (seq, is_insert, tag) for every change after `seq`, in order.
+        Recurring tags are reported as RecurringTags, without expanding them.
+        See `enable_journal`."""
+        with self._sqlite_db:
+            conn = self._sqlite_db.cursor()
+            rows = list(
+                conn.execute(
+                    f"""
+                    SELECT seq, is_insert, {_RECURRING_COLUMNS}
+                    FROM journal WHERE seq > :seq ORDER BY seq
+                    """,
+                    {"seq": seq},
+                )
+            )
+        for row in rows:
+            if row[6] is None:
+                tag: Tag = self._tag_from_row(row[2:6])
+            else:
+                tag = self._recurring_from_row(row[2:9])
+            yield row[0], bool(row[1]), tag
+
+    def truncate_journal(self, seq: int) -> None:
+        """Forget journal entries up to and including `seq`. Sequence numbers
+        are never reused."""
+        with self._sqlite_db:
+            self._sqlite_db.cursor().execute(
+                "DELETE FROM journal WHERE seq <= :seq", {"seq": seq}
+            )
+
+    def _rebuild_fingerprint(self) -> None:
+        stored = itertools.chain(self._iter_concrete(), self._iter_recurring())
+        self._fingerprint = Fingerprint(stored)
 
     @property
     def category_pool(self) -> BaseCategoryPool:
         return cast(BaseCategoryPool, self._category_pool)
 
-    def iter_tags(self) -> Iterable["Tag"]:
+    def iter_tags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable["Tag"]:
+        _check_ordering(order_by, after)
+        recurring = list(self._iter_recurring())
+        if not recurring:
+            yield from self._iter_concrete(order_by, after, limit)
+            return
+
+        concrete = self._iter_concrete(order_by, after)
+        occurrences = self._occurrences(
+            recurring, None if after is None else after.valid_from
+        )
+        if order_by is None:
+            tags: Iterable[Tag] = itertools.chain(concrete, occurrences)
+        else:
+            tags = heapq.merge(concrete, occurrences, key=_order_key)
+        if after is not None:
+            cursor = _order_key(after)
+            tags = (t for t in tags if _order_key(t) > cursor)
+        yield from itertools.islice(tags, limit)
+
+    def _iter_concrete(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable[Tag]:
+        for row in self._select(
+            "valid_from, valid_to, name, category", order_by, after, limit
+        ):
+            yield self._tag_from_row(row)
+
+    def _occurrences(
+        self,
+        rules: Iterable[RecurringTag],
+        begins_at: Optional[dt.datetime] = None,
+        finish_at: Optional[dt.datetime] = None,
+    ) -> Iterator[Tag]:
+        """The occurrences of `rules` overlapping the window, in order, less any
+        that are also stored as concrete tags or repeat another rule's. Like
+        the tags table, this keeps one tag per start, finish and name."""
+        merged = heapq.merge(
+            *(rule.occurrences(begins_at, finish_at) for rule in rules),
+            key=_order_key,
+        )
+        previous: Optional[Tuple[Optional[int], Optional[int], str]] = None
+        for tag in merged:
+            key = (_sql_time(tag.valid_from), _sql_time(tag.valid_to), tag.name)
+            if key == previous:
+                continue
+            previous = key
+            with self._sqlite_db:
+                stored = list(
+                    self._sqlite_db.cursor().execute(
+                        """
+                        SELECT 1 FROM tags
+                        WHERE valid_from = ? AND valid_to = ? AND name = ?
+                        """,
+                        key,
+                    )
+                )
+            if not stored:
+                yield tag
+
+    def _iter_recurring(self) -> Iterable[RecurringTag]:
+        with self._sqlite_db:
+            cursor = self._sqlite_db.cursor()
+            rows = list(cursor.execute(f"SELECT {_RECURRING_COLUMNS} FROM recurring"))
+        for row in rows:
+            yield self._recurring_from_row(row)
+
+    def _recurring_from_row(self, row: Any) -> RecurringTag:
+        tag = self._tag_from_row(row[0:4])
+        zone = gettz(row[6]) if row[6] else UTC
+        return RecurringTag(
+            name=tag.name,
+            category=tag.category,
+            valid_from=cast(dt.datetime, tag.valid_from).astimezone(zone),
+            valid_to=cast(dt.datetime, tag.valid_to).astimezone(zone),
+            recurrence=row[4],
+            duration=dt.timedelta(microseconds=row[5]),
+        )
+
+    def _select(
+        self,
+        columns: str,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+        where: Optional[str] = None,
+        where_params: Optional[Dict[str, Any]] = None,
+    ) -> Iterable[Any]:
+        """Ordered and keyset-paginated SELECT, served by tags_idx."""
+        _check_ordering(order_by, after)
+        conditions = [where] if where else []
+        params: Dict[str, Any] = dict(where_params or {})
+        if after is not None:
+            # Rows with an open finish are after any cursor with the same start
+            conditions.append(
+                "(valid_from, valid_to, name) > (:after_from, :after_to, :after_name)"
+                " OR (valid_from = :after_from AND valid_to IS NULL)"
+            )
+            params["after_from"] = _sql_time(after.valid_from)
+            params["after_to"] = _sql_time(after.valid_to)
+            params["after_name"] = after.name
+
+        query = f"SELECT {columns} FROM tags"
+        if conditions:
+            query += " WHERE " + " AND ".join(f"({c})" for c in conditions)
+        if order_by is not None:
+            query += f" ORDER BY {_ORDER_BY}"
+        if limit is not None:
+            query += " LIMIT :limit"
+            params["limit"] = limit
+
         with self._sqlite_db:
             cursor = self._sqlite_db.cursor()
-            result = cursor.execute(
-                "SELECT valid_from, valid_to, name, category FROM tags"
+            yield from cursor.execute(query, params)
+
+    def _overlapping(
+        self,
+        begins_at: Optional[dt.datetime],
+        finish_at: Optional[dt.datetime],
+        params: Dict[str, Any],
+    ) -> List[str]:
+        """WHERE conditions for rows overlapping the window. When every row is
+        bounded, the start time is bounded on both sides so that tags_idx can
+        serve the range."""
+        conditions = []
+        if self._max_duration is None:
+            if finish_at is not None:
+                conditions.append("valid_from IS NULL OR valid_from <= :finish_at")
+            if begins_at is not None:
+                conditions.append("valid_to IS NULL OR valid_to >= :begins_at")
+        else:
+            if finish_at is not None:
+                conditions.append("valid_from <= :finish_at")
+            if begins_at is not None:
+                conditions.append("valid_from >= :earliest AND valid_to >= :begins_at")
+                params["earliest"] = _sql_time(_shift(begins_at, -self._max_duration))
+        if finish_at is not None:
+            params["finish_at"] = _sql_time(finish_at)
+        if begins_at is not None:
+            params["begins_at"] = _sql_time(begins_at)
+        return conditions
+
+    def active_at(self, when: dt.datetime) -> Iterable[Tag]:
+        params: Dict[str, Any] = {}
+        rows = self._select(
+            "valid_from, valid_to, name, category",
+            order_by="valid_from",
+            where=" AND ".join(f"({c})" for c in self._overlapping(when, when, params)),
+            where_params=params,
+        )
+        active = [self._tag_from_row(row) for row in rows]
+        active.extend(self._occurrences(self._iter_recurring(), when, when))
+        return sorted(active, key=_order_key)
+
+    def next_after(self, when: dt.datetime, n: Optional[int] = 1) -> Iterable[Tag]:
+        rows = self._select(
+            "valid_from, valid_to, name, category",
+            order_by="valid_from",
+            limit=n,
+            where="valid_from > :when",
+            where_params={"when": _sql_time(when)},
+        )
+        upcoming: Iterable[Tag] = (self._tag_from_row(row) for row in rows)
+        recurring = list(self._iter_recurring())
+        if recurring:
+            occurrences = (
+                o
+                for o in self._occurrences(recurring, when)
+                if cast(dt.datetime, o.valid_from) > when
             )
-            for row in result:
-                yield self._tag_from_row(row)
+            upcoming = heapq.merge(upcoming, occurrences, key=_order_key)
+        return list(itertools.islice(upcoming, n))
+
+    def _run_query(self, query: Query) -> Iterable[Tag]:
+        """Compile the query to a single SELECT. Recurring tags can't be
+        expanded in SQL, so their occurrences are merged in afterwards."""
+        params: Dict[str, Any] = {}
+        conditions = self._overlapping(
+            query.window.begins_at, query.window.finish_at, params
+        )
+        for i, category in enumerate(query.categories):
+            # Either the category itself, or anything beneath it
+            conditions.append(
+                f"category = :cat{i}"
+                f" OR (category > :cat{i} || '/' AND category < :cat{i} || '0')"
+            )
+            params[f"cat{i}"] = category.fullpath
+        if query.name_set is not None:
+            names = sorted(query.name_set)
+            conditions.append(
+                "name IN (" + ", ".join(f":name{i}" for i in range(len(names))) + ")"
+            )
+            params.update((f"name{i}", name) for i, name in enumerate(names))
+
+        rows = self._select(
+            "valid_from, valid_to, name, category",
+            order_by=query.ordering,
+            limit=query.max_results,
+            where=" AND ".join(f"({c})" for c in conditions),
+            where_params=params,
+        )
+        tags: Iterable[Tag] = (self._tag_from_row(row) for row in rows)
+
+        window = query.window
+        rules = [r for r in self._iter_recurring() if query.matches(r)]
+        if rules:
+            occurrences = filter(
+                query.matches,
+                self._occurrences(rules, window.begins_at, window.finish_at),
+            )
+            if query.ordering is None:
+                tags = itertools.chain(tags, occurrences)
+            else:
+                tags = heapq.merge(tags, occurrences, key=_order_key)
+        return itertools.islice(tags, query.max_results)
+
+    def search(self, text: str, within: Optional[Span] = None) -> Iterable[Tag]:
+        """Tags whose names (or metadata, in a SqliteMetaTimeSpan) contain
+        every word of `text`, in time order.
+
+        Words are matched whole and case insensitively, through a full-text
+        index that is created on the first search and kept up to date after.
+        `within` limits the results to the tags overlapping it.
+        """
+        words = _words(text)
+        if not words:
+            return iter(())
+        self._ensure_search_index()
+
+        params: Dict[str, Any] = {
+            "search": " ".join(f'"{word}"' for word in sorted(words))
+        }
+        begins_at = None if within is None else within.begins_at
+        finish_at = None if within is None else within.finish_at
+        conditions = self._overlapping(begins_at, finish_at, params)
+        conditions.append(
+            "rowid IN (SELECT rowid FROM tags_fts WHERE tags_fts MATCH :search)"
+        )
+        rows = self._select(
+            "valid_from, valid_to, name, category",
+            order_by="valid_from",
+            where=" AND ".join(f"({c})" for c in conditions),
+            where_params=params,
+        )
+        tags: Iterable[Tag] = (self._tag_from_row(row) for row in rows)
+
+        rules = [r for r in self._iter_recurring() if words <= _words(r.name)]
+        if rules:
+            occurrences = self._occurrences(rules, begins_at, finish_at)
+            tags = heapq.merge(tags, occurrences, key=_order_key)
+        return tags
+
+    def _ensure_search_index(self) -> None:
+        if self._has_search_index:
+            return
+        columns = ", ".join(self._SEARCH_COLUMNS)
+        old = ", ".join(f"old.{column}" for column in self._SEARCH_COLUMNS)
+        new = ", ".join(f"new.{column}" for column in self._SEARCH_COLUMNS)
+        with self._sqlite_db:
+            conn = self._sqlite_db.cursor()
+            # It may have come along with a file that was read in
+            if not conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'tags_fts'"
+            ).fetchall():
+                # An external content table, which indexes tags without
+                # storing a second copy of them.
+                conn.execute(
+                    f"""
+                    CREATE VIRTUAL TABLE tags_fts USING fts5(
+                        {columns}, content='tags', content_rowid='rowid'
+                    );
+                    CREATE TRIGGER tags_fts_insert AFTER INSERT ON tags BEGIN
+                        INSERT INTO tags_fts (rowid, {columns})
+                        VALUES (new.rowid, {new});
+                    END;
+                    CREATE TRIGGER tags_fts_delete AFTER DELETE ON tags BEGIN
+                        INSERT INTO tags_fts (tags_fts, rowid, {columns})
+                        VALUES ('delete', old.rowid, {old});
+                    END;
+                    CREATE TRIGGER tags_fts_update AFTER UPDATE ON tags BEGIN
+                        INSERT INTO tags_fts (tags_fts, rowid, {columns})
+                        VALUES ('delete', old.rowid, {old});
+                        INSERT INTO tags_fts (rowid, {columns})
+                        VALUES (new.rowid, {new});
+                    END;
+                    INSERT INTO tags_fts (tags_fts) VALUES ('rebuild');
+                    """
+                )
+        self._has_search_index = True
 
     def filter(self, category: Union["Category", str]) -> "BaseTimeSpan":
         if isinstance(category, str):
             category = self._category_pool.get_category(category)
 
-        return SqliteTimeSpan(tags=[t for t in self.iter_tags() if t in category])
+        # Recurring tags are carried over as rules, without expanding them.
+        stored = itertools.chain(self._iter_concrete(), self._iter_recurring())
+        return SqliteTimeSpan(
+            tags=[t for t in stored if t in category], memory_budget=self._memory_budget
+        )
+
+    def filter_many(
+        self, categories: Iterable[Union["Category", str]]
+    ) -> Dict[Union["Category", str], "BaseTimeSpan"]:
+        targets, routed = self._filter_targets(categories)
+        if targets:
+            # One row per tag, with the positions of the targets containing it
+            ordered = list(targets)
+            wanted = ", ".join(f"({i}, :path{i})" for i in range(len(ordered)))
+            params = {f"path{i}": c.fullpath for i, c in enumerate(ordered)}
+            query = f"""
+            WITH wanted(i, path) AS (VALUES {wanted})
+            SELECT valid_from, valid_to, name, category, group_concat(i)
+            FROM tags JOIN wanted ON category = path
+                OR (category > path || '/' AND category < path || '0')
+            GROUP BY tags.rowid
+            """
+            with self._sqlite_db:
+                for row in self._sqlite_db.cursor().execute(query, params):
+                    tag = self._tag_from_row(row)
+                    for i in row[4].split(","):
+                        for key in targets[ordered[int(i)]]:
+                            routed[key].append(tag)
+            # Recurring tags are carried over as rules, as in `filter`.
+            _route(self._iter_recurring(), targets, routed)
+
+        return {
+            key: SqliteTimeSpan(tags=tags, memory_budget=self._memory_budget)
+            for key, tags in routed.items()
+        }
 
     def reslice(
         self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
@@ -273,7 +1756,7 @@ class SqliteTimeSpan(InsertableTimeSpan, RemovableTimeSpan, WriteableTimeSpan):
         query_parts = [tag_is_infinite]
 
         if begins_at is None and finish_at is None:
-            return SqliteTimeSpan(self.iter_tags())
+            return SqliteTimeSpan(self.iter_tags(), self._memory_budget)
 
         elif begins_at is None:
             query_parts += ["(valid_from IS NULL OR valid_from <= :finish_at)"]
@@ -292,29 +1775,29 @@ class SqliteTimeSpan(InsertableTimeSpan, RemovableTimeSpan, WriteableTimeSpan):
             conn = self._sqlite_db.cursor()
             result = conn.execute(
                 query,
-                {
-                    "begins_at": begins_at.astimezone(tzutc()).isoformat()
-                    if begins_at is not None
-                    else None,
-                    "finish_at": finish_at.astimezone(tzutc()).isoformat()
-                    if finish_at is not None
-                    else None,
-                },
+                {"begins_at": _sql_time(begins_at), "finish_at": _sql_time(finish_at)},
             )
             for row in result:
                 tags.append(self._tag_from_row(row))
 
-        return SqliteTimeSpan(tags=tags)
+        tags.extend(self._occurrences(self._iter_recurring(), begins_at, finish_at))
+        return SqliteTimeSpan(tags=tags, memory_budget=self._memory_budget)
 
     @property
     def span(self) -> "Span":
         with self._sqlite_db:
             conn = self._sqlite_db.cursor()
-            result = conn.execute("SELECT min(valid_from), max(valid_to) FROM tags")
+            result = conn.execute(
+                """
+                SELECT min(valid_from), max(valid_to) FROM (
+                    SELECT valid_from, valid_to FROM tags
+                    UNION ALL
+                    SELECT valid_from, valid_to FROM recurring
+                )
+                """
+            )
             earliest, latest = result.fetchone()
-            begins_at = None if earliest is None else date_parse(earliest)
-            finish_at = None if latest is None else date_parse(latest)
-            return Span(begins_at, finish_at)
+            return Span(_sql_time_from(earliest), _sql_time_from(latest))
 
     def has_tag(self, tag: Tag) -> bool:
         with self._sqlite_db:
@@ -330,30 +1813,29 @@ class SqliteTimeSpan(InsertableTimeSpan, RemovableTimeSpan, WriteableTimeSpan):
             result = conn.execute(
                 query,
                 {
-                    "valid_to": tag.valid_to.astimezone(tzutc()).isoformat()
-                    if tag.valid_to is not None
-                    else None,
-                    "valid_from": tag.valid_from.astimezone(tzutc()).isoformat()
-                    if tag.valid_from is not None
-                    else None,
+                    "valid_to": _sql_time(tag.valid_to),
+                    "valid_from": _sql_time(tag.valid_from),
                     "category": tag.category.fullpath if tag.category else None,
                 },
             )
             row = result.fetchone()
             # We could do consistency checking here - there SHOULD be
             # only one, ever, but we could check...
-            return row[0] > 0
+            if row[0] > 0:
+                return True
+
+        return any(
+            occurrence == tag
+            for recurring in self._iter_recurring()
+            for occurrence in recurring.occurrences(tag.valid_from, tag.valid_from)
+        )
 
     # TODO - do better than 'any' here please
     def _tag_from_row(self, row: Any) -> Tag:
         category = self._category_pool.get_category(row[3])
         return Tag(
-            valid_from=None
-            if row[0] is None
-            else dt.datetime.fromisoformat(row[0]).replace(tzinfo=tzutc()),
-            valid_to=None
-            if row[1] is None
-            else dt.datetime.fromisoformat(row[1]).replace(tzinfo=tzutc()),
+            valid_from=_sql_time_from(row[0]),
+            valid_to=_sql_time_from(row[1]),
             name=row[2],
             category=category,
         )
@@ -372,16 +1854,111 @@ class SqliteTimeSpan(InsertableTimeSpan, RemovableTimeSpan, WriteableTimeSpan):
         new_timespan = SqliteTimeSpan()
         with new_timespan._sqlite_db.backup("main", file_db, "main") as backup:
             backup.step()  # This can be split in to chunks if need be
+        new_timespan._restore()
         return new_timespan
 
+    def _restore(self) -> None:
+        """Bring a store written earlier (perhaps by an older version) up to
+        date, and rebuild what is kept in memory alongside it."""
+        with self._sqlite_db:
+            # Files written before recurring tags were supported lack the table
+            self._create_recurring_table(self._sqlite_db.cursor())
+        self._migrate_times()
+        self._migrate_timezones()
+        with self._sqlite_db:
+            categories = list(
+                self._sqlite_db.cursor().execute(
+                    "SELECT category FROM tags UNION SELECT category FROM recurring"
+                )
+            )
+        for (category,) in categories:
+            self._category_pool.get_category(category, create=True)
+        self._measure_max_duration()
+        self._rebuild_fingerprint()
+
+    def _migrate_times(self) -> None:
+        """Convert times stored as ISO strings, by older versions, to integer
+        UTC microseconds."""
+        with self._sqlite_db:
+            conn = self._sqlite_db.cursor()
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+            for table in ("tags", "recurring", "journal"):
+                if table not in tables:
+                    continue
+                rows = list(
+                    conn.execute(
+                        f"""
+                        SELECT rowid, valid_from, valid_to FROM {table}
+                        WHERE typeof(valid_from) = 'text' OR typeof(valid_to) = 'text'
+                        """
+                    )
+                )
+                conn.executemany(
+                    f"UPDATE {table} SET valid_from = ?, valid_to = ? WHERE rowid = ?",
+                    (
+                        (_legacy_time(start), _legacy_time(finish), rowid)
+                        for rowid, start, finish in rows
+                    ),
+                )
+
+    def _migrate_timezones(self) -> None:
+        """Add the timezone column of recurring tags to files from older
+        versions, whose rules are then expanded in UTC as they were before."""
+        with self._sqlite_db:
+            conn = self._sqlite_db.cursor()
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+            for table in ("recurring", "journal"):
+                if table not in tables:
+                    continue
+                info = conn.execute(f"PRAGMA table_info({table})")
+                columns = {row[1] for row in info}
+                if "timezone" not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN timezone text")
+            if "journal" in tables:
+                # Journal the new column too
+                for event in ("insert", "delete"):
+                    conn.execute(f"DROP TRIGGER IF EXISTS journal_recurring_{event}")
+        if "journal" in tables:
+            self.enable_journal()
+
+    def _measure_max_duration(self) -> None:
+        """Recompute `_max_duration` from the stored tags, eg. after a restore."""
+        with self._sqlite_db:
+            conn = self._sqlite_db.cursor()
+            unbounded, longest = list(
+                conn.execute(
+                    """
+                    SELECT
+                        sum(valid_from IS NULL OR valid_to IS NULL),
+                        max(valid_to - valid_from)
+                    FROM tags
+                    """
+                )
+            )[0]
+        if unbounded:
+            self._max_duration = None
+        else:
+            self._max_duration = dt.timedelta(microseconds=longest or 0)
+
+
+# The columns a MetaTag is read from. The last is whether it is an IDTag.
+_METATAG_COLUMNS = """
+    valid_from, valid_to, name, category, metadata,
+    CASE WHEN metadata = '' THEN 0 ELSE json_type(metadata, '$.id') IS NOT NULL END
+"""
+
 
 class SqliteMetaTimeSpan(SqliteTimeSpan):
+    _SEARCH_COLUMNS = ("name", "metadata")
+
     def __init__(
         self,
         tags: Optional[Iterable[Tag]] = None,
         metatags: Optional[Iterable[MetaTag]] = None,
+        memory_budget: Optional[int] = None,
     ) -> None:
-        super().__init__(tags)
+        self._has_id_index = False
+        super().__init__(tags, memory_budget)
         if metatags:
             for tag in metatags:
                 self.insert_metatag(tag)
@@ -405,35 +1982,47 @@ class SqliteMetaTimeSpan(SqliteTimeSpan):
         )
 
     def insert_metatag(self, tag: MetaTag) -> None:
+        self._insert_concrete([tag])
+        self._check_budget()
+        self._notify_inserted([tag])
+
+    def _insert_concrete(self, tags: Iterable[Tag]) -> None:
         with self._sqlite_db:
             conn = self._sqlite_db.cursor()
-            category_str = tag.category.fullpath if tag.category else "sqlite3"
-            category = self._category_pool.get_category(category_str, create=True)
-            conn.execute(
+            conn.executemany(
                 """
                 INSERT INTO
                 tags (valid_from, valid_to, name, category, metadata)
                 VALUES (:valid_from, :valid_to, :name, :category, :metadata)
                 """,
-                {
-                    "valid_from": tag.valid_from.astimezone(tzutc()).isoformat()
-                    if tag.valid_from
-                    else None,
-                    "valid_to": tag.valid_to.astimezone(tzutc()).isoformat()
-                    if tag.valid_to
-                    else None,
-                    "name": tag.name,
-                    "category": category.fullpath,
-                    "metadata": json.dumps(tag.data),
-                },
+                (
+                    {
+                        **self._tag_params(tag),
+                        "metadata": encode_data(tag.data)
+                        if isinstance(tag, MetaTag)
+                        else "",
+                    }
+                    for tag in tags
+                ),
             )
 
+    def compact(
+        self,
+        gap_tolerance: dt.timedelta = dt.timedelta(0),
+        archive_before: Optional[dt.datetime] = None,
+    ) -> None:
+        """Compact this timespan in place, keeping the metadata of the tags
+        that are merged. See the module-level `compact`."""
+        self._compact(
+            self.iter_metatags(order_by="valid_from"), gap_tolerance, archive_before
+        )
+
     def reslice(
         self, begins_at: Optional[dt.datetime], finish_at: Optional[dt.datetime]
     ) -> "BaseTimeSpan":
         tags: List[MetaTag] = []
-        query_start = """
-        SELECT valid_from, valid_to, name, category, metadata
+        query_start = f"""
+        SELECT {_METATAG_COLUMNS}
         FROM tags
         WHERE
         """
@@ -442,7 +2031,7 @@ class SqliteMetaTimeSpan(SqliteTimeSpan):
         query_parts = [tag_is_infinite]
 
         if begins_at is None and finish_at is None:
-            return type(self)(self.iter_tags())
+            return type(self)(self.iter_tags(), memory_budget=self._memory_budget)
 
         elif begins_at is None:
             query_parts += ["(valid_from IS NULL OR valid_from <= :finish_at)"]
@@ -461,30 +2050,197 @@ class SqliteMetaTimeSpan(SqliteTimeSpan):
             conn = self._sqlite_db.cursor()
             result = conn.execute(
                 query,
-                {
-                    "begins_at": begins_at.astimezone(tzutc()).isoformat()
-                    if begins_at is not None
-                    else None,
-                    "finish_at": finish_at.astimezone(tzutc()).isoformat()
-                    if finish_at is not None
-                    else None,
-                },
+                {"begins_at": _sql_time(begins_at), "finish_at": _sql_time(finish_at)},
             )
             for row in result:
                 tags.append(self._metatag_from_row(row))
 
-        return type(self)(metatags=tags)
+        occurrences = self._occurrences(self._iter_recurring(), begins_at, finish_at)
+        return type(self)(
+            tags=occurrences, metatags=tags, memory_budget=self._memory_budget
+        )
 
-    def iter_metatags(self) -> Iterable[MetaTag]:
+    def iter_metatags(
+        self,
+        order_by: Optional[str] = None,
+        after: Optional[Tag] = None,
+        limit: Optional[int] = None,
+    ) -> Iterable[MetaTag]:
+        for row in self._select(_METATAG_COLUMNS, order_by, after, limit):
+            yield self._metatag_from_row(row)
+
+    def get_by_id(self, tag_id: Any) -> Optional[MetaTag]:
+        """The MetaTag (eg. IDTag) with this "id" in its metadata, if any.
+
+        The first lookup creates an index on the ids, which is then kept up to
+        date (and written out) along with the table."""
         with self._sqlite_db:
-            cursor = self._sqlite_db.cursor()
-            result = cursor.execute(
-                "SELECT valid_from, valid_to, name, category, metadata FROM tags"
+            conn = self._sqlite_db.cursor()
+            if not self._has_id_index:
+                conn.execute(
+                    """
+                    CREATE INDEX IF NOT EXISTS tags_id_idx
+                    ON tags (json_extract(metadata, '$.id'))
+                    WHERE metadata != ''
+                    """
+                )
+                self._has_id_index = True
+            rows = list(
+                conn.execute(
+                    f"""
+                    SELECT {_METATAG_COLUMNS}
+                    FROM tags
+                    WHERE metadata != '' AND json_extract(metadata, '$.id') = :id
+                    LIMIT 1
+                    """,
+                    {"id": tag_id},
+                )
             )
-            for row in result:
-                yield self._metatag_from_row(row)
+        return self._metatag_from_row(rows[0]) if rows else None
 
     def _metatag_from_row(self, row: Any) -> MetaTag:
-        tag = self._tag_from_row(row[0:4])
-        data = json.loads(row[4]) if row[4] else {}
-        return MetaTag.from_tag(tag=tag, data=data)
+        # The metadata is only decoded if it is used (or has an id to check)
+        cls = IDTag if row[5] else MetaTag
+        return cls(
+            valid_from=_sql_time_from(row[0]),
+            valid_to=_sql_time_from(row[1]),
+            name=row[2],
+            category=self._category_pool.get_category(row[3]),
+            data=LazyData(row[4]),
+        )
+
+
+class ConcurrentSqliteTimeSpan(SqliteTimeSpan):
+    """A SqliteTimeSpan that may be shared between threads.
+
+    The database is a file in WAL mode (a temporary one, unless `path` is
+    given, which may be an existing store to reopen). Writes are serialized through a single writer connection, while
+    each reading thread gets its own read-only connection from a pool. In WAL
+    mode every read transaction sees a consistent snapshot, so long-running
+    iterators never block writers, nor see their changes part way through.
+    Use `snapshot()` to read several things from the same snapshot.
+    """
+
+    def __init__(
+        self, tags: Optional[Iterable[Tag]] = None, path: Optional[Path] = None
+    ) -> None:
+        self._temporary = path is None
+        if path is None:
+            fd, name = tempfile.mkstemp(prefix="hermes-", suffix=".sqlite")
+            os.close(fd)
+            path = Path(name)
+        self._path = path
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers: List[apsw.Connection] = []
+        with self._writing():
+            super().__init__()
+            if not self._temporary:
+                self._restore()
+            if tags:
+                self.insert_tags(tags)
+        weakref.finalize(
+            self, _close_pool, self._writer, self._readers, path, self._temporary
+        )
+
+    def _create_table(self, conn) -> None:
+        # Unless reopening an existing store
+        if not list(conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'tags'")):
+            super()._create_table(conn)
+
+    def _connect(self) -> apsw.Connection:
+        writer = apsw.Connection(str(self._path))
+        writer.setbusytimeout(5000)
+        writer.cursor().execute("PRAGMA journal_mode = WAL")
+        return writer
+
+    @property  # type: ignore
+    def _sqlite_db(self) -> apsw.Connection:
+        if getattr(self._local, "writing", 0):
+            return self._writer
+        return self._reader()
+
+    @_sqlite_db.setter
+    def _sqlite_db(self, connection: apsw.Connection) -> None:
+        self._writer = connection
+
+    def _reader(self) -> apsw.Connection:
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            reader = apsw.Connection(
+                str(self._path), flags=apsw.SQLITE_OPEN_READONLY
+            )
+            reader.setbusytimeout(5000)
+            self._local.reader = reader
+            with self._write_lock:
+                self._readers.append(reader)
+        return reader
+
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        with self._write_lock:
+            depth = getattr(self._local, "writing", 0)
+            self._local.writing = depth + 1
+            try:
+                yield
+            finally:
+                self._local.writing = depth
+
+    @contextmanager
+    def snapshot(self) -> Iterator[None]:
+        """Hold one read transaction open for this thread, so that every read
+        made inside the block sees the same snapshot."""
+        reader = self._reader()
+        with reader:
+            # The snapshot is taken by the first read, so make one now
+            reader.cursor().execute("SELECT 1 FROM tags LIMIT 1").fetchall()
+            yield
+
+    def _check_budget(self) -> None:
+        pass  # Already on disk
+
+    def _insert_tags(
+        self, params: Iterable[Dict[str, Any]], recurring: List[RecurringTag]
+    ) -> None:
+        with self._writing():
+            super()._insert_tags(params, recurring)
+
+    def remove_tag(self, tag: Tag) -> bool:
+        with self._writing():
+            return super().remove_tag(tag)
+
+    def compact(
+        self,
+        gap_tolerance: dt.timedelta = dt.timedelta(0),
+        archive_before: Optional[dt.datetime] = None,
+    ) -> None:
+        with self._writing():
+            super().compact(gap_tolerance, archive_before)
+
+    def _ensure_search_index(self) -> None:
+        with self._writing():
+            super()._ensure_search_index()
+
+    def enable_journal(self) -> int:
+        with self._writing():
+            return super().enable_journal()
+
+    def truncate_journal(self, seq: int) -> None:
+        with self._writing():
+            super().truncate_journal(seq)
+
+
+def _close_pool(
+    writer: apsw.Connection,
+    readers: List[apsw.Connection],
+    path: Path,
+    temporary: bool,
+) -> None:
+    for reader in readers:
+        reader.close()
+    writer.close()
+    if temporary:
+        for suffix in ("", "-wal", "-shm"):
+            leftover = Path(f"{path}{suffix}")
+            if leftover.exists():
+                leftover.unlink()
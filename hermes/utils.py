@@ -1,7 +1,91 @@
 import datetime as dt
+from functools import lru_cache
+import json
+import os
+from typing import Any, Optional, Union
 
+from dateutil.tz import gettz, tzlocal
+from dateutil.tz.tz import TZPATHS
 import pytz
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+# Instants are handled internally as aware UTC datetimes, and stored as
+# integer microseconds since the Unix epoch. Local time is only for display.
+UTC = dt.timezone.utc
+MICROS_PER_SECOND = 1_000_000
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=UTC)
+_MICROSECOND = dt.timedelta(microseconds=1)
+
 
 def get_now() -> dt.datetime:
     return dt.datetime.now(pytz.UTC).astimezone()
+
+
+def to_micros(when: dt.datetime) -> int:
+    """Integer microseconds since the epoch. Naive times are taken as local."""
+    if when.tzinfo is None:
+        when = when.astimezone()
+    return (when - _EPOCH) // _MICROSECOND
+
+
+def from_micros(micros: int) -> dt.datetime:
+    return _EPOCH + micros * _MICROSECOND
+
+
+def normalize(when: Optional[dt.datetime]) -> Optional[dt.datetime]:
+    """The canonical form of an instant: aware, and in `UTC`."""
+    if when is None or when.tzinfo is UTC:
+        return when
+    return when.astimezone(UTC)
+
+
+@lru_cache(maxsize=None)
+def local_timezone() -> dt.tzinfo:
+    return tzlocal()
+
+
+def to_local(when: dt.datetime) -> dt.datetime:
+    """Convert an instant to local time, for presentation."""
+    return when.astimezone(local_timezone())
+
+
+def zone_name(tzinfo: Optional[dt.tzinfo]) -> Optional[str]:
+    """The IANA name of a time zone, eg. to store it, or None if it hasn't one
+    that `gettz` would find again (such as a fixed offset)."""
+    if tzinfo is None:
+        return None
+    if tzinfo is UTC:
+        return "UTC"
+    # zoneinfo zones have a key and pytz ones a zone, while dateutil's only
+    # know the file they were read from.
+    name = getattr(tzinfo, "key", None) or getattr(tzinfo, "zone", None)
+    filename = getattr(tzinfo, "_filename", None)
+    if name is None and isinstance(filename, str):
+        name = filename
+        for path in TZPATHS:
+            if filename.startswith(path + os.sep):
+                name = filename[len(path) + 1 :]
+                break
+    if not isinstance(name, str) or gettz(name) is None:
+        return None
+    return name
+
+
+def json_dumps(value: Any) -> str:
+    """Encode JSON, with orjson if it is installed and can encode `value`."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode("utf-8")
+        except TypeError:
+            pass  # eg. non-string keys, which json converts
+    return json.dumps(value)
+
+
+def json_loads(encoded: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(encoded)
+    return json.loads(encoded)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+from multiprocessing import get_context
+from operator import attrgetter
+from pathlib import Path
+import tempfile
+
+from hermes.columnar import (
+    ColumnarTimeSpan,
+    encode_columns,
+    MappedTimeSpan,
+    SharedTimeSpan,
+    write_columnar,
+)
+from hermes.tag import RecurringTag, Tag
+from hermes.timespan import _order_key, TimeSpan
+import pytest
+
+
+def _count_active(name, when):
+    with SharedTimeSpan.attach(name) as shared:
+        return len(list(shared.active_at(when)))
+
+
+def test_columnar_timespan(complex_timespan_tags):
+    ordered = sorted(complex_timespan_tags, key=attrgetter("valid_from"))
+    unbounded = Tag("Forever", valid_from=None, valid_to=None)
+    columnar = ColumnarTimeSpan(encode_columns(ordered + [unbounded]))
+    assert len(columnar) == 5
+    assert list(columnar.iter_tags())[1:] == ordered
+    assert list(columnar.iter_tags(order_by="valid_from", after=ordered[1])) == (
+        ordered[2:]
+    )
+
+    t0 = ordered[0].valid_from
+    assert list(columnar.active_at(t0)) == [unbounded, ordered[0]]
+    assert list(columnar.next_after(t0, n=None)) == ordered[1:]
+    window = columnar.reslice(t0 + dt.timedelta(hours=1), t0 + dt.timedelta(hours=2))
+    assert window == TimeSpan({unbounded, *ordered[0:3]})
+    assert set(columnar.filter("A/B").iter_tags()) == set(ordered[1:3])
+    assert list(columnar.query().category("A/B/C")) == [ordered[2]]
+
+
+def test_shared_timespan(complex_timespan):
+    shared = SharedTimeSpan.publish(complex_timespan)
+    try:
+        attached = SharedTimeSpan.attach(shared.name)
+        assert set(attached.iter_tags()) == complex_timespan.tags
+        attached.close()
+
+        when = complex_timespan.span.begins_at + dt.timedelta(minutes=45)
+        with get_context("spawn").Pool(2) as pool:
+            assert pool.starmap(_count_active, [(shared.name, when)] * 2) == [2, 2]
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+def _overlapping(tags, begins_at, finish_at):
+    return {
+        t
+        for t in tags
+        if (t.valid_from or begins_at) <= finish_at
+        and (t.valid_to or finish_at) >= begins_at
+    }
+
+
+def test_mapped_timespan(sqlite_metatimespan, generic_span):
+    start = generic_span.begins_at
+    many = [
+        Tag(f"Tag {i % 7}", valid_from=start + dt.timedelta(minutes=i), valid_to=None)
+        if i % 100 == 0
+        else Tag(
+            f"Tag {i % 7}",
+            valid_from=start + dt.timedelta(minutes=i),
+            valid_to=start + dt.timedelta(minutes=i + 30),
+        )
+        for i in range(1000)
+    ]
+    many.append(Tag("Unbounded", valid_from=None, valid_to=start))
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir) / "archive.hcol"
+        write_columnar(many, path, block_size=64)
+        with pytest.raises(ValueError):
+            write_columnar(many, path)
+
+        mapped = MappedTimeSpan.read_from(path)
+        assert not mapped.has_metadata
+        assert list(mapped.iter_tags()) == sorted(many, key=_order_key)
+        when = start + dt.timedelta(minutes=500, seconds=1)
+        assert set(mapped.active_at(when)) == _overlapping(many, when, when)
+        finish = when + dt.timedelta(minutes=5)
+        resliced = mapped.reslice(when, finish)
+        assert resliced == TimeSpan(_overlapping(many, when, finish))
+        mapped.close()
+
+        meta_path = Path(tempdir) / "meta.hcol"
+        sqlite_metatimespan.insert_tag(
+            RecurringTag(
+                "Daily",
+                valid_from=start,
+                valid_to=start + dt.timedelta(days=2, hours=1),
+                recurrence="RRULE:FREQ=DAILY",
+                duration=dt.timedelta(hours=1),
+            )
+        )
+        write_columnar(sqlite_metatimespan, meta_path)
+        meta = MappedTimeSpan.read_from(meta_path)
+        assert meta.has_metadata
+        metatags = list(meta.iter_metatags())
+        assert [t for t in metatags if t.data] == sorted(
+            sqlite_metatimespan.iter_metatags(), key=_order_key
+        )
+        assert sorted(meta.iter_tags()) == sorted(sqlite_metatimespan.iter_tags())
+        copy_path = Path(tempdir) / "copy.hcol"
+        meta.write_to(copy_path)
+        copy = MappedTimeSpan.read_from(copy_path)
+        assert list(copy.iter_metatags()) == list(meta.iter_metatags())
+        copy.close()
+        meta.close()
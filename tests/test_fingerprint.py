@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+
+from hermes.fingerprint import Fingerprint
+from hermes.tag import Tag
+from hermes.timespan import SqliteTimeSpan, TimeSpan
+
+
+def test_fingerprint_matches_across_stores(complex_timespan_tags):
+    sqlite_fingerprint = SqliteTimeSpan(complex_timespan_tags).fingerprint
+    assert sqlite_fingerprint == TimeSpan(complex_timespan_tags).fingerprint
+    assert Fingerprint().root == 0
+
+
+def test_fingerprint_incremental(sqlite_timespan, complex_timespan):
+    before = complex_timespan.fingerprint
+    assert sqlite_timespan.fingerprint.differing_days(before) == []
+
+    later = sqlite_timespan.span.begins_at + dt.timedelta(days=40)
+    tag = Tag("Later", valid_from=later, valid_to=later + dt.timedelta(hours=1))
+    sqlite_timespan.insert_tag(tag)
+    assert sqlite_timespan.fingerprint != before
+    assert sqlite_timespan.fingerprint.differing_days(before) == [later.date()]
+    assert sqlite_timespan.fingerprint.day(later.date()) != 0
+
+    assert sqlite_timespan.remove_tag(tag)
+    assert not sqlite_timespan.remove_tag(tag)
+    assert sqlite_timespan.fingerprint == before
+    assert sqlite_timespan.fingerprint.day(later.date()) == 0
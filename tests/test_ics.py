@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import io
+
+from hermes.clients.ics import load_ics, read_ics, write_ics
+from hermes.tag import _parse_recurrence, Category, RecurringTag, Tag
+from hermes.timespan import SqliteTimeSpan, TimeSpan
+
+UTC = dt.timezone.utc
+
+SAMPLE = """BEGIN:VCALENDAR\r
+VERSION:2.0\r
+BEGIN:VEVENT\r
+UID:one\r
+DTSTART:20190101T090000Z\r
+DTEND:20190101T100000Z\r
+SUMMARY:Planning\\, mostly\r
+CATEGORIES:Work/Meetings\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:two\r
+DTSTART;TZID=America/Los_Angeles:20190102T090000\r
+DURATION:PT30M\r
+SUMMARY:Stand\r
+ up\r
+RRULE:FREQ=DAILY;COUNT=3\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:two\r
+RECURRENCE-ID;TZID=America/Los_Angeles:20190103T090000\r
+DTSTART;TZID=America/Los_Angeles:20190103T100000\r
+DTEND;TZID=America/Los_Angeles:20190103T103000\r
+SUMMARY:Standup (moved)\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+
+def test_read_ics():
+    tags = list(read_ics(io.StringIO(SAMPLE), category=Category("Imported")))
+    assert tags[0] == Tag(
+        "Planning, mostly",
+        category=Category("Meetings", Category("Work", Category("Imported"))),
+        valid_from=dt.datetime(2019, 1, 1, 9, tzinfo=UTC),
+        valid_to=dt.datetime(2019, 1, 1, 10, tzinfo=UTC),
+    )
+    assert tags[1].name == "Standup (moved)"
+    assert tags[1].valid_from == dt.datetime(2019, 1, 3, 18, tzinfo=UTC)
+
+    recurring = tags[2]
+    assert isinstance(recurring, RecurringTag)
+    assert recurring.name == "Standup"
+    starts = [t.valid_from for t in recurring.occurrences()]
+    assert starts == [
+        dt.datetime(2019, 1, 2, 17, tzinfo=UTC),
+        dt.datetime(2019, 1, 4, 17, tzinfo=UTC),
+    ]
+    assert recurring.valid_to == starts[-1] + dt.timedelta(minutes=30)
+
+
+def test_ics_round_trip():
+    timespan = load_ics(io.StringIO(SAMPLE), batch_size=1)
+    assert isinstance(timespan, SqliteTimeSpan)
+    assert len(timespan) == 4
+
+    exported = io.StringIO()
+    assert write_ics(timespan, exported) == 3
+    lines = exported.getvalue().split("\r\n")
+    assert all(len(line.encode("utf-8")) <= 75 for line in lines)
+    # The recurrence is written in its own zone, to follow its DST
+    assert "DTSTART;TZID=America/Los_Angeles:20190102T090000" in lines
+    exported.seek(0)
+    restored = load_ics(exported)
+    assert sorted(restored.iter_tags()) == sorted(timespan.iter_tags())
+
+    # Long lines are folded by their length in octets, between characters
+    start = dt.datetime(2019, 1, 1, 9, tzinfo=UTC)
+    snowmen = Tag("☃" * 40, valid_from=start, valid_to=start + dt.timedelta(hours=1))
+    folded = io.StringIO()
+    write_ics(TimeSpan([snowmen]), folded)
+    lines = folded.getvalue().split("\r\n")
+    assert all(len(line.encode("utf-8")) <= 75 for line in lines)
+    folded.seek(0)
+    assert list(read_ics(folded)) == [snowmen]
+
+    # Any timespan can be written, with its recurrences expanded
+    plain = io.StringIO()
+    assert write_ics(TimeSpan(timespan.iter_tags()), plain) == 4
+
+
+def test_stored_recurrence_keeps_its_zone():
+    weekly = """BEGIN:VCALENDAR\r
+BEGIN:VEVENT\r
+UID:weekly\r
+DTSTART;TZID=America/Los_Angeles:20190301T090000\r
+DURATION:PT1H\r
+SUMMARY:Weekly\r
+RRULE:FREQ=WEEKLY;COUNT=3\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+    timespan = load_ics(io.StringIO(weekly))
+    # Forget the rule parsed while loading, so it's expanded from the store
+    _parse_recurrence.cache_clear()
+    # 9am in Los Angeles, either side of the change to daylight saving time
+    assert [t.valid_from for t in timespan.iter_tags()] == [
+        dt.datetime(2019, 3, 1, 17, tzinfo=UTC),
+        dt.datetime(2019, 3, 8, 17, tzinfo=UTC),
+        dt.datetime(2019, 3, 15, 16, tzinfo=UTC),
+    ]
+
+
+def test_nested_components():
+    with_alarm = """BEGIN:VCALENDAR\r
+BEGIN:VEVENT\r
+UID:alarmed\r
+DTSTART:20190101T090000Z\r
+BEGIN:VALARM\r
+ACTION:EMAIL\r
+SUMMARY:Alarm email subject\r
+DURATION:PT15M\r
+TRIGGER:-PT30M\r
+END:VALARM\r
+SUMMARY:Planning\r
+DTEND:20190101T100000Z\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+    # The alarm's properties are its own, not the event's
+    assert list(read_ics(io.StringIO(with_alarm))) == [
+        Tag(
+            "Planning",
+            valid_from=dt.datetime(2019, 1, 1, 9, tzinfo=UTC),
+            valid_to=dt.datetime(2019, 1, 1, 10, tzinfo=UTC),
+        )
+    ]
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+from pathlib import Path
+import tempfile
+
+import apsw
+from hermes.multistore import MultiStore
+from hermes.span import Span
+from hermes.tag import Category, RecurringTag, Tag
+from hermes.timespan import SqliteTimeSpan
+import pytest
+
+START = dt.datetime(2019, 6, 3, 9, tzinfo=dt.timezone.utc)
+HOUR = dt.timedelta(hours=1)
+
+
+def _tags(category: str, hours):
+    return [
+        Tag(
+            f"{category} {i}",
+            category=Category(category),
+            valid_from=START + i * HOUR,
+            valid_to=START + (i + length) * HOUR,
+        )
+        for i, length in hours
+    ]
+
+
+def test_multistore():
+    work = _tags("Work", [(0, 2), (4, 1)])
+    home = _tags("Home", [(1, 1), (2, 2), (5, 1)])
+    daily = RecurringTag(
+        "Standup",
+        category=Category("Work"),
+        valid_from=START,
+        valid_to=START + dt.timedelta(days=2),
+        recurrence="RRULE:FREQ=DAILY",
+        duration=HOUR / 4,
+    )
+    with tempfile.TemporaryDirectory() as tempdir:
+        home_file = Path(tempdir) / "home.sqlite"
+        SqliteTimeSpan(home).write_to(home_file)
+        store = MultiStore(
+            work=SqliteTimeSpan(work + [daily]),
+            home=home_file,
+            shared=SqliteTimeSpan([daily]),
+        )
+        with pytest.raises(ValueError):
+            store.attach("main", SqliteTimeSpan())
+
+        assert list(store.overlaps("work", "home")) == [(work[0], home[0])]
+        assert list(store.conflicts()) == [("home", home[0], "work", work[0])]
+
+        assert store.tabulate() == {
+            "work": {"Work": 3 * HOUR},
+            "home": {"Home": 4 * HOUR},
+            "shared": {},
+        }
+        within = Span(START + HOUR, START + 3 * HOUR)
+        assert store.tabulate(within)["home"] == {"Home": 2 * HOUR}
+
+        combined = store.combine()
+        store.close()
+    assert sorted(combined.iter_tags()) == sorted(
+        work + home + list(daily.occurrences())
+    )
+    assert len(list(combined._iter_recurring())) == 1
+    assert combined.fingerprint.root != 0
+    assert combined.active_at(START + HOUR * 5.5) == [home[2]]
+
+
+def test_multistore_legacy_file():
+    with tempfile.TemporaryDirectory() as tempdir:
+        legacy_file = Path(tempdir) / "legacy.sqlite"
+        SqliteTimeSpan(_tags("Home", [(0, 1)])).write_to(legacy_file)
+        # Older versions stored times as ISO strings
+        conn = apsw.Connection(str(legacy_file))
+        with conn:
+            conn.execute("UPDATE tags SET valid_from = '2019-06-03T09:00:00+00:00'")
+        conn.close()
+        store = MultiStore()
+        with pytest.raises(ValueError):
+            store.attach("legacy", legacy_file)
+        assert store.aliases == []
+
+        SqliteTimeSpan.read_from(legacy_file).write_to(Path(tempdir) / "new.sqlite")
+        store.attach("new", Path(tempdir) / "new.sqlite")
+        assert store.tabulate() == {"new": {"Home": HOUR}}
+        store.close()
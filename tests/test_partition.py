@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+from pathlib import Path
+import tempfile
+
+from hermes.partition import PartitionedTimeSpan, yearly
+from hermes.tag import Category, Tag
+import pytest
+
+
+def _monthly_tags():
+    start = dt.datetime(2019, 1, 15, 9, tzinfo=dt.timezone.utc)
+    return [
+        Tag(
+            f"Month {i}",
+            category=Category("Monthly"),
+            valid_from=start + dt.timedelta(days=31 * i),
+            valid_to=start + dt.timedelta(days=31 * i, hours=1),
+        )
+        for i in range(6)
+    ]
+
+
+def test_partition_pruning(complex_timespan_tags):
+    tags = _monthly_tags()
+    timespan = PartitionedTimeSpan(tags)
+    assert sorted(timespan.partitions) == [
+        "2019-01",
+        "2019-02",
+        "2019-03",
+        "2019-04",
+        "2019-05",
+        "2019-06",
+    ]
+    assert len(timespan) == 6
+    assert list(timespan.iter_tags(order_by="valid_from")) == tags
+    assert timespan.span.begins_at == tags[0].valid_from
+
+    window = (tags[2].valid_from, tags[3].valid_to)
+    assert timespan._pruned(*window) == ["2019-03", "2019-04"]
+    assert sorted(timespan.reslice(*window).partitions) == ["2019-03", "2019-04"]
+    assert list(timespan.query().between(*window).order_by("valid_from")) == tags[2:4]
+    assert list(timespan.active_at(tags[1].valid_from)) == [tags[1]]
+    assert list(timespan.next_after(tags[1].valid_from, n=2)) == tags[2:4]
+
+    by_year = PartitionedTimeSpan(complex_timespan_tags, partition_key=yearly)
+    assert list(by_year.partitions) == ["2018"]
+    assert len(by_year.filter("A/B")) == 2
+
+
+def test_partition_freeze():
+    tags = _monthly_tags()
+    timespan = PartitionedTimeSpan(tags)
+    assert timespan.freeze(tags[2].valid_from) == ["2019-01", "2019-02"]
+    assert timespan.freeze(tags[2].valid_from) == []
+    with pytest.raises(ValueError):
+        timespan.insert_tag(tags[0])
+    with pytest.raises(ValueError):
+        timespan.remove_tag(tags[1])
+    timespan.remove_tag(tags[5])
+    assert len(timespan) == 5
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        timespan.write_to(Path(tempdir) / "store")
+        restored = PartitionedTimeSpan.read_from(Path(tempdir) / "store")
+    assert restored.frozen == {"2019-01", "2019-02"}
+    assert list(restored.iter_tags(order_by="valid_from")) == tags[:5]
+    assert restored._pruned(tags[3].valid_from, None) == ["2019-04", "2019-05"]
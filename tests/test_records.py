@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import io
+
+from dateutil.tz import gettz
+from hermes.clients.records import (
+    insert_batched,
+    read_csv,
+    read_jsonl,
+    stored_tags,
+    write_csv,
+    write_jsonl,
+)
+from hermes.tag import _parse_recurrence, RecurringTag
+from hermes.timespan import SqliteTimeSpan
+import pytest
+
+
+@pytest.mark.parametrize(
+    "writer,reader", [(write_jsonl, read_jsonl), (write_csv, read_csv)]
+)
+def test_records_round_trip(sqlite_timespan, writer, reader):
+    start = sqlite_timespan.span.begins_at
+    sqlite_timespan.insert_tag(
+        RecurringTag(
+            "Daily",
+            valid_from=start,
+            valid_to=start + dt.timedelta(days=3, hours=1),
+            recurrence="RRULE:FREQ=DAILY",
+            duration=dt.timedelta(hours=1),
+        )
+    )
+    stream = io.StringIO()
+    assert writer(stored_tags(sqlite_timespan), stream, chunk_size=2) == 5
+    stream.seek(0)
+
+    restored = SqliteTimeSpan()
+    assert insert_batched(restored, reader(stream), batch_size=3) == 5
+    assert sorted(restored.iter_tags()) == sorted(sqlite_timespan.iter_tags())
+    assert len(list(restored._iter_recurring())) == 1
+
+
+@pytest.mark.parametrize(
+    "writer,reader", [(write_jsonl, read_jsonl), (write_csv, read_csv)]
+)
+def test_records_keep_recurrence_zone(writer, reader):
+    weekly = RecurringTag(
+        "Weekly",
+        valid_from=dt.datetime(2019, 3, 1, 9, tzinfo=gettz("America/Los_Angeles")),
+        valid_to=dt.datetime(2019, 3, 16, tzinfo=dt.timezone.utc),
+        recurrence="RRULE:FREQ=WEEKLY",
+        duration=dt.timedelta(hours=1),
+    )
+    stream = io.StringIO()
+    writer([weekly], stream)
+    stream.seek(0)
+    (restored,) = reader(stream)
+    # Forget the rule parsed above, so it's expanded from the record's zone
+    _parse_recurrence.cache_clear()
+    assert list(restored.occurrences()) == list(weekly.occurrences())
+    assert len(list(restored.occurrences())) == 3
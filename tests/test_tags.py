@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import datetime as dt
+import json
 
+from dateutil.tz import gettz
 from hermes.categorypool import MutableCategoryPool
 from hermes.span import Span
-from hermes.tag import Category, MetaTag, Tag
+from hermes.tag import Category, encode_data, LazyData, MetaTag, RecurringTag, Tag
 from hermes.utils import get_now
 import pytest
 
@@ -76,6 +78,14 @@ def test_infinite_spans(complex_timespan):
     assert span1 in span2
     assert span1.duration == span2.duration
 
+    # Tags with open ends can be tested against aware spans
+    finish_at = complex_timespan.span.finish_at
+    assert Tag("Open", valid_from=None, valid_to=finish_at) in span2
+    assert Tag("Open", valid_from=finish_at, valid_to=None) in span2
+    assert Tag("Open", valid_from=finish_at, valid_to=None).span == Span(
+        finish_at, None
+    )
+
 
 @pytest.mark.parametrize(
     "path", ["☃", "/", " /foo", "/bar", "  ", "  //  / /", "\\ ", "\\"]
@@ -142,3 +152,64 @@ def test_meta_tag_equality(generic_span):
     assert t1 != t2
     assert "biff" not in t1.data
     assert "foo" not in t2.data
+
+
+def test_meta_tag_lazy_data(generic_span):
+    tag = Tag.from_span(generic_span, name="example tag")
+    data = LazyData('{"foo": "bar"}')
+    mtag = MetaTag.from_tag(tag, data)
+    copied = MetaTag.from_tag(mtag, {})
+    assert data._data is None and copied.data._data is None
+    assert encode_data(copied.data) == '{"foo": "bar"}'
+
+    assert mtag.data == {"foo": "bar"}
+    assert mtag == MetaTag.from_tag(tag, {"foo": "bar"})
+    mtag.data["biff"] = "boff"
+    assert "biff" not in copied.data
+    assert json.loads(encode_data(mtag.data)) == {"foo": "bar", "biff": "boff"}
+    assert LazyData("") == {}
+
+
+def test_recurring_tags(generic_span):
+    start = generic_span.begins_at.replace(microsecond=0)
+    daily = RecurringTag(
+        "Standup",
+        valid_from=start,
+        valid_to=start + dt.timedelta(days=10),
+        recurrence="RRULE:FREQ=DAILY;INTERVAL=2",
+        duration=dt.timedelta(minutes=15),
+    )
+    assert len(list(daily.occurrences())) == 5
+
+    window = list(
+        daily.occurrences(
+            start + dt.timedelta(days=2, minutes=5), start + dt.timedelta(days=4)
+        )
+    )
+    assert [t.valid_from for t in window] == [
+        start + dt.timedelta(days=2),
+        start + dt.timedelta(days=4),
+    ]
+    assert all(type(t) is Tag for t in window)
+
+    forever = RecurringTag("Forever", valid_from=start, recurrence="RRULE:FREQ=DAILY")
+    with pytest.raises(ValueError):
+        list(forever.occurrences())
+
+
+def test_recurring_tags_follow_their_zone():
+    # The same first occurrence, expanded in UTC and across a DST change
+    pacific = dt.datetime(2019, 3, 1, 9, tzinfo=gettz("America/Los_Angeles"))
+    utc = pacific.astimezone(dt.timezone.utc)
+
+    def utc_hours(dtstart):
+        weekly = RecurringTag(
+            "Weekly",
+            valid_from=dtstart,
+            valid_to=dtstart + dt.timedelta(days=15),
+            recurrence="RRULE:FREQ=WEEKLY;COUNT=3",
+        )
+        return [t.valid_from.astimezone(utc.tzinfo).hour for t in weekly.occurrences()]
+
+    assert utc_hours(utc) == [17, 17, 17]
+    assert utc_hours(pacific) == [17, 17, 16]
@@ -1,12 +1,40 @@
 # -*- coding: utf-8 -*-
+from dataclasses import replace
 import datetime as dt
 from operator import attrgetter
 import os
 from pathlib import Path
 import tempfile
+import threading
+import time
 
+import apsw
+from dateutil.parser import parse as dateutil_parse
+from dateutil.tz import gettz, tzoffset
 from hermes.span import Span
-from hermes.timespan import SqliteTimeSpan, TimeSpan, WriteableTimeSpan
+from hermes.tag import (
+    allocate_ids,
+    Category,
+    IDAllocator,
+    IDTag,
+    MetaTag,
+    RecurringTag,
+    Tag,
+)
+from hermes.timespan import (
+    CachedTimeSpan,
+    ConcurrentSqliteTimeSpan,
+    compact,
+    date_parse,
+    diff,
+    merge,
+    ReadOnlyTimeSpan,
+    SqliteMetaTimeSpan,
+    SqliteTimeSpan,
+    TimeSpan,
+    WriteableTimeSpan,
+)
+from hermes.utils import from_micros, normalize, to_micros, UTC
 import pytest
 
 from .conftest import GENERIC_RO_TIMESPANS
@@ -153,6 +181,42 @@ def test_query_by_category_filter(complex_timespan):
     assert len(complex_timespan.filter("Not A Tag")) == 0
 
 
+@pytest.mark.parametrize(
+    "generic_ro_timespan", GENERIC_RO_TIMESPANS.keys(), indirect=True
+)
+def test_filter_many(generic_ro_timespan):
+    start = generic_ro_timespan.span.begins_at
+    b_cat = generic_ro_timespan.category_pool.get_category("A/B")
+    wanted = ["A", "A/B", b_cat, "A/B/C", "Not A Tag"]
+    filtered = generic_ro_timespan.filter_many(wanted)
+    assert list(filtered) == wanted
+    for key in wanted:
+        assert sorted(filtered[key].iter_tags()) == sorted(
+            generic_ro_timespan.filter(key).iter_tags()
+        )
+    assert [len(filtered[key]) for key in wanted] == [4, 2, 2, 1, 0]
+    assert len(generic_ro_timespan.filter_many(["A", "A"])["A"]) == 4
+
+    if isinstance(generic_ro_timespan, SqliteTimeSpan):
+        # Recurring tags, and categories sharing a prefix ("A/B" and "A/Bee")
+        generic_ro_timespan.insert_tags(
+            [
+                RecurringTag(
+                    "Daily",
+                    category=b_cat,
+                    valid_from=start,
+                    valid_to=start + dt.timedelta(days=1, hours=1),
+                    recurrence="RRULE:FREQ=DAILY",
+                    duration=dt.timedelta(hours=1),
+                ),
+                Tag("Bee", category=Category("Bee", b_cat.parent), valid_from=start),
+            ]
+        )
+        filtered = generic_ro_timespan.filter_many(["A/B", "A"])
+        assert len(filtered["A/B"]) == 4
+        assert len(filtered["A"]) == 7
+
+
 def test_sqlite_backend(complex_timespan, sqlite_timespan):
     assert len(sqlite_timespan) == len(complex_timespan)
     assert (
@@ -195,12 +259,82 @@ def test_sqlite_writable(sqlite_timespan):
             if hack_filepath.exists():
                 os.unlink(str(hack_filepath))
     assert sorted(sqlite_timespan.iter_tags()) == sorted(new_span.iter_tags())
+    midpoint = sqlite_timespan.span.begins_at + dt.timedelta(hours=2)
+    assert new_span.active_at(midpoint) == sqlite_timespan.active_at(midpoint)
 
     with tempfile.NamedTemporaryFile() as tempf:
         with pytest.raises(ValueError):
             sqlite_timespan.write_to(Path(tempf.name))
 
 
+def test_sqlite_legacy_times(sqlite_timespan):
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = Path(tempdir) / "legacy.sqlite"
+        sqlite_timespan.write_to(filepath)
+        # Older versions stored times as UTC ISO strings
+        conn = apsw.Connection(str(filepath))
+        rows = list(conn.execute("SELECT rowid, valid_from, valid_to FROM tags"))
+        with conn:
+            for rowid, valid_from, valid_to in rows:
+                conn.execute(
+                    "UPDATE tags SET valid_from = ?, valid_to = ? WHERE rowid = ?",
+                    (from_micros(valid_from).isoformat(), valid_to, rowid),
+                )
+        conn.close()
+        new_span = SqliteTimeSpan.read_from(filepath)
+    assert sorted(new_span.iter_tags()) == sorted(sqlite_timespan.iter_tags())
+    assert new_span.span == sqlite_timespan.span
+
+
+def test_sqlite_legacy_recurring(generic_span):
+    start = generic_span.begins_at.replace(microsecond=0)
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = Path(tempdir) / "legacy.sqlite"
+        legacy = SqliteTimeSpan()
+        seq = legacy.enable_journal()
+        legacy.write_to(filepath)
+        # Older versions kept no time zone for recurring tags, nor journaled one
+        conn = apsw.Connection(str(filepath))
+        with conn:
+            conn.execute("DROP TRIGGER journal_recurring_insert")
+            conn.execute("DROP TRIGGER journal_recurring_delete")
+            for table in ("recurring", "journal"):
+                conn.execute(f"ALTER TABLE {table} DROP COLUMN timezone")
+            conn.execute(
+                "INSERT INTO recurring VALUES (?, ?, 'Daily', 'sqlite3', ?, 0)",
+                (
+                    to_micros(start),
+                    to_micros(start + dt.timedelta(days=2)),
+                    "RRULE:FREQ=DAILY",
+                ),
+            )
+        conn.close()
+        new_span = SqliteTimeSpan.read_from(filepath)
+    assert [t.valid_from for t in new_span.iter_tags()] == [
+        start,
+        start + dt.timedelta(days=1),
+        start + dt.timedelta(days=2),
+    ]
+
+    zoned = RecurringTag(
+        "Weekly",
+        valid_from=dt.datetime(2019, 3, 1, 9, tzinfo=gettz("America/Los_Angeles")),
+        valid_to=dt.datetime(2019, 3, 16, tzinfo=UTC),
+        recurrence="RRULE:FREQ=WEEKLY",
+    )
+    new_span.insert_tag(zoned)
+    ((_, _, journaled),) = new_span.changes_since(seq)
+    assert journaled.valid_from.utcoffset() == dt.timedelta(hours=-8)
+
+
+def test_utc_micros():
+    when = dt.datetime(2018, 4, 16, 6, 43, 15, 13, tzinfo=tzoffset(None, -25200))
+    assert from_micros(to_micros(when)) == when
+    assert from_micros(to_micros(when)).tzinfo is UTC
+    assert normalize(when) == when and normalize(when).tzinfo is UTC
+    assert to_micros(dt.datetime(1970, 1, 1, tzinfo=UTC)) == 0
+
+
 def test_sqlitemeta_data(sqlite_metatimespan):
     assert isinstance(sqlite_metatimespan, WriteableTimeSpan)
     data = {
@@ -212,3 +346,587 @@ def test_sqlitemeta_data(sqlite_metatimespan):
     assert data["☃"][3] == "snowman"
     assert data["foo"] == 10
     assert data["null"] is None
+
+
+def test_get_by_id(complex_timespan_tags):
+    ids = allocate_ids(len(complex_timespan_tags))
+    tags = [
+        IDTag.from_tag(tag, data={"id": tag_id})
+        for tag, tag_id in zip(complex_timespan_tags, ids)
+    ]
+    assert ids == sorted(ids) and IDTag(name="Later").id > ids[-1]
+
+    metatimespan = SqliteMetaTimeSpan(metatags=tags)
+    metatimespan.insert_tag(Tag("No metadata", valid_from=tags[0].valid_from))
+    for timespan in (TimeSpan(tags), metatimespan):
+        found = timespan.get_by_id(ids[2])
+        assert isinstance(found, IDTag) and found.id == ids[2]
+        assert MetaTag.from_tag(found, {}) == MetaTag.from_tag(tags[2], {})
+        assert timespan.get_by_id("missing") is None
+    metatags = list(metatimespan.iter_metatags())
+    assert sum(isinstance(t, IDTag) for t in metatags) == len(tags)
+    plan = metatimespan._sqlite_db.cursor().execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM tags"
+        " WHERE metadata != '' AND json_extract(metadata, '$.id') = 'x'"
+    )
+    assert "tags_id_idx" in str(list(plan))
+
+
+def test_id_allocators_dont_collide():
+    # Eg. in two processes, allocating in the same millisecond
+    first, second = IDAllocator(), IDAllocator()
+    assert set(first.allocate(1000)).isdisjoint(second.allocate(1000))
+
+    # Batches of ids (and ones taken singly) are in the order allocated
+    ids = [first.next_id(), *first.allocate(2), first.next_id(), first.next_id()]
+    assert ids == sorted(ids) and len(set(ids)) == 5
+    # Ids taken singly don't keep an earlier millisecond's time
+    before = first.next_id()
+    time.sleep(0.002)
+    assert int(first.next_id(), 16) >> 80 > int(before, 16) >> 80
+
+
+def test_sqlite_search(sqlite_timespan, generic_span):
+    start = generic_span.begins_at
+    hour = dt.timedelta(hours=1)
+    dentist = [
+        Tag(
+            "Dentist appointment",
+            valid_from=start + i * 30 * hour,
+            valid_to=start + (i * 30 + 1) * hour,
+        )
+        for i in range(3)
+    ]
+    dentist = [t.recategorize(sqlite_timespan._stored_category(t)) for t in dentist]
+    sqlite_timespan.insert_tags(dentist)
+    assert list(sqlite_timespan.search("dentist")) == dentist
+    plan = sqlite_timespan._sqlite_db.cursor().execute(
+        "EXPLAIN QUERY PLAN SELECT rowid FROM tags_fts WHERE tags_fts MATCH 'x'"
+    )
+    assert "VIRTUAL TABLE INDEX" in str(list(plan))
+
+    # The index follows later changes
+    sqlite_timespan.remove_tag(dentist[0])
+    weekly = RecurringTag(
+        "Weekly dentist",
+        category=dentist[0].category,
+        valid_from=start,
+        valid_to=start + dt.timedelta(weeks=2, hours=1),
+        recurrence="RRULE:FREQ=WEEKLY",
+        duration=hour,
+    )
+    sqlite_timespan.insert_tag(weekly)
+    within = Span(start + hour, start + 40 * hour)
+    assert list(sqlite_timespan.search("APPOINTMENT dentist", within)) == dentist[1:2]
+    assert [t.name for t in sqlite_timespan.search("dentist")] == [
+        "Weekly dentist",
+        "Dentist appointment",
+        "Dentist appointment",
+        "Weekly dentist",
+        "Weekly dentist",
+    ]
+    assert list(sqlite_timespan.search("dentist surgery")) == []
+    assert list(sqlite_timespan.search(" ")) == []
+
+
+def test_merge(complex_timespan, sqlite_timespan):
+    # Overlapping subspans share a tag, which must only appear once.
+    accounts = list(sqlite_timespan.subspans(dt.timedelta(hours=2)))
+    merged = list(merge(*accounts))
+    assert merged == sorted(complex_timespan.tags, key=attrgetter("valid_from"))
+
+    bulk = SqliteTimeSpan()
+    bulk.insert_tags(merge(complex_timespan, sqlite_timespan))
+    assert sorted(bulk.iter_tags()) == sorted(complex_timespan.iter_tags())
+
+
+def test_merge_coalesce(generic_span):
+    hour = dt.timedelta(hours=1)
+    start = generic_span.begins_at
+    left = [
+        Tag("Work", valid_from=start, valid_to=start + hour),
+        Tag("Lunch", valid_from=start + hour, valid_to=start + 2 * hour),
+        Tag("Work", valid_from=start + 2 * hour, valid_to=start + 3 * hour),
+    ]
+    right = [
+        Tag("Work", valid_from=start + hour / 2, valid_to=start + hour),
+        Tag("Work", valid_from=start + 5 * hour, valid_to=start + 6 * hour),
+    ]
+
+    merged = list(merge(left, right, coalesce=True))
+    assert [t.name for t in merged] == ["Work", "Lunch", "Work", "Work"]
+    assert merged[0].valid_to == start + hour
+
+    merged = list(merge(left, right, coalesce=True, gap_tolerance=hour))
+    assert [t.name for t in merged] == ["Work", "Lunch", "Work"]
+    assert merged[0].valid_to == start + 3 * hour
+    assert merged == sorted(merged, key=attrgetter("valid_from"))
+
+
+def test_compact(generic_span):
+    hour = dt.timedelta(hours=1)
+    start = generic_span.begins_at
+    timespan = SqliteTimeSpan(
+        [
+            Tag("Import", valid_from=start, valid_to=start + hour),
+            Tag("Import", valid_from=start + hour, valid_to=start + 2 * hour),
+            Tag("Import", valid_from=start + 3 * hour, valid_to=start + 4 * hour),
+            Tag("Other", valid_from=start + hour, valid_to=start + 2 * hour),
+        ]
+    )
+    assert len(list(compact(timespan))) == 3
+    assert len(list(compact(timespan, gap_tolerance=hour))) == 2
+
+    timespan.compact(archive_before=start + 3 * hour)
+    tags = list(merge(timespan))
+    assert len(tags) == 2
+    assert tags[0].name.startswith("Archived")
+    assert (tags[0].valid_from, tags[0].valid_to) == (start, start + 2 * hour)
+    assert tags[1].name == "Import"
+
+
+def test_compact_metadata(generic_span):
+    hour = dt.timedelta(hours=1)
+    start = generic_span.begins_at
+    timespan = SqliteMetaTimeSpan(
+        metatags=[
+            MetaTag("Import", valid_from=start, valid_to=start + hour, data={"a": 1}),
+            MetaTag(
+                "Import",
+                valid_from=start + hour,
+                valid_to=start + 2 * hour,
+                data={"a": 2, "b": 2},
+            ),
+            MetaTag("Other", valid_from=start, valid_to=start + hour, data={"c": 3}),
+        ]
+    )
+    timespan.compact()
+    tags = list(timespan.iter_metatags(order_by="valid_from"))
+    assert [(t.name, t.data) for t in tags] == [
+        ("Other", {"c": 3}),
+        ("Import", {"a": 1, "b": 2}),
+    ]
+
+    timespan.compact(archive_before=start + 3 * hour)
+    (summary,) = timespan.iter_metatags()
+    assert summary.name.startswith("Archived")
+    assert summary.data == {"a": 1, "b": 2, "c": 3}
+
+
+@pytest.mark.parametrize(
+    "generic_ro_timespan", GENERIC_RO_TIMESPANS.keys(), indirect=True
+)
+def test_ordered_pagination(generic_ro_timespan, complex_timespan_tags):
+    expected = sorted(complex_timespan_tags, key=attrgetter("valid_from"))
+    assert list(generic_ro_timespan.iter_tags(order_by="valid_from")) == expected
+
+    pages = []
+    cursor = None
+    while True:
+        page = list(
+            generic_ro_timespan.iter_tags(order_by="valid_from", after=cursor, limit=3)
+        )
+        if not page:
+            break
+        pages.append(page)
+        cursor = page[-1]
+    assert [len(page) for page in pages] == [3, 1]
+    assert [t for page in pages for t in page] == expected
+
+    with pytest.raises(ValueError):
+        list(generic_ro_timespan.iter_tags(order_by="name"))
+    with pytest.raises(ValueError):
+        list(generic_ro_timespan.iter_tags(after=expected[0]))
+
+
+def test_open_ended_ordering(generic_span):
+    start = generic_span.begins_at.replace(microsecond=0)
+    hour = dt.timedelta(hours=1)
+    tags = [
+        Tag("Open", valid_from=start),
+        Tag("Closed", valid_from=start, valid_to=start + hour),
+        Tag("Before", valid_to=start),
+        Tag("Later", valid_from=start + hour),
+    ]
+    daily = RecurringTag(
+        "Daily",
+        valid_from=start + hour,
+        valid_to=start + 2 * hour,
+        recurrence="RRULE:FREQ=DAILY",
+        duration=hour,
+    )
+    expected = ["Before", "Closed", "Open", "Daily", "Later"]
+    # Recurring tags are merged in to the ordered rows by `_order_key`
+    for timespan in (TimeSpan(set(tags) | {daily}), SqliteTimeSpan(tags + [daily])):
+        ordered = list(timespan.iter_tags(order_by="valid_from"))
+        assert [t.name for t in ordered] == expected
+        resumed = timespan.iter_tags(order_by="valid_from", after=ordered[1])
+        assert [t.name for t in resumed] == expected[2:]
+
+
+@pytest.mark.parametrize(
+    "generic_ro_timespan", GENERIC_RO_TIMESPANS.keys(), indirect=True
+)
+def test_point_in_time_queries(generic_ro_timespan, complex_timespan_tags):
+    ordered = sorted(complex_timespan_tags, key=attrgetter("valid_from"))
+    begins_at = generic_ro_timespan.span.begins_at
+    for minutes in range(-30, 5 * 60, 15):
+        when = begins_at + dt.timedelta(minutes=minutes)
+        active = [t for t in ordered if t.valid_from <= when <= t.valid_to]
+        upcoming = [t for t in ordered if t.valid_from > when]
+        assert list(generic_ro_timespan.active_at(when)) == active
+        assert list(generic_ro_timespan.next_after(when)) == upcoming[:1]
+        assert list(generic_ro_timespan.next_after(when, n=None)) == upcoming
+
+
+@pytest.mark.parametrize(
+    "generic_ro_timespan", GENERIC_RO_TIMESPANS.keys(), indirect=True
+)
+def test_query(generic_ro_timespan, complex_timespan_tags):
+    ordered = sorted(complex_timespan_tags, key=attrgetter("valid_from"))
+    begins_at = generic_ro_timespan.span.begins_at
+    a, b = begins_at + dt.timedelta(hours=1), begins_at + dt.timedelta(hours=2)
+
+    query = generic_ro_timespan.query().order_by("valid_from")
+    assert list(query) == ordered
+    assert list(query.between(a, b)) == [t for t in ordered if t in Span(a, b)]
+    assert list(query.category("A/B")) == [
+        t for t in ordered if t.name in ("Tag B", "Tag C")
+    ]
+    assert list(query.category("A").category("A/B/C")) == [ordered[2]]
+    assert list(query.category("A/B").names("Tag A", "Tag B")) == [ordered[1]]
+    assert list(query.between(None, a).limit(5).limit(2)) == ordered[:2]
+    assert list(query.between(b, a)) == []
+    assert list(query.names("Tag D").names("Tag A")) == []
+
+
+@pytest.mark.parametrize("factory", GENERIC_RO_TIMESPANS.values())
+def test_recurring_timespans(factory, generic_span):
+    start = generic_span.begins_at.replace(microsecond=0)
+    daily = RecurringTag(
+        "Standup",
+        valid_from=start,
+        valid_to=start + dt.timedelta(days=7),
+        recurrence="RRULE:FREQ=DAILY",
+        duration=dt.timedelta(minutes=15),
+    )
+    lunch = Tag("Lunch", valid_from=start, valid_to=start + dt.timedelta(hours=1))
+    timespan = factory({daily, lunch})
+
+    assert len(timespan) == 8
+    window = timespan[start + dt.timedelta(days=2) : start + dt.timedelta(days=3)]
+    assert sorted(t.name for t in window.iter_tags()) == ["Standup", "Standup"]
+
+    first = list(timespan.iter_tags(order_by="valid_from", limit=3))
+    assert [t.name for t in first] == ["Standup", "Lunch", "Standup"]
+
+    later = timespan.query().order_by("valid_from").between(start, None).limit(3)
+    assert [t.name for t in later] == ["Standup", "Lunch", "Standup"]
+    assert len(list(timespan.query().names("Standup"))) == 7
+    assert [t.name for t in timespan.active_at(start)] == ["Standup", "Lunch"]
+    assert timespan.next_after(start)[0].valid_from == start + dt.timedelta(days=1)
+
+    # An occurrence also held as a concrete tag is only there once
+    first_standup = next(daily.occurrences())
+    doubled = factory({daily, lunch, first_standup})
+    assert len(doubled) == 8
+    assert sorted(doubled.iter_tags()) == sorted(timespan.iter_tags())
+    resliced = doubled.reslice(start, start + dt.timedelta(hours=1))
+    assert sorted(t.name for t in resliced.iter_tags()) == ["Lunch", "Standup"]
+    assert [t.name for t in doubled.active_at(start)] == ["Standup", "Lunch"]
+
+
+def test_unbounded_recurrences(generic_span):
+    start = generic_span.begins_at.replace(microsecond=0)
+    forever = RecurringTag("Forever", valid_from=start, recurrence="RRULE:FREQ=DAILY")
+    # A TimeSpan couldn't count or iterate over them
+    with pytest.raises(ValueError):
+        TimeSpan({forever})
+    bounded = replace(forever, valid_to=start + dt.timedelta(days=2))
+    assert len(TimeSpan({bounded})) == 3
+
+
+def test_sqlite_remove_occurrence(generic_span):
+    start = generic_span.begins_at.replace(microsecond=0)
+    daily = RecurringTag(
+        "Standup",
+        valid_from=start,
+        valid_to=start + dt.timedelta(days=3),
+        recurrence="RRULE:FREQ=DAILY",
+        duration=dt.timedelta(minutes=15),
+    )
+    timespan = SqliteTimeSpan([daily])
+    removed = []
+    timespan.subscribe(lambda is_insert, tag: removed.append(tag))
+
+    second = timespan.next_after(start)[0]
+    assert timespan.remove_tag(second)
+    assert removed == [second]
+    assert second not in list(timespan.iter_tags())
+    assert len(timespan) == 2
+    assert not timespan.remove_tag(second)
+
+
+def test_diff(complex_timespan, sqlite_timespan):
+    assert not diff(complex_timespan, sqlite_timespan)
+
+    tags = sorted(complex_timespan.tags, key=attrgetter("valid_from"))
+    moved = Tag(
+        tags[1].name,
+        category=tags[1].category,
+        valid_from=tags[1].valid_from,
+        valid_to=tags[1].valid_to + dt.timedelta(minutes=5),
+    )
+    extra = Tag("Extra", valid_from=tags[0].valid_from, valid_to=tags[0].valid_to)
+    changes = diff(tags, [tags[0], extra, moved, tags[3]])
+    assert changes
+    assert changes.added == [extra]
+    assert changes.removed == [tags[2]]
+    assert changes.changed == [(tags[1], moved)]
+
+
+def test_sqlite_journal(sqlite_timespan, generic_span):
+    seq = sqlite_timespan.enable_journal()
+    assert seq == 0
+    assert sqlite_timespan.enable_journal() == seq
+
+    start = generic_span.begins_at.replace(microsecond=0)
+    tag = Tag("New", valid_from=start, valid_to=start + dt.timedelta(hours=1))
+    daily = RecurringTag(
+        "Daily",
+        valid_from=start,
+        valid_to=start + dt.timedelta(days=3),
+        recurrence="RRULE:FREQ=DAILY",
+    )
+    sqlite_timespan.insert_tags([tag, daily])
+    sqlite_timespan.remove_tag(tag)
+
+    changes = list(sqlite_timespan.changes_since(seq))
+    assert [(is_insert, t.name) for _, is_insert, t in changes] == [
+        (True, "New"),
+        (True, "Daily"),
+        (False, "New"),
+    ]
+    assert isinstance(changes[1][2], RecurringTag)
+    assert [s for s, _, _ in changes] == [1, 2, 3]
+    assert sqlite_timespan.last_seq == 3
+    assert list(sqlite_timespan.changes_since(2))[0][0] == 3
+
+    sqlite_timespan.truncate_journal(3)
+    assert list(sqlite_timespan.changes_since(0)) == []
+    assert sqlite_timespan.last_seq == 3
+
+
+def test_sqlite_subscribe(sqlite_timespan, generic_span):
+    start = generic_span.begins_at.replace(microsecond=0)
+    window = Span(start, start + dt.timedelta(days=1))
+    seen = []
+    unsubscribe = sqlite_timespan.subscribe(
+        lambda is_insert, tag: seen.append((is_insert, tag)), span=window
+    )
+
+    inside = Tag("Inside", valid_from=start, valid_to=start + dt.timedelta(hours=1))
+    outside = Tag(
+        "Outside",
+        valid_from=start + dt.timedelta(days=2),
+        valid_to=start + dt.timedelta(days=2, hours=1),
+    )
+    daily = RecurringTag(
+        "Daily",
+        valid_from=start,
+        valid_to=start + dt.timedelta(days=5),
+        recurrence="RRULE:FREQ=DAILY",
+        duration=dt.timedelta(minutes=30),
+    )
+    sqlite_timespan.insert_tags([inside, outside, daily])
+    assert [(i, t.name) for i, t in seen] == [
+        (True, "Inside"),
+        (True, "Daily"),
+        (True, "Daily"),
+    ]
+    assert not any(isinstance(t, RecurringTag) for _, t in seen)
+
+    seen.clear()
+    assert sqlite_timespan.remove_tag(inside)
+    assert not sqlite_timespan.remove_tag(inside)
+    sqlite_timespan.remove_tag(outside)
+    assert [(i, t.name) for i, t in seen] == [(False, "Inside")]
+
+    unsubscribe()
+    seen.clear()
+    sqlite_timespan.insert_tag(inside)
+    assert seen == []
+
+
+def test_sqlite_meta_subscribe(sqlite_metatimespan, generic_span):
+    start = generic_span.begins_at
+    cached = CachedTimeSpan(sqlite_metatimespan)
+    assert len(cached.filter("Meta")) == 0
+
+    seen = []
+    sqlite_metatimespan.subscribe(lambda is_insert, tag: seen.append(tag))
+    tag = MetaTag(
+        "New",
+        category=Category("Meta"),
+        valid_from=start,
+        valid_to=start + dt.timedelta(hours=1),
+        data={"a": 1},
+    )
+    sqlite_metatimespan.insert_metatag(tag)
+    assert seen == [tag]
+    assert len(cached.filter("Meta")) == 1
+
+
+def test_cached_timespan(sqlite_timespan):
+    cached = CachedTimeSpan(sqlite_timespan, max_tags=4)
+    begins_at = sqlite_timespan.span.begins_at
+    a, b = begins_at, begins_at + dt.timedelta(minutes=45)
+
+    assert len(cached) == 4
+    first = cached.reslice(a, b)
+    assert cached.reslice(a, b) is first
+    assert len(first) == 2
+    assert cached.filter("A/B/C") is cached.filter("A/B/C")
+    assert (cached.hits, cached.misses) == (2, 3)
+    # Results are shared, so they can't be changed by whoever receives them
+    assert isinstance(first, ReadOnlyTimeSpan)
+    assert not hasattr(first, "insert_tag")
+    assert cached.size == 4
+
+    # Over budget: the least recently used entry, len, is evicted
+    c, d = a + dt.timedelta(hours=3), a + dt.timedelta(hours=4)
+    late = cached.reslice(c, d)
+    assert cached.size == 4
+    assert ("len",) not in cached._entries
+
+    # Only the entries that could see the new tag are dropped
+    tag = Tag("New", valid_from=a, valid_to=a + dt.timedelta(minutes=5))
+    sqlite_timespan.insert_tag(tag)
+    assert cached.size == 2
+    assert cached.reslice(c, d) is late
+    assert len(cached.filter("A/B/C")) == 1
+    assert "New" in {t.name for t in cached.reslice(a, b).iter_tags()}
+    assert len(cached) == 5
+
+    cached.close()
+    sqlite_timespan.remove_tag(tag)
+    assert cached.size == 0
+
+
+def test_sqlite_spill(complex_timespan_tags, generic_span):
+    timespan = SqliteTimeSpan(complex_timespan_tags, memory_budget=64 * 1024)
+    assert not timespan.spilled
+
+    start = generic_span.begins_at
+    timespan.insert_tags(
+        Tag(f"Tag {i}", valid_from=start, valid_to=start + dt.timedelta(minutes=i))
+        for i in range(2000)
+    )
+    assert timespan.spilled
+    path = timespan._spill_path
+    assert path.exists()
+    assert len(timespan) == 2004
+    assert len(list(timespan.active_at(start + dt.timedelta(minutes=1999)))) == 1
+    assert len(timespan.filter("A/B")) == 2
+
+    del timespan
+    assert not path.exists()
+
+    # Spilling waits for compaction's transaction to finish
+    timespan = SqliteTimeSpan(complex_timespan_tags, memory_budget=1024 * 1024)
+    timespan._memory_budget = 1024
+    timespan.compact()
+    assert timespan.spilled
+    assert sorted(timespan.iter_tags()) == sorted(complex_timespan_tags)
+
+
+def test_concurrent_sqlite(complex_timespan_tags, generic_span):
+    timespan = ConcurrentSqliteTimeSpan(complex_timespan_tags)
+    start = generic_span.begins_at
+    new_tags = [
+        Tag(f"Thread {i}", valid_from=start, valid_to=start + dt.timedelta(hours=i))
+        for i in range(1, 5)
+    ]
+
+    # An open iterator holds its snapshot, without blocking the writers
+    reading = iter(timespan.iter_tags(order_by="valid_from"))
+    first = next(reading)
+    writers = [
+        threading.Thread(target=timespan.insert_tag, args=(tag,)) for tag in new_tags
+    ]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    assert [first] + list(reading) == sorted(
+        complex_timespan_tags, key=attrgetter("valid_from")
+    )
+
+    with timespan.snapshot():
+        before = len(timespan)
+        worker = threading.Thread(target=timespan.remove_tag, args=(new_tags[0],))
+        worker.start()
+        worker.join()
+        assert len(timespan) == before == 8
+    assert len(timespan) == 7
+
+    seen = []
+    readers = [
+        threading.Thread(target=lambda: seen.append(len(timespan))) for _ in range(4)
+    ]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    assert seen == [7, 7, 7, 7]
+
+
+def test_concurrent_sqlite_reopen(complex_timespan_tags, generic_span):
+    start = generic_span.begins_at.replace(microsecond=0)
+    daily = RecurringTag(
+        "Daily",
+        valid_from=start,
+        valid_to=start + dt.timedelta(days=2),
+        recurrence="RRULE:FREQ=DAILY",
+    )
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir) / "store.sqlite"
+        first = ConcurrentSqliteTimeSpan(complex_timespan_tags | {daily}, path=path)
+        reopened = ConcurrentSqliteTimeSpan(path=path)
+        assert sorted(reopened.iter_tags()) == sorted(first.iter_tags())
+        assert reopened.fingerprint.root == first.fingerprint.root
+        assert (
+            reopened.category_pool.categories.keys()
+            == first.category_pool.categories.keys()
+        )
+        assert len(reopened.filter("A")) == len(first.filter("A"))
+        assert reopened._max_duration == first._max_duration
+
+        later = Tag(
+            "Later",
+            category=reopened.category_pool.get_category("A"),
+            valid_from=start,
+            valid_to=start + dt.timedelta(hours=1),
+        )
+        reopened.insert_tag(later)
+        assert first.has_tag(later)
+        del first, reopened
+
+
+@pytest.mark.parametrize(
+    "datestring",
+    [
+        "2020-03-04",
+        "2020-03-04T05:06:07Z",
+        "2020-03-04T05:06:07.123-07:00",
+        "2020-03-04 05:06:07.123456+00:00",
+        "2020-03-04T05:06:07",
+        "March 4 2020 5pm",
+        "2020-03-04T05:06:07.1Z",
+    ],
+)
+def test_date_parse(datestring):
+    expected = dateutil_parse(datestring).astimezone(dt.timezone.utc)
+    assert date_parse(datestring) == expected
+    assert date_parse(datestring).tzinfo == dt.timezone.utc
+    assert date_parse(datestring) is date_parse(datestring)